@@ -0,0 +1,278 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import platform
+import numpy as np
+
+# also puts the backend sources on the path
+from synthetic import StubModel, generate_library, write_images
+
+import src.api
+from src.ann import indexes
+from src.sql_wrapper import DataBase
+from src.persistence import Persistence
+
+# Latency of the main queries and routes on synthetic libraries, with a stub
+# model so that no weights are needed. The files of the library do not exist,
+# except for the sync benchmark which writes its own.
+#
+#   python benchmarks/library.py --sizes 1000 10000 100000 1000000 --json \
+#       > results.jsonl
+#   python benchmarks/library.py --compare results.jsonl
+#   python benchmarks/library.py --index exact --sizes 300000 --skip-routes
+
+def timings(func, repeat: int, rng: np.random.Generator) -> dict:
+    # func(rng) is called repeat times
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(rng)
+        times.append(time.perf_counter() - start)
+
+    times = np.array(times) * 1000
+    return {'repeat': repeat, 'mean_ms': float(times.mean()),
+            'median_ms': float(np.median(times)),
+            'p95_ms': float(np.percentile(times, 95)),
+            'min_ms': float(times.min())}
+
+def tag_ids(db: Persistence) -> tuple[int, int]:
+    # the most and one of the least common tags
+    counts = sorted((db.tag_index.count(tag['id']), tag['id'])
+                    for tag in db.all_tags())
+    return counts[-1][1], counts[len(counts) // 10][1]
+
+def benchmark_queries(db: Persistence, ids: list[int], repeat: int,
+                      rng: np.random.Generator) -> dict[str, dict]:
+    common, rare = tag_ids(db)
+    timestamps = [db._get_image_from_id(int(id))['timestamp']
+                  for id in rng.choice(ids, min(len(ids), 100))]
+    counter = iter(range(1 << 30))
+
+    def random_id(rng):
+        return int(rng.choice(ids))
+
+    benchmarks = {
+        # distinct prompts, the prompt cache never hits
+        'prompt_n_best': lambda rng: db.prompt_n_best(
+            f'query {next(counter)}', 50),
+        'filter_all_images_common': lambda rng: db.filter_all_images(
+            [common], 100),
+        'filter_all_images_rare': lambda rng: db.filter_all_images(
+            [rare], 100),
+        'filter_all_images_both': lambda rng: db.filter_all_images(
+            [common, rare], 100),
+        'similar_images': lambda rng: db.similar_images(random_id(rng), 20),
+        'filter_around': lambda rng: db.filter_around(
+            random_id(rng), [common], 10),
+        'closest_to_date': lambda rng: db.closest_to_date(
+            float(rng.choice(timestamps))),
+    }
+    results = {name: timings(func, repeat, rng)
+               for name, func in benchmarks.items()}
+
+    # scores every image against the new tag
+    results['new_tag'] = timings(
+        lambda rng: db.new_tag(f'new tag {next(counter)}', False),
+        max(1, repeat // 10), rng)
+    return results
+
+def benchmark_recall(db: Persistence, ids: np.ndarray, queries: int,
+                     rng: np.random.Generator) -> dict[str, float]:
+    # recall@20 of the index against an exact scan, for searches by a stored
+    # image with the default nprobe. Prompts always scan exactly. The index
+    # only differs from an exact scan on libraries large enough to train it.
+    images = db.embeddings.vectors(db.embeddings.rows_of(
+        rng.choice(ids, min(len(ids), queries), replace=False)))
+    return {'recall_image': db.index.measure_recall(images, 20)}
+
+def benchmark_sync(tmp: str, files: int, repeat: int,
+                   rng: np.random.Generator) -> dict[str, dict]:
+    images_dir = os.path.join(tmp, 'sync')
+    write_images(images_dir, files)
+    db = Persistence(os.path.join(tmp, 'sync.db'), images_dir, StubModel(),
+                     sync_batch_size=32)
+
+    results = {'sync_new': timings(lambda rng: db.sync(), 1, rng)}
+    # nothing changed, only the file stats are compared
+    results['sync_unchanged'] = timings(lambda rng: db.sync(), repeat, rng)
+    db.close()
+    return results
+
+def benchmark_routes(db_file: str, images_dir: str, ids: list[int],
+                     repeat: int, rng: np.random.Generator
+                     ) -> dict[str, dict]:
+    from fastapi.testclient import TestClient
+
+    # the lifespan is not entered: the startup sync job never runs, it would
+    # remove the images whose files do not exist
+    src.api.Model = StubModel
+    app = src.api.setup_api(db_file, images_dir, text_cache=False)
+    client = TestClient(app)
+
+    common = client.get('/tags/list').json()[0]['id']
+    counter = iter(range(1 << 30))
+
+    def get(url, **params):
+        response = client.get(url, params=params)
+        response.raise_for_status()
+
+    def post(url, body, **params):
+        response = client.post(url, params=params, json=body)
+        response.raise_for_status()
+
+    routes = {
+        'GET /images/prompt': lambda rng: get(
+            '/images/prompt', prompt=f'route query {next(counter)}', n=50),
+        'POST /images/filter': lambda rng: post(
+            '/images/filter', [common], limit=100),
+        'POST /images/around': lambda rng: post(
+            '/images/around', [common], image_id=int(rng.choice(ids)), n=10),
+        'GET /images/date': lambda rng: get(
+            '/images/date', timestamp=int(rng.integers(1.3e9, 1.7e9))),
+        'GET /images/list-ids': lambda rng: get('/images/list-ids',
+                                                limit=1000),
+        'GET /tags/list': lambda rng: get('/tags/list'),
+    }
+    results = {name: timings(func, repeat, rng)
+               for name, func in routes.items()}
+    return results
+
+def run(size: int, args: argparse.Namespace) -> list[dict]:
+    rng = np.random.default_rng(args.seed)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, 'library.db')
+        images_dir = os.path.join(tmp, 'images')
+
+        start = time.perf_counter()
+        generate_library(db_file, images_dir, size, args.tags,
+                         args.tags_per_image, seed=args.seed)
+        generate = time.perf_counter() - start
+
+        start = time.perf_counter()
+        db = Persistence(db_file, images_dir, StubModel())
+        open_ms = (time.perf_counter() - start) * 1000
+        results.append({'benchmark': 'open', 'mean_ms': open_ms,
+                        'median_ms': open_ms, 'repeat': 1})
+
+        # an array, choosing from a list converts it on every call
+        ids = np.array(db.all_image_ids())
+        for name, stats in benchmark_queries(db, ids, args.repeat,
+                                             rng).items():
+            results.append({'benchmark': name, **stats})
+        for name, recall in benchmark_recall(db, ids, args.recall_queries,
+                                             rng).items():
+            results.append({'benchmark': name, 'recall': recall,
+                            'index': type(db.index).__name__})
+        db.close()
+
+        if not args.skip_routes:
+            for name, stats in benchmark_routes(db_file, images_dir, ids,
+                                                args.repeat, rng).items():
+                results.append({'benchmark': name, **stats})
+
+        if not args.skip_sync:
+            files = min(size, args.sync_files)
+            for name, stats in benchmark_sync(tmp, files, args.repeat,
+                                              rng).items():
+                results.append({'benchmark': name, 'files': files, **stats})
+
+    for result in results:
+        result['size'] = size
+        result['generate_s'] = generate
+    return results
+
+def compare(baseline_file: str, results: list[dict],
+            threshold: float) -> bool:
+    # prints the median of each benchmark against the baseline, returns
+    # whether none got slower than the threshold ratio
+    with open(baseline_file) as f:
+        baseline = {(result['size'], result['benchmark']): result
+                    for result in map(json.loads, f) if 'benchmark' in result}
+
+    ok = True
+    for result in results:
+        if 'recall' in result:
+            continue
+        old = baseline.get((result['size'], result['benchmark']))
+        if old is None:
+            continue
+        ratio = result['median_ms'] / max(old['median_ms'], 1e-9)
+        slower = ratio > threshold
+        ok &= not slower
+        print(f'{result["size"]:>8} {result["benchmark"]:<28} '
+              f'{old["median_ms"]:9.2f} -> {result["median_ms"]:9.2f} ms '
+              f'x{ratio:.2f}{"  SLOWER" if slower else ""}')
+    return ok
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--tags', type=int, default=200,
+                        help='tags besides the default ones')
+    parser.add_argument('--tags-per-image', type=float, default=4)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--sync-files', type=int, default=2000,
+                        help='files synced at most, written to disk')
+    parser.add_argument('--skip-routes', action='store_true')
+    parser.add_argument('--skip-sync', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true',
+                        help='print one JSON object per benchmark')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='JSON output of a previous run to compare with, '
+                             'exits with 1 if a benchmark got slower')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='slowdown ratio reported as a regression')
+    parser.add_argument('--index', choices=list(indexes),
+                        default=DataBase.index_type,
+                        help='index of the searches by image, the IVF one '
+                             'is only trained on libraries of '
+                             'IVFIndex.min_train_size images')
+    parser.add_argument('--recall-queries', type=int, default=50)
+    parser.add_argument('--min-recall', type=float, default=.95,
+                        help='recall@20 of the index against an exact '
+                             'scan below which the run fails')
+    args = parser.parse_args()
+    DataBase.index_type = args.index
+
+    if args.json:
+        print(json.dumps({'python': platform.python_version(),
+                          'numpy': np.__version__,
+                          'machine': platform.machine(),
+                          'time': time.time()}))
+
+    results = []
+    for size in args.sizes:
+        for result in run(size, args):
+            results.append(result)
+            if args.json:
+                print(json.dumps(result), flush=True)
+            elif 'recall' in result:
+                print(f'{size:>8} {result["benchmark"]:<28} '
+                      f'{result["recall"]:9.3f} with {result["index"]}',
+                      flush=True)
+            elif not args.compare:
+                print(f'{size:>8} {result["benchmark"]:<28} '
+                      f'{result["median_ms"]:9.2f} ms median, '
+                      f'{result.get("p95_ms", result["median_ms"]):9.2f} ms '
+                      f'p95', flush=True)
+
+    low_recall = [result for result in results
+                  if result.get('recall', 1) < args.min_recall]
+    for result in low_recall:
+        print(f'{result["size"]:>8} {result["benchmark"]:<28} '
+              f'{result["recall"]:9.3f} below {args.min_recall}',
+              file=sys.stderr)
+
+    if args.compare and not compare(args.compare, results, args.threshold):
+        sys.exit(1)
+    if low_recall:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
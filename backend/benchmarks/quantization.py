@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import tempfile
+import numpy as np
+
+# run from anywhere, the backend sources are one directory up
+backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, backend_dir)
+
+from src.embeddings import EmbeddingStore, normalize, top_n
+from src.quantization import codecs, storage_codecs
+from synthetic import synthetic_embeddings
+
+# Memory, disk size, recall@n and latency of the embedding formats against
+# float32, on synthetic clustered vectors shaped like CLIP embeddings.
+#
+#   python benchmarks/quantization.py --size 100000 --json
+
+def disk_bytes(codes: np.ndarray) -> int:
+    # size of an SQLite table holding the codes as blobs, like images
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        con = sqlite3.connect(path)
+        con.execute('CREATE TABLE images (id INTEGER PRIMARY KEY, '
+                    'embedding BLOB)')
+        con.executemany('INSERT INTO images (embedding) VALUES (?)',
+                        ((code.tobytes(),) for code in codes))
+        con.commit()
+        con.execute('VACUUM')
+        con.close()
+        return os.path.getsize(path)
+
+def benchmark(format: str, vectors: np.ndarray, queries: np.ndarray,
+              exact: list[set[int]], n: int, rerank_factor: int) -> dict:
+    dim = vectors.shape[1]
+    codec = codecs[format](dim)
+
+    start = time.perf_counter()
+    codec.train(vectors)
+    store = EmbeddingStore(dim, codec=codec)
+    store.load(np.arange(len(vectors)), vectors)
+    build = time.perf_counter() - start
+
+    found = 0
+    found_reranked = 0
+    latency = 0
+    for query, expected in zip(queries, exact):
+        start = time.perf_counter()
+        _, ids = store.search(query, n)
+        latency += time.perf_counter() - start
+        found += len(expected.intersection(ids.tolist()))
+
+        # rescored with the float32 rows, as read back from the database
+        _, ids = store.search(query, n * rerank_factor)
+        best = top_n(vectors[ids] @ query, n)
+        found_reranked += len(expected.intersection(ids[best].tolist()))
+
+    total = len(queries) * n
+    return {
+        'format': format,
+        'memory_bytes_per_vector': store.codes.nbytes / len(vectors),
+        'disk_bytes_per_vector': disk_bytes(store.codes) / len(vectors)
+                                 if format in storage_codecs else None,
+        f'recall@{n}': found / total,
+        f'recall@{n}_reranked': found_reranked / total,
+        'query_ms': latency / len(queries) * 1000,
+        'build_s': build,
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--clusters', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('-n', type=int, default=10)
+    parser.add_argument('--rerank-factor', type=int, default=4)
+    parser.add_argument('--formats', nargs='+', default=list(codecs))
+    parser.add_argument('--json', action='store_true',
+                        help='print one JSON object per format')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = synthetic_embeddings(args.size, args.dim, args.clusters, rng)
+    # queries land near existing images, like a prompt matching some photos
+    queries = vectors[rng.choice(args.size, args.queries, replace=False)]
+    queries = normalize(queries + rng.standard_normal(queries.shape) * .05)
+    exact = [set(top_n(vectors @ query, args.n).tolist())
+             for query in queries]
+
+    for format in args.formats:
+        result = benchmark(format, vectors, queries, exact, args.n,
+                           args.rerank_factor)
+        if args.json:
+            print(json.dumps(result))
+            continue
+
+        print(f'{format:>8}: '
+              f'{result["memory_bytes_per_vector"]:7.1f} B/vector in memory, '
+              f'{result["disk_bytes_per_vector"] or 0:7.1f} B/vector on disk, '
+              f'recall@{args.n} {result[f"recall@{args.n}"]:.3f} '
+              f'({result[f"recall@{args.n}_reranked"]:.3f} re-ranked), '
+              f'{result["query_ms"]:.2f} ms/query')
+
+if __name__ == '__main__':
+    main()
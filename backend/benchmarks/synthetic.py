@@ -0,0 +1,128 @@
+import os
+import sys
+import zlib
+import sqlite3
+from datetime import datetime
+import numpy as np
+from PIL import Image
+
+backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, backend_dir)
+
+from src.model import Model
+from src.sql_wrapper import DataBase
+from src.embeddings import normalize
+from src.migrations import migrate
+
+# Synthetic libraries and a stand-in for the CLIP model, shared by the
+# benchmarks.
+
+def synthetic_embeddings(size: int, dim: int, clusters: int,
+                         rng: np.random.Generator) -> np.ndarray:
+    centers = normalize(rng.standard_normal((clusters, dim)))
+    labels = rng.integers(clusters, size=size)
+    noise = rng.standard_normal((size, dim)).astype(np.float32) * .04
+    return normalize(centers[labels] + noise)
+
+class StubModel(Model):
+    # embeddings seeded by a checksum of the text or the pixels: the same
+    # input always gets the same vector, without loading any weights
+    dim = 512
+
+    @property
+    def loaded(self) -> bool:
+        return True
+
+    def load(self) -> None:
+        pass
+
+    def _vector(self, input) -> np.ndarray:
+        if isinstance(input, str):
+            data = input.encode()
+        else:
+            data = input.convert('RGB').resize((8, 8)).tobytes()
+        rng = np.random.default_rng(zlib.crc32(data))
+        return rng.standard_normal(StubModel.dim).astype(np.float32)
+
+    def _encode(self, kind: str, inputs: list) -> np.ndarray:
+        if not inputs:
+            return np.empty((0, StubModel.dim), dtype=np.float32)
+        return np.stack([self._vector(input) for input in inputs])
+
+def _timestamps(size: int, rng: np.random.Generator) -> np.ndarray:
+    # photos come in sessions of a few shots a minute apart, spread over the
+    # last ten years
+    now = datetime(2025, 1, 1).timestamp()
+    sessions = max(size // 20, 1)
+    starts = rng.uniform(now - 10 * 365 * 86400, now, sessions)
+    session = rng.integers(sessions, size=size)
+    return starts[session] + rng.exponential(60, size)
+
+def generate_library(db_file: str, images_dir: str, size: int, tags: int,
+                     tags_per_image: float = 4, clusters: int = 1000,
+                     seed: int = 0, chunk_size: int = 50000) -> None:
+    # writes size images and tags straight into a new database, as a sync
+    # would have: each image gets a few tags, picked with a long tailed
+    # popularity, plus the tags of its year and month. The image files do
+    # not exist.
+    rng = np.random.default_rng(seed)
+    con = sqlite3.connect(db_file)
+    con.execute('PRAGMA journal_mode = wal')
+    migrate(con)
+
+    names = DataBase.basic_tags + [f'tag{i}' for i in range(tags)]
+    con.executemany("""
+    INSERT INTO tags (name, is_dirname, embedding)
+    VALUES (?, ?, ?)""", [(name, False, vector.tobytes()) for name, vector
+                          in zip(names, synthetic_embeddings(
+                              len(names), StubModel.dim, clusters, rng))])
+    tag_ids = {name: id for id, name in con.execute(
+        'SELECT tags.id, tags.name FROM tags')}
+    popular = np.array([tag_ids[name] for name in names])
+
+    timestamps = _timestamps(size, rng)
+    for start in range(0, size, chunk_size):
+        end = min(start + chunk_size, size)
+        count = end - start
+        embeddings = synthetic_embeddings(count, StubModel.dim, clusters, rng)
+        con.executemany("""
+        INSERT INTO images
+            (id, path, timestamp, embedding, size, mtime, hash, phash)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", [
+            (id + 1, os.path.join(images_dir, f'img{id}.jpg'), float(ts),
+             embedding.tobytes(), 100000, float(ts), f'{id:016x}',
+             int(rng.integers(-2 ** 63, 2 ** 63 - 1)))
+            for id, ts, embedding in zip(range(start, end),
+                                         timestamps[start:end], embeddings)])
+
+        pairs = set()
+        counts = rng.poisson(tags_per_image, count)
+        for i, (id, ts) in enumerate(zip(range(start + 1, end + 1),
+                                         timestamps[start:end])):
+            picks = rng.zipf(1.3, counts[i]) % len(popular)
+            pairs.update((id, int(tag)) for tag in popular[picks])
+
+            date = datetime.fromtimestamp(ts)
+            for name in [str(date.year), date.strftime('%B')]:
+                if name not in tag_ids:
+                    tag_ids[name] = con.execute("""
+                    INSERT INTO tags (name, is_dirname, embedding)
+                    VALUES (?, ?, ?)""", [name, False, normalize(
+                        rng.standard_normal((1, StubModel.dim)))[0]
+                        .tobytes()]).lastrowid
+                pairs.add((id, tag_ids[name]))
+
+        con.executemany("""
+        INSERT INTO tags_join (image_id, tag_id)
+        VALUES (?, ?)""", sorted(pairs))
+        con.commit()
+
+    con.close()
+
+def write_images(images_dir: str, count: int, seed: int = 0) -> None:
+    # small image files with distinct contents, for syncing
+    rng = np.random.default_rng(seed)
+    os.makedirs(images_dir, exist_ok=True)
+    for i in range(count):
+        pixels = rng.integers(0, 256, (16, 16, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(images_dir, f'img{i}.png'))
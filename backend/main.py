@@ -9,8 +9,32 @@ origins = [
 db_path = 'db.db'
 images_path = os.getenv('IMAGES_PATH')
 verbose = False
+# number of images embedded at once and image decoding threads during sync
+batch_size = 32
+workers = os.cpu_count()
+# keep the database up to date with file changes while running
+watch = False
+# threads serving database requests and running the model concurrently
+db_workers = 8
+inference_workers = 1
+# keep the embeddings of prompts and tag names across restarts
+text_cache = True
+# run the model in its own process, batching concurrent requests.
+# inference_workers only applies to the model running in this process.
+inference_process = True
+# SQL statements taking longer are logged with their parameters, None to
+# disable the log
+slow_query_ms = None
+# original files sent by a front server rather than from here:
+# 'X-Accel-Redirect' for nginx, with an internal location serving
+# IMAGES_PATH under sendfile_prefix, 'X-Sendfile' for Apache or lighttpd
+sendfile_header = None
+sendfile_prefix = '/originals/'
 if not images_path or not os.path.isdir(images_path):
     print('Please provide a valid IMAGES_PATH environment variable')
     exit(1)
 
-app = setup_api(db_path, images_path, verbose, origins)
+app = setup_api(db_path, images_path, verbose, origins, batch_size, workers,
+                watch, db_workers, inference_workers, text_cache,
+                inference_process, slow_query_ms, sendfile_header,
+                sendfile_prefix)
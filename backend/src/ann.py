@@ -0,0 +1,243 @@
+import os
+import numpy as np
+
+from .embeddings import EmbeddingStore, normalize, top_n
+
+class ExactIndex:
+    # brute-force scan over the whole embedding store, always exact
+
+    def __init__(self, store: EmbeddingStore):
+        self.store = store
+
+    def add(self, ids: list[int]) -> None:
+        pass
+
+    def remove(self, id: int) -> None:
+        pass
+
+    def clear(self) -> None:
+        pass
+
+    def maybe_train(self) -> bool:
+        return False
+
+    def save(self, path: str) -> None:
+        pass
+
+    def load(self, path: str) -> None:
+        pass
+
+    def search(self, query: np.ndarray, n: int,
+               nprobe: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        return self.store.search(query, n)
+
+    def measure_recall(self, queries: np.ndarray, n: int,
+                       nprobe: int | None = None) -> float:
+        # fraction of the exact top n that the index also returns
+        found = 0
+        for query in queries:
+            _, exact = self.store.search(query, n)
+            _, approx = self.search(query, n, nprobe)
+            found += len(np.intersect1d(exact, approx))
+
+        total = len(queries) * min(n, len(self.store))
+        return 1 if total == 0 else found / total
+
+class IVFIndex(ExactIndex):
+    # inverted file index: vectors are copied into buckets by their closest
+    # k-means centroid and a query only scans the buckets of its nprobe
+    # closest centroids, trading recall for latency
+
+    # below this many images a brute-force scan is fast enough
+    min_train_size = 50000
+    # retrain when the library grew this much since the last training
+    retrain_factor = 4
+    # share of the lists scanned by default, for searches by image: recall@20
+    # against an exact scan stays above .95 on the synthetic libraries of
+    # benchmarks/library.py up to 600k images, for 4 to 5 times fewer
+    # vectors scored. Text prompts are far from every image and their best
+    # matches spread over too many lists, they never use the index.
+    nprobe_ratio = .16
+    min_nprobe = 32
+    kmeans_iterations = 10
+    kmeans_sample_per_list = 64
+
+    def __init__(self, store: EmbeddingStore):
+        super().__init__(store)
+        self.clear()
+
+    def clear(self) -> None:
+        self.centroids = None
+        self.trained_size = 0
+        self.labels: dict[int, int] = {} # image id -> list
+        self.lists: list[EmbeddingStore] = []
+
+    @property
+    def nlist(self) -> int:
+        return 0 if self.centroids is None else len(self.centroids)
+
+    @property
+    def default_nprobe(self) -> int:
+        return max(IVFIndex.min_nprobe,
+                   int(np.ceil(self.nlist * IVFIndex.nprobe_ratio)))
+
+    def _nearest(self, data: np.ndarray) -> np.ndarray:
+        labels = np.empty(len(data), dtype=np.int64)
+
+        chunk_size = 4096
+        for i in range(0, len(data), chunk_size):
+            chunk = data[i:i + chunk_size] @ self.centroids.T
+            labels[i:i + chunk_size] = np.argmax(chunk, axis=1)
+
+        return labels
+
+    def _labels(self, rows: np.ndarray) -> np.ndarray:
+        # nearest centroids of stored rows, decoded a chunk at a time
+        chunk_size = 4096
+        return np.concatenate(
+            [self._nearest(self.store.vectors(rows[i:i + chunk_size]))
+             for i in range(0, len(rows), chunk_size)]
+            + [np.empty(0, dtype=np.int64)])
+
+    def _kmeans(self, data: np.ndarray, k: int) -> np.ndarray:
+        rng = np.random.default_rng(0)
+        self.centroids = data[rng.choice(len(data), k, replace=False)]
+
+        for _ in range(IVFIndex.kmeans_iterations):
+            labels = self._nearest(data)
+            order = np.argsort(labels, kind='stable')
+            present, starts = np.unique(labels[order], return_index=True)
+
+            sums = data[rng.choice(len(data), k)] # reseeds empty lists
+            sums[present] = np.add.reduceat(data[order], starts, axis=0)
+            self.centroids = normalize(sums)
+
+        return self.centroids
+
+    def train(self) -> None:
+        size = len(self.store)
+        k = max(1, int(np.sqrt(size)))
+
+        sample_size = min(size, k * IVFIndex.kmeans_sample_per_list)
+        rng = np.random.default_rng(0)
+        sample = self.store.vectors(rng.choice(size, sample_size,
+                                               replace=False))
+        self._kmeans(sample, k)
+
+        self.trained_size = size
+        self._init_lists(k)
+        self._assign(self.store.ids.tolist(), self._labels(np.arange(size)))
+
+    def _init_lists(self, k: int) -> None:
+        self.labels = {}
+        self.lists = [EmbeddingStore(self.store.dim, 16, self.store.codec)
+                      for _ in range(k)]
+
+    def maybe_train(self) -> bool:
+        size = len(self.store)
+        if size < IVFIndex.min_train_size:
+            if self.centroids is not None:
+                self.clear()
+            return False
+
+        if self.centroids is not None \
+                and size <= self.trained_size * IVFIndex.retrain_factor \
+                and size * IVFIndex.retrain_factor >= self.trained_size:
+            return False
+
+        self.train()
+        return True
+
+    def _assign(self, ids: list[int], labels: np.ndarray) -> None:
+        for id in ids:
+            self.remove(id)
+        self.labels.update(zip(ids, labels.tolist()))
+
+        # group by list to copy the vectors in bulk
+        ids = np.asarray(ids, dtype=np.int64)
+        rows = self.store.rows_of(ids)
+        order = np.argsort(labels, kind='stable')
+        present, starts = np.unique(labels[order], return_index=True)
+        for label, group in zip(present.tolist(), np.split(order, starts[1:])):
+            self.lists[label].add_codes(ids[group],
+                                        self.store.codes[rows[group]])
+
+    def add(self, ids: list[int]) -> None:
+        if self.centroids is None:
+            return
+
+        rows = self.store.rows_of(ids)
+        self._assign(ids, self._labels(rows))
+
+    def remove(self, id: int) -> None:
+        label = self.labels.pop(id, None)
+        if label is not None:
+            self.lists[label].remove(id)
+
+    def save(self, path: str) -> None:
+        if self.centroids is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+
+        ids = np.fromiter(self.labels.keys(), dtype=np.int64,
+                          count=len(self.labels))
+        labels = np.fromiter(self.labels.values(), dtype=np.int64,
+                             count=len(self.labels))
+
+        # write through a temporary file so a crash never leaves half an index
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, ids=ids, labels=labels,
+                     trained_size=self.trained_size)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str) -> None:
+        self.clear()
+
+        try:
+            with np.load(path) as data:
+                centroids = data['centroids']
+                ids = data['ids']
+                labels = data['labels']
+                trained_size = int(data['trained_size'])
+        except (OSError, KeyError, ValueError):
+            return
+
+        if centroids.shape[1:] != (self.store.dim,):
+            return
+
+        self.centroids = centroids
+        self.trained_size = trained_size
+        self._init_lists(len(centroids))
+
+        # reconcile with the images that changed since the index was saved
+        known = [i for i, id in enumerate(ids.tolist()) if id in self.store]
+        self._assign(ids[known].tolist(), labels[known])
+        missing = [id for id in self.store.ids.tolist()
+                   if id not in self.labels]
+        self.add(missing)
+
+    def search(self, query: np.ndarray, n: int,
+               nprobe: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        if nprobe is None:
+            nprobe = self.default_nprobe
+        if self.centroids is None or nprobe >= self.nlist:
+            return self.store.search(query, n)
+
+        query = normalize(query)
+        probed = top_n(self.centroids @ query, max(1, nprobe))
+
+        lists = [self.lists[label] for label in probed.tolist()]
+        if sum(len(l) for l in lists) < n:
+            return self.store.search(query, n)
+
+        scores = np.concatenate([l.scores(query) for l in lists])
+        ids = np.concatenate([l.ids for l in lists])
+        best = top_n(scores, n)
+        return scores[best], ids[best]
+
+indexes = {
+    'exact': ExactIndex,
+    'ivf': IVFIndex,
+}
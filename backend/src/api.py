@@ -1,25 +1,161 @@
+import os
+import json
+import time
+import asyncio
+import mimetypes
+from sys import stderr
+from urllib.parse import quote
+from email.utils import formatdate, parsedate_to_datetime
+from functools import partial
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, File, Form, UploadFile
-from fastapi.responses import FileResponse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from fastapi import FastAPI, File, Form, Query, Request, Response, UploadFile
+from fastapi.responses import FileResponse, PlainTextResponse, \
+    StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from .model import Model
 from .persistence import Persistence
+from .watcher import create_watcher
 
 def setup_api(db_path: str, images_path: str, verbose: bool = False,
-              cross_origin: list[str] | None = None):
-    model = Model()
-    db = Persistence(db_path, images_path, model, verbose=verbose)
-    db.sync()
+              cross_origin: list[str] | None = None, batch_size: int = 32,
+              workers: int | None = None, watch: bool = False,
+              db_workers: int = 8, inference_workers: int = 1,
+              text_cache: bool = True, inference_process: bool = False,
+              slow_query_ms: float | None = None,
+              sendfile_header: str | None = None,
+              sendfile_prefix: str = '/originals/'):
+    if sendfile_header not in [None, 'X-Accel-Redirect', 'X-Sendfile']:
+        raise ValueError(f'Unsupported sendfile header: {sendfile_header}')
+
+    text_cache_file = None
+    if text_cache:
+        text_cache_file = os.path.splitext(db_path)[0] + '.text_cache.db'
+    model = Model(inference_workers, text_cache_file, inference_process)
+    db = Persistence(db_path, images_path, model, verbose=verbose,
+                     sync_batch_size=batch_size, sync_workers=workers,
+                     slow_query_seconds=None if slow_query_ms is None
+                     else slow_query_ms / 1000)
+    metrics = db.metrics
+    # submitted on startup, see lifespan
+    startup_sync: int | None = None
+
+    # database and model work is blocking, keep it off the event loop.
+    # Inference has its own pool inside Model, bounded separately.
+    db_pool = ThreadPoolExecutor(db_workers, thread_name_prefix='db')
+
+    # page size used when streaming without an explicit limit
+    stream_chunk = 1000
+    # files in a batch upload, an archive counting as one
+    upload_max_files = 10000
+
+    async def run(func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(db_pool, partial(func, *args))
+
+    async def paginate(page: Callable, convert: Callable, response: Response,
+                       limit: int | None, cursor: str | None,
+                       stream: bool) -> list | StreamingResponse:
+        # page(limit, cursor) returns (items, next_cursor). Streamed responses
+        # fetch one page at a time, as newline delimited JSON.
+        if not stream:
+            items, next_cursor = await page(limit, cursor)
+            if next_cursor is not None:
+                response.headers['X-Next-Cursor'] = next_cursor
+            return [convert(item) for item in items]
+
+        async def lines():
+            next_cursor = cursor
+            while True:
+                items, next_cursor = await page(limit or stream_chunk,
+                                                next_cursor)
+                if items:
+                    yield ''.join(json.dumps(convert(item)) + '\n'
+                                  for item in items)
+                if next_cursor is None:
+                    break
+
+        return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+    async def sync_changes(queue: asyncio.Queue) -> None:
+        while True:
+            paths = set(await queue.get())
+            while not queue.empty():
+                paths.update(queue.get_nowait())
+
+            try:
+                await run(db.sync_paths, sorted(paths))
+            except Exception as e:
+                print(f'Error: failed to sync changed files: {e}', file=stderr)
+
+    # background duplicate detection, at most one at a time
+    detection: asyncio.Task | None = None
+
+    async def detect_duplicates() -> None:
+        try:
+            await run(db.detect_duplicates)
+        except Exception as e:
+            print(f'Error: failed to detect duplicates: {e}', file=stderr)
 
     @asynccontextmanager
     async def lifespan(app: FastAPI):
+        nonlocal startup_sync
+        db.jobs.start()
+        # serve the library as it is while the changes since the last run are
+        # found in the background. A sync or reset interrupted by the last
+        # run is resumed instead, another sync would find the same changes.
+        startup_sync = db.jobs.find(['sync', 'reset'])
+        if startup_sync is None:
+            startup_sync = db.jobs.submit('sync')
+        watcher = None
+        if watch:
+            loop = asyncio.get_running_loop()
+            queue = asyncio.Queue()
+            watcher = create_watcher(
+                images_path,
+                lambda paths: loop.call_soon_threadsafe(queue.put_nowait,
+                                                        paths))
+            watcher.start()
+            task = asyncio.create_task(sync_changes(queue))
+
         yield
 
+        if watcher is not None:
+            watcher.stop()
+            task.cancel()
+        if detection is not None:
+            await detection
+        await asyncio.to_thread(db.jobs.stop)
+        db_pool.shutdown()
+        model.close()
         db.close()
 
     app = FastAPI(lifespan=lifespan)
 
+    @app.middleware('http')
+    async def time_requests(request: Request, call_next):
+        # until the response starts, streamed bodies are not included
+        start = time.perf_counter()
+        response = await call_next(request)
+        # labelled by the route template, not the path with its ids
+        route = request.scope.get('route')
+        route = 'unmatched' if route is None else route.path
+        metrics.observe('mediadb_http_request_seconds',
+                        time.perf_counter() - start,
+                        method=request.method, route=route)
+        metrics.increment('mediadb_http_requests_total',
+                          method=request.method, route=route,
+                          status=response.status_code)
+        return response
+
+    pagination_doc = (
+        ' With a limit, at most that many items are returned and the '
+        'X-Next-Cursor response header holds the cursor of the next page, if '
+        'any. With stream, all the items after the cursor are sent as '
+        'newline delimited JSON, fetched limit items at a time.')
+
     if cross_origin is not None:
         app.add_middleware(
             CORSMiddleware,
@@ -27,40 +163,120 @@ def setup_api(db_path: str, images_path: str, verbose: bool = False,
             allow_credentials=True,
             allow_methods=['*'],
             allow_headers=['*'],
+            expose_headers=['X-Next-Cursor', 'X-Search-Plan'],
         )
 
+    def not_modified(request: Request, etag: str,
+                     mtime: float | None = None) -> bool:
+        # If-None-Match wins over If-Modified-Since when both are sent
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(',')]
+
+        if_modified_since = request.headers.get('if-modified-since')
+        if mtime is None or if_modified_since is None:
+            return False
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates are in whole seconds
+        return int(mtime) <= since
+
     @app.get('/image/{image_id}/data',
              summary='Get image data',
-             description='Retrieve an image\'s data from its id.')
-    async def image_data_from_id(image_id: int) -> FileResponse:
-        res = db.get_image_path_for_data(image_id)
-        return FileResponse(res)
+             description='Retrieve an image\'s data from its id. Supports '
+                         'conditional requests with If-None-Match or '
+                         'If-Modified-Since, and byte ranges with Range.')
+    async def image_data_from_id(image_id: int,
+                                 request: Request) -> FileResponse:
+        path, stat = await run(db.get_image_file, image_id)
+        headers = {
+            'ETag': f'"{image_id}-{stat.st_size}-{stat.st_mtime_ns}"',
+            'Last-Modified': formatdate(stat.st_mtime, usegmt=True),
+            'Cache-Control': 'public, max-age=86400',
+        }
+        if not_modified(request, headers['ETag'], stat.st_mtime):
+            return Response(status_code=304, headers=headers)
+
+        media_type = mimetypes.guess_type(path)[0]
+        relative = os.path.relpath(path, images_path)
+        if sendfile_header == 'X-Accel-Redirect' \
+                and not relative.startswith(os.pardir):
+            # nginx sends the file from an internal location mapped to the
+            # images directory, ranges included
+            headers['X-Accel-Redirect'] = sendfile_prefix + quote(
+                relative.replace(os.sep, '/'))
+            return Response(headers=headers, media_type=media_type)
+        if sendfile_header == 'X-Sendfile':
+            headers['X-Sendfile'] = path
+            return Response(headers=headers, media_type=media_type)
+
+        # answers Range requests with partial content by itself
+        return FileResponse(path, headers=headers, media_type=media_type,
+                            stat_result=stat)
+
+    @app.get('/image/{image_id}/thumb',
+             summary='Get image thumbnail',
+             description='Retrieve a JPEG thumbnail of an image from its id. '
+                         'The size is the maximum width and height, rounded '
+                         'up to one of the cached sizes.')
+    async def image_thumb_from_id(image_id: int, request: Request,
+                                  size: int = 256) -> FileResponse:
+        path, etag = await run(db.get_image_thumb, image_id, size)
+        headers = {'ETag': etag, 'Cache-Control': 'public, max-age=86400'}
+
+        if not_modified(request, etag):
+            return Response(status_code=304, headers=headers)
+
+        return FileResponse(path, media_type='image/jpeg', headers=headers)
 
     @app.get('/image/{image_id}/info',
              summary='Get image info',
              description='Retrieve image id, name and timestamp from its id.')
     async def image_info_from_id(image_id: int) -> dict:
-        return db.safe_image(db.image_info_from_id(image_id))
+        return db.safe_image(await run(db.image_info_from_id, image_id))
 
     @app.delete('/image/{image_id}/delete',
                 summary='Delete image',
                 description='Delete image from the database and the local '
                             'files from its id.')
     async def delete_image(image_id: int) -> None:
-        db.delete_image_everywhere(image_id)
+        await run(db.delete_image_everywhere, image_id)
 
     @app.get('/image/{image_id}/tags',
              summary='Get image tags',
              description='Get a list of all the target image\'s tags id+name.')
     async def get_image_tags(image_id: int) -> list[dict]:
-        return [db.safe_tag(tag) for tag in db.get_image_tags(image_id)]
+        tags = await run(db.get_image_tags, image_id)
+        return [db.safe_tag(tag) for tag in tags]
+
+    @app.get('/image/{image_id}/similar',
+             summary='Get similar images',
+             description='Get the n images whose embeddings are the closest '
+                         'to that of the target image, the image itself '
+                         'excluded. Its stored embedding is reused. On large '
+                         'libraries nprobe trades recall for speed: higher '
+                         'values scan more of the index, leave it empty for '
+                         'the default.')
+    async def similar_images(image_id: int, n: int,
+                             nprobe: int | None = None) -> list[dict]:
+        results = await run(db.similar_images, image_id, n, nprobe)
+        return [{'score': score, **db.safe_image(image)}
+                for score, image in results]
 
     @app.get('/images/list-ids',
              summary='Get all image ids',
              description='Get a list with the ids of all the images in the '
-                         'database.')
-    async def all_image_ids() -> list[int]:
-        return db.all_image_ids()
+                         'database, newest first.' + pagination_doc)
+    async def all_image_ids(response: Response,
+                            limit: int | None = Query(None, ge=1),
+                            cursor: str | None = None,
+                            stream: bool = False) -> list[int]:
+        return await paginate(
+            lambda limit, cursor: run(db.filter_images_page, [], limit,
+                                      cursor),
+            lambda image: image['id'], response, limit, cursor, stream)
 
     @app.post('/images/new',
               summary='Add an image',
@@ -69,84 +285,252 @@ def setup_api(db_path: str, images_path: str, verbose: bool = False,
                           'database. The image is also written as a file.')
     async def add_image(name: str = Form(...), timestamp: float = Form(...),
                         file: UploadFile = File(...)) -> dict[str, int]:
-        image_id = db.add_image_everywhere(name, timestamp, file)
+        image_id = await run(db.add_image_everywhere, name, timestamp, file)
         return {'image_id': image_id}
 
+    @app.post('/images/batch',
+              summary='Upload images in a batch',
+              description='Upload many images at once, as multipart "files" '
+                          'fields. Tar and zip archives are expanded into the '
+                          'images they contain. Optional "timestamps" fields '
+                          'give the creation or modification timestamp of '
+                          'each file, in order, archives keep those of their '
+                          'entries. The images are written as files, then '
+                          'embedded and added together. Returns the status '
+                          'of each image: added with its id, exists when a '
+                          'file has the same name, unsupported or failed.')
+    async def add_images(request: Request) -> list[dict]:
+        # parsed here rather than by FastAPI, which caps uploads at 1000 files
+        async with request.form(max_files=upload_max_files,
+                                max_fields=upload_max_files) as form:
+            uploads = [upload for upload in form.getlist('files')
+                       if not isinstance(upload, str)]
+            return await run(db.add_images_everywhere, uploads,
+                             form.getlist('timestamps'))
+
     @app.post('/images/filter',
               summary='Filter all images with tags',
               description='Get images id+name for all the images that are '
-                          'associated with all the given tags.')
-    async def filter_all_images(tag_ids: list[int]) -> list[dict]:
-        return [db.safe_image(image) for image in db.filter_all_images(tag_ids)]
+                          'associated with all the given tags, newest first.'
+                          + pagination_doc)
+    async def filter_all_images(tag_ids: list[int], response: Response,
+                                limit: int | None = Query(None, ge=1),
+                                cursor: str | None = None,
+                                stream: bool = False) -> list[dict]:
+        return await paginate(
+            lambda limit, cursor: run(db.filter_images_page, tag_ids, limit,
+                                      cursor),
+            db.safe_image, response, limit, cursor, stream)
 
     @app.post('/images/around',
               summary='Get images around chronologically',
               description='Get a list of 2n-1 images chronologically closest '
-                          'to the target image, n-1 before and after.')
-    async def filter_around(image_id: int, tag_ids: list[int],
-                            n: int) -> list[dict]:
-        return [db.safe_image(image)
-                for image in db.filter_around(image_id, tag_ids, n)]
+                          'to the target image, n-1 before and after. Without '
+                          'an image, the images around the timestamp are '
+                          'returned instead, n at or before it and n-1 after. '
+                          'Only images with all the tags are counted.')
+    async def filter_around(tag_ids: list[int], n: int,
+                            image_id: int | None = None,
+                            timestamp: float | None = None) -> list[dict]:
+        images = await run(db.filter_around, image_id, tag_ids, n, timestamp)
+        return [db.safe_image(image) for image in images]
 
     @app.get('/images/date',
              summary='Get closest image to timestamp',
              description='Get the image whose date is the closest to the given '
-                     'timestamp.')
-    async def closest_to_date(timestamp: int) -> dict:
-        return db.safe_image(db.closest_to_date(timestamp))
+                     'timestamp, among the images with all the given tags.')
+    async def closest_to_date(timestamp: float,
+                              tag_ids: list[int] = Query([])) -> dict:
+        return db.safe_image(await run(db.closest_to_date, timestamp, tag_ids))
+
+    @app.post('/images/timeline',
+              summary='Count images over time',
+              description='Get the number of images with all the tags taken '
+                          'each day, month or year, in the local time of the '
+                          'server, between start and end when given. Periods '
+                          'without images are left out.')
+    async def date_histogram(tag_ids: list[int], unit: str = 'month',
+                             start: float | None = None,
+                             end: float | None = None) -> list[dict]:
+        return await run(db.date_histogram, unit, tag_ids, start, end)
 
     @app.get('/images/prompt',
              summary='Prompt matching images with AI',
              description='Match images inside the database whose embeddings '
-                         'match that of the supplied prompt.')
-    async def prompt_n_best(prompt: str, n: int) -> list[dict]:
+                         'match that of the supplied prompt. With distinct, '
+                         'only the representative of each group of duplicates '
+                         'can be returned.')
+    async def prompt_n_best(prompt: str, n: int,
+                            distinct: bool = False) -> list[dict]:
+        results = await run(db.prompt_n_best, prompt, n, distinct)
+        return [{'score': score, **db.safe_image(image)}
+                for score, image in results]
+
+    @app.post('/images/search',
+              summary='Prompt images matching tags with AI',
+              description='Rank the images that are associated with all the '
+                          'given tags, and taken between start and end when '
+                          'given, by how well they match the prompt. Selective '
+                          'filters are applied first, broad ones are applied '
+                          'to the prompt results; the X-Search-Plan response '
+                          'header tells which one was used.')
+    async def search_images(prompt: str, n: int, tag_ids: list[int],
+                            response: Response, start: float | None = None,
+                            end: float | None = None) -> list[dict]:
+        results, plan = await run(db.search_images, prompt, n, tag_ids, start,
+                                  end)
+        response.headers['X-Search-Plan'] = plan
+        return [{'score': score, **db.safe_image(image)}
+                for score, image in results]
+
+    @app.post('/images/similar',
+              summary='Search with an image',
+              description='Get the n images whose embeddings are the closest '
+                          'to that of the uploaded image. The image is only '
+                          'embedded, not added to the database. nprobe works '
+                          'as for similar images.')
+    async def search_by_image(n: int, file: UploadFile = File(...),
+                              nprobe: int | None = None) -> list[dict]:
+        results = await run(db.search_by_image, file, n, nprobe)
         return [{'score': score, **db.safe_image(image)}
-                for score, image in db.prompt_n_best(prompt, n)]
+                for score, image in results]
+
+    @app.post('/duplicates/detect',
+              summary='Detect duplicates',
+              description='Start grouping near-duplicate images and bursts of '
+                          'similar shots in the background. The status is '
+                          'running if a detection was already under way.')
+    async def start_duplicate_detection() -> dict[str, str]:
+        nonlocal detection
+        if detection is not None and not detection.done():
+            return {'status': 'running'}
+
+        detection = asyncio.create_task(detect_duplicates())
+        return {'status': 'started'}
+
+    @app.get('/duplicates/groups',
+             summary='List duplicates',
+             description='Get the groups of duplicates found by the last '
+                         'detection. The representative is the image kept by '
+                         'distinct prompts, the largest file of the group.')
+    async def duplicate_groups() -> list[dict]:
+        return await run(db.duplicate_groups)
 
     @app.delete('/tag/{tag_id}/delete',
                 summary='Delete tag',
                 description='Delete tag from the database by id. '
                             'Any assignation of it will be discarded.')
     async def delete_tag(tag_id: int) -> None:
-        db.delete_tag_everywhere(tag_id)
+        await run(db.delete_tag_everywhere, tag_id)
 
     @app.get('/tags/list',
              summary='List tags',
-             description='Get a list of id+name for all the tags.')
-    async def all_tags() -> list[dict]:
-        return [db.safe_tag(tag) for tag in db.all_tags()]
+             description='Get a list of id+name for all the tags.'
+                         + pagination_doc)
+    async def all_tags(response: Response,
+                       limit: int | None = Query(None, ge=1),
+                       cursor: str | None = None,
+                       stream: bool = False) -> list[dict]:
+        return await paginate(
+            lambda limit, cursor: run(db.tags_page, limit, cursor),
+            db.safe_tag, response, limit, cursor, stream)
 
     @app.post('/tags/new',
               summary='Create new tag',
-              description='Create a new tag with the specified name.')
+              description='Create a new tag with the specified name. The '
+                          'images are matched against it by the returned '
+                          'job.')
     async def add_tag(tag_name: str) -> dict[str, int]:
-        tag_id = db.new_tag(tag_name, False)
-        return {'tag_id': tag_id}
+        tag_id = await run(db.new_tag, tag_name, False)
+        job_id = await run(db.jobs.submit, 'tag', {'tag_id': tag_id})
+        return {'tag_id': tag_id, 'job_id': job_id}
 
     @app.post('/assign/{image_id}/{tag_id}',
               summary='Assign tag to image',
               description='Assign a tag to an image. Both must be present.')
     async def assign(image_id: int, tag_id: int) -> None:
-        db.assign_tag(image_id, tag_id)
+        await run(db.assign_tag, image_id, tag_id)
 
     @app.post('/unassign/{image_id}/{tag_id}',
               summary='Unassign tag',
               description='Unassign a tag to an image.')
     async def unassign(image_id: int, tag_id: int) -> None:
-        db.unassign_tag(image_id, tag_id)
+        await run(db.unassign_tag, image_id, tag_id)
 
     @app.delete('/reset',
                 summary='Reset database',
                 description='Reset the entire database and parse images from '
-                            'disk again with the set of default tags.')
+                            'disk again with the set of default tags, in the '
+                            'returned job.')
     async def reset() -> dict[str, int]:
-        db.reset_db()
-        return db.sync()
+        return {'job_id': await run(db.jobs.submit, 'reset')}
 
     @app.get('/sync',
              summary='Sync database',
-             description='Sync the database for added image files.')
+             description='Sync the database for added image files, in the '
+                         'returned job.')
     async def sync() -> dict[str, int]:
-        return db.sync()
+        return {'job_id': await run(db.jobs.submit, 'sync')}
+
+    @app.get('/ready',
+             summary='Readiness',
+             description='Tell whether the server is serving requests, '
+                         'whether the model is loaded, which happens on the '
+                         'first request that needs it, and whether the sync '
+                         'started along with the server is complete.')
+    async def ready() -> dict:
+        sync = await run(db.job_status, startup_sync)
+        return {'serving': True, 'model_loaded': model.loaded,
+                'sync_complete': sync['status'] == 'done',
+                'sync_job': startup_sync}
+
+    @app.get('/inference/metrics',
+             summary='Inference metrics',
+             description='Get the batching statistics of the inference '
+                         'process: batch sizes and fill rate, time spent '
+                         'queued and encoding. Empty without an inference '
+                         'process or before the model is loaded.')
+    async def inference_metrics() -> dict:
+        return model.inference_metrics() or {}
+
+    @app.get('/metrics',
+             summary='Server metrics',
+             description='Get latency histograms of the routes, SQL '
+                         'statements, embeddings, file operations and search '
+                         'stages, along with counters and the inference '
+                         'statistics, in the Prometheus text format.',
+             response_class=PlainTextResponse)
+    async def server_metrics() -> PlainTextResponse:
+        # read without db.lock, held for seconds while the embeddings load
+        # or the index trains. A count can be a batch behind.
+        gauges = {'mediadb_images': len(db.embeddings),
+                  'mediadb_tags': len(db.tag_embeddings)}
+        gauges['mediadb_model_loaded'] = int(model.loaded)
+        for name, value in (model.inference_metrics() or {}).items():
+            gauges[f'mediadb_inference_{name}'] = value
+        return PlainTextResponse(metrics.render(gauges),
+                                 media_type='text/plain; version=0.0.4')
+
+    @app.get('/jobs/list',
+             summary='List jobs',
+             description='Get the latest jobs, most recent first.')
+    async def list_jobs() -> list[dict]:
+        return await run(db.list_jobs)
+
+    @app.get('/jobs/{job_id}',
+             summary='Job status',
+             description='Get the status of a job: queued, running, done, '
+                         'failed or cancelled, along with its progress, '
+                         'eta in seconds and result once done.')
+    async def job_status(job_id: int) -> dict:
+        return await run(db.job_status, job_id)
+
+    @app.post('/jobs/{job_id}/cancel',
+              summary='Cancel job',
+              description='Cancel a queued or running job. A running job '
+                          'stops at its next checkpoint, keeping the work '
+                          'done so far.')
+    async def cancel_job(job_id: int) -> dict:
+        return await run(db.cancel_job, job_id)
 
     return app
@@ -0,0 +1,210 @@
+import numpy as np
+from PIL import Image
+
+def perceptual_hash(image: Image.Image) -> int:
+    # difference hash: one bit per horizontally adjacent pixel pair of a 9x8
+    # grayscale thumbnail, robust to resizing and recompression. Returned as
+    # a signed 64-bit integer to fit in an SQLite INTEGER.
+    small = image.convert('L').resize((9, 8), Image.Resampling.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    value = int(np.packbits(bits).view('>u8')[0])
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+# set bits of each byte value
+byte_popcounts = np.array([bin(i).count('1') for i in range(256)],
+                          dtype=np.uint8)
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    # same shape as values, a byte per bit count
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    counts = byte_popcounts[values.view(np.uint8)]
+    return counts.reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+class DisjointSets:
+    def __init__(self, size: int):
+        self.parents = list(range(size))
+
+    def find(self, i: int) -> int:
+        root = i
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[i] != root:
+            self.parents[i], i = root, self.parents[i]
+        return root
+
+    def union(self, i: int, j: int) -> None:
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            self.parents[max(i, j)] = min(i, j)
+
+class DuplicateFinder:
+    # Groups near-duplicate images without comparing every pair: candidate
+    # pairs only come from blocks that similar images are likely to share,
+    # then get checked exactly.
+    # - embeddings: random hyperplane LSH, a block per hash in each table
+    # - perceptual hashes: a block per 16-bit band, any two hashes at most 3
+    #   bits apart share a band
+    # - bursts: images taken a few seconds apart, in timestamp order
+
+    duplicate_score = .95
+    lsh_tables = 8
+    # images per LSH block on average, sets the number of hash bits
+    lsh_block_size = 8
+    # blocks larger than this are split on further random hyperplanes
+    max_block_size = 1024
+
+    phash_bands = 4
+    phash_distance = 3
+
+    burst_seconds = 10
+    burst_score = .85
+    burst_neighbours = 8
+
+    def __init__(self, vectors: np.ndarray, timestamps: np.ndarray,
+                 phashes: list[int | None] | None = None):
+        # vectors are normalized, phashes may hold None for unknown hashes
+        self.vectors = vectors
+        self.timestamps = timestamps
+        self.phashes = phashes
+        self.sets = DisjointSets(len(vectors))
+
+    def _link(self, rows: np.ndarray, pairs: np.ndarray) -> None:
+        # pairs are (n, 2) indices into rows
+        for i, j in rows[pairs].tolist():
+            self.sets.union(i, j)
+
+    def _check_block(self, rows: np.ndarray, score: float) -> None:
+        block = self.vectors[rows]
+        scores = block @ block.T
+        i, j = np.nonzero(np.triu(scores >= score, 1))
+        if len(i):
+            self._link(rows, np.stack([i, j], axis=1))
+
+    def _blocks(self, keys: np.ndarray):
+        # groups of rows sharing the same key, two rows or more
+        order = np.argsort(keys, kind='stable')
+        _, starts, counts = np.unique(keys[order], return_index=True,
+                                      return_counts=True)
+        for start, count in zip(starts.tolist(), counts.tolist()):
+            if count > 1:
+                yield order[start:start + count]
+
+    def _embedding_pairs(self, rng: np.random.Generator) -> None:
+        size, dim = self.vectors.shape
+        bits = max(1, min(62, int(np.log2(max(size, 2)
+                                          / DuplicateFinder.lsh_block_size))))
+        weights = 1 << np.arange(bits, dtype=np.int64)
+
+        for _ in range(DuplicateFinder.lsh_tables):
+            planes = rng.standard_normal((dim, bits)).astype(np.float32)
+            keys = ((self.vectors @ planes) > 0) @ weights
+            for rows in self._blocks(keys):
+                self._check_large_block(rows, rng)
+
+    def _check_large_block(self, rows: np.ndarray,
+                           rng: np.random.Generator) -> None:
+        if len(rows) <= DuplicateFinder.max_block_size:
+            self._check_block(rows, DuplicateFinder.duplicate_score)
+            return
+
+        # clustered libraries pile up in a few blocks, cut them further
+        plane = rng.standard_normal(self.vectors.shape[1]).astype(np.float32)
+        sides = self.vectors[rows] @ plane > 0
+        if sides.all() or not sides.any():
+            self._check_block(rows, DuplicateFinder.duplicate_score)
+            return
+        self._check_large_block(rows[sides], rng)
+        self._check_large_block(rows[~sides], rng)
+
+    def _phash_pairs(self) -> None:
+        if self.phashes is None:
+            return
+
+        known = np.array([h is not None for h in self.phashes], dtype=bool)
+        rows = np.nonzero(known)[0]
+        hashes = np.array([self.phashes[i] for i in rows.tolist()],
+                          dtype=np.int64).view(np.uint64)
+
+        band_bits = 64 // DuplicateFinder.phash_bands
+        for band in range(DuplicateFinder.phash_bands):
+            mask = ((1 << band_bits) - 1) << band * band_bits
+            keys = hashes & np.uint64(mask)
+            for block in self._blocks(keys):
+                self._check_hashes(rows[block], hashes[block],
+                                   ~mask & (1 << 64) - 1)
+
+    def _bit_groups(self, free: int) -> list[int]:
+        # masks splitting the free bits in as many groups as the distance
+        # allows, two hashes close enough agree on all the bits of one group
+        bits = [bit for bit in range(64) if free >> bit & 1]
+        count = DuplicateFinder.phash_distance + 1
+        if len(bits) < count:
+            return []
+        return [sum(1 << bit for bit in group.tolist())
+                for group in np.array_split(np.array(bits), count)]
+
+    def _check_hashes(self, rows: np.ndarray, hashes: np.ndarray,
+                      free: int) -> None:
+        # rows of a block agree on the bits outside of the free mask.
+        # Copies of an image share the same hash, link them once and only
+        # compare the distinct hashes.
+        hashes, first, inverse = np.unique(hashes, return_index=True,
+                                           return_inverse=True)
+        if len(hashes) < len(rows):
+            self._link(rows, np.stack([first[inverse],
+                                       np.arange(len(rows))], axis=1))
+        rows = rows[first]
+
+        # large blocks are split again on the free bits rather than compared
+        # pair by pair
+        groups = self._bit_groups(free) \
+            if len(hashes) > DuplicateFinder.max_block_size else []
+        for mask in groups:
+            keys = hashes & np.uint64(mask)
+            for block in self._blocks(keys):
+                self._check_hashes(rows[block], hashes[block], free & ~mask)
+        if not groups:
+            self._compare_hashes(rows, hashes)
+
+    def _compare_hashes(self, rows: np.ndarray, hashes: np.ndarray) -> None:
+        # in tiles of bounded size, the upper triangle only
+        size = DuplicateFinder.max_block_size
+        for start in range(0, len(hashes), size):
+            chunk = hashes[start:start + size]
+            for other in range(start, len(hashes), size):
+                distances = popcount(chunk[:, None]
+                                     ^ hashes[None, other:other + size])
+                i, j = np.nonzero(distances <= DuplicateFinder.phash_distance)
+                i += start
+                j += other
+                later = i < j
+                if later.any():
+                    self._link(rows, np.stack([i[later], j[later]], axis=1))
+
+    def _burst_pairs(self) -> None:
+        order = np.argsort(self.timestamps, kind='stable')
+        timestamps = self.timestamps[order]
+        vectors = self.vectors[order]
+
+        for offset in range(1, DuplicateFinder.burst_neighbours + 1):
+            if offset >= len(order):
+                break
+            close = timestamps[offset:] - timestamps[:-offset] \
+                <= DuplicateFinder.burst_seconds
+            scores = np.einsum('ij,ij->i', vectors[offset:], vectors[:-offset])
+            i = np.nonzero(close & (scores >= DuplicateFinder.burst_score))[0]
+            if len(i):
+                self._link(order, np.stack([i, i + offset], axis=1))
+
+    def groups(self) -> list[list[int]]:
+        # row indices of each group of two images or more
+        self._embedding_pairs(np.random.default_rng(0))
+        self._phash_pairs()
+        self._burst_pairs()
+
+        groups: dict[int, list[int]] = {}
+        for i in range(len(self.vectors)):
+            groups.setdefault(self.sets.find(i), []).append(i)
+
+        return [group for group in groups.values() if len(group) > 1]
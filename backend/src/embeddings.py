@@ -0,0 +1,174 @@
+import numpy as np
+
+from .quantization import Float32Codec
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+def top_n(scores: np.ndarray, n: int) -> np.ndarray:
+    n = min(n, len(scores))
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    if n < len(scores):
+        indices = np.argpartition(-scores, n - 1)[:n]
+    else:
+        indices = np.arange(len(scores))
+
+    return indices[np.argsort(-scores[indices], kind='stable')]
+
+class EmbeddingStore:
+    # in-memory copy of the image embeddings, stored as one contiguous matrix
+    # of normalized vectors so that cosine similarity is a single dot product.
+    # The rows are kept encoded by the codec, float32 unless memory matters
+    # more than exact scores.
+
+    # rows decoded at once when scoring with a lossy codec
+    chunk_size = 16384
+
+    def __init__(self, dim: int = 512, min_capacity: int = 1024,
+                 codec: Float32Codec | None = None):
+        self.dim = dim
+        self.min_capacity = min_capacity
+        self.codec = codec or Float32Codec(dim)
+        self.size = 0
+        self.rows: dict[int, int] = {} # id -> row in the matrix
+        self._ids = np.empty(0, dtype=np.int64)
+        self._codes = np.empty((0, self.codec.code_size), dtype=np.uint8)
+        # incremented on every change, for caches of search results
+        self.version = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __contains__(self, id: int) -> bool:
+        return id in self.rows
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._ids[:self.size]
+
+    @property
+    def codes(self) -> np.ndarray:
+        return self._codes[:self.size]
+
+    @property
+    def matrix(self) -> np.ndarray:
+        # decoded copy of all the rows, a view for float32
+        return self.codec.decode(self.codes)
+
+    @property
+    def nbytes(self) -> int:
+        return self._ids.nbytes + self._codes.nbytes
+
+    def set_codec(self, codec: Float32Codec) -> None:
+        self.codec = codec
+        self.clear()
+
+    def _reserve(self, capacity: int) -> None:
+        if capacity <= len(self._ids):
+            return
+
+        capacity = max(capacity, 2 * len(self._ids), self.min_capacity)
+        ids = np.empty(capacity, dtype=np.int64)
+        codes = np.empty((capacity, self.codec.code_size), dtype=np.uint8)
+        ids[:self.size] = self.ids
+        codes[:self.size] = self.codes
+        self._ids = ids
+        self._codes = codes
+
+    def clear(self) -> None:
+        self.version += 1
+        self.size = 0
+        self.rows = {}
+        self._ids = np.empty(0, dtype=np.int64)
+        self._codes = np.empty((0, self.codec.code_size), dtype=np.uint8)
+
+    def load(self, ids: list[int], embeddings: np.ndarray) -> None:
+        self.clear()
+        self.add_many(ids, embeddings)
+
+    def add(self, id: int, embedding: np.ndarray) -> None:
+        self.add_many([id], embedding)
+
+    def add_many(self, ids: list[int], embeddings: np.ndarray) -> None:
+        embeddings = normalize(np.reshape(embeddings, (-1, self.dim)))
+        self.add_codes(ids, self.codec.encode(embeddings))
+
+    def add_codes(self, ids: list[int], codes: np.ndarray) -> None:
+        # codes of normalized vectors, from the same codec
+        self.version += 1
+
+        self._reserve(self.size + len(ids))
+        for id, code in zip(ids, codes):
+            id = int(id)
+            row = self.rows.get(id)
+            if row is None:
+                row = self.size
+                self.size += 1
+                self.rows[id] = row
+
+            self._ids[row] = id
+            self._codes[row] = code
+
+    def remove(self, id: int) -> None:
+        row = self.rows.pop(id, None)
+        if row is None:
+            return
+        self.version += 1
+
+        # move the last row into the hole to keep the matrix contiguous
+        last = self.size - 1
+        if row != last:
+            moved = int(self._ids[last])
+            self._ids[row] = moved
+            self._codes[row] = self._codes[last]
+            self.rows[moved] = row
+
+        self.size = last
+
+    def rows_of(self, ids: list[int]) -> np.ndarray:
+        return np.fromiter((self.rows[int(id)] for id in ids),
+                           dtype=np.int64, count=len(ids))
+
+    def vectors(self, rows: np.ndarray) -> np.ndarray:
+        return self.codec.decode(self._codes[rows])
+
+    def get(self, id: int) -> np.ndarray | None:
+        row = self.rows.get(id)
+        if row is None:
+            return None
+
+        return self.codec.decode(self._codes[row:row + 1])[0]
+
+    def scores(self, query: np.ndarray,
+               rows: np.ndarray | None = None) -> np.ndarray:
+        query = normalize(query)
+        codes = self.codes if rows is None else self._codes[rows]
+        if not self.codec.lossy:
+            return self.codec.scores(codes, query)
+
+        # bounds the memory used by decoded rows
+        chunk_size = EmbeddingStore.chunk_size
+        return np.concatenate(
+            [self.codec.scores(codes[i:i + chunk_size], query)
+             for i in range(0, len(codes), chunk_size)]
+            + [np.empty(0, dtype=np.float32)])
+
+    def search(self, query: np.ndarray,
+               n: int) -> tuple[np.ndarray, np.ndarray]:
+        scores = self.scores(query)
+        best = top_n(scores, n)
+        return scores[best], self.ids[best]
+
+    def search_among(self, query: np.ndarray, ids: list[int],
+                     n: int) -> tuple[np.ndarray, np.ndarray]:
+        # search restricted to the given ids, unknown ones are skipped
+        rows = np.fromiter((self.rows[id] for id in ids if id in self.rows),
+                           dtype=np.int64)
+        scores = self.scores(query, rows)
+        best = top_n(scores, n)
+        return scores[best], self._ids[rows[best]]
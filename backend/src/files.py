@@ -1,10 +1,16 @@
 import os
+import hashlib
 
 class FilePath:
-    def __init__(self, path: str):
+    def __init__(self, path: str, size: int | None = None,
+                 mtime: float | None = None):
         self.dirs = []
         self.name = os.path.basename(path)
         self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.hash = None
+        self.phash = None
 
         for dir in path.split(os.sep)[:-1]:
             if len(dir) > 0:
@@ -13,15 +19,38 @@ class FilePath:
     def __repr__(self):
         return f'FilePath({self.dirs} / {self.name})'
 
+    def update_stat(self) -> None:
+        stat = os.stat(self.path)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+
+def content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def hash_file(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+
+    return h.hexdigest()
+
 def list_files(path) -> list[FilePath]:
     l = [] # using a list to avoid cache issues on database sync for clients
 
-    for f in os.listdir(path):
-        full = os.path.join(path, f)
+    # scandir gives the file type and stat without extra system calls on most
+    # platforms, which matters when comparing against the database on sync
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir():
+                l += list_files(entry.path)
+                continue
 
-        if os.path.isdir(full):
-            l += list_files(full)
-        else:
-            l.append(FilePath(full))
+            try:
+                stat = entry.stat()
+            except OSError:
+                l.append(FilePath(entry.path))
+                continue
+            l.append(FilePath(entry.path, stat.st_size, stat.st_mtime))
 
     return l
@@ -0,0 +1,197 @@
+import time
+import itertools
+import threading
+import multiprocessing as mp
+from queue import Empty
+from concurrent.futures import Future
+import numpy as np
+
+# Inference in a separate process. Requests from all the threads of the API
+# process go through a queue, and the worker encodes the ones arriving within
+# a short window in a single batch. Requests are (id, kind, inputs,
+# submitted), kind being 'text' or 'image'.
+
+def load_model(name: str):
+    # torch and sentence_transformers alone take seconds to import
+    import torch
+    from sentence_transformers import SentenceTransformer
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    return SentenceTransformer(name, device=device)
+
+def _encode_batch(model, batch: list[tuple], results: mp.Queue) -> None:
+    started = time.time()
+    for kind in ['text', 'image']:
+        requests = [request for request in batch if request[1] == kind]
+        if not requests:
+            continue
+
+        inputs = [x for request in requests for x in request[2]]
+        try:
+            embeddings = np.asarray(model.encode(inputs,
+                                                 batch_size=len(inputs)),
+                                    dtype=np.float32)
+        except Exception as e:
+            for request in requests:
+                results.put(('error', request[0], str(e)))
+            continue
+
+        start = 0
+        for request in requests:
+            end = start + len(request[2])
+            results.put(('result', request[0], embeddings[start:end]))
+            start = end
+
+    results.put(('batch', sum(len(request[2]) for request in batch),
+                 [started - request[3] for request in batch],
+                 time.time() - started))
+
+def serve(model_name: str, requests: mp.Queue, results: mp.Queue,
+          max_batch_size: int, max_wait: float) -> None:
+    try:
+        model = load_model(model_name)
+    except Exception as e:
+        results.put(('failed', str(e)))
+        return
+    results.put(('ready',))
+
+    closed = False
+    while not closed:
+        request = requests.get()
+        if request is None:
+            break
+
+        # wait a little for more requests, unless the batch is already full
+        batch = [request]
+        size = len(request[2])
+        deadline = time.monotonic() + max_wait
+        while size < max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = requests.get(timeout=timeout)
+            except Empty:
+                break
+            if request is None:
+                closed = True
+                break
+            batch.append(request)
+            size += len(request[2])
+
+        _encode_batch(model, batch, results)
+
+    results.put(('closed',))
+
+class InferenceMetrics:
+    def __init__(self, max_batch_size: int):
+        self.max_batch_size = max_batch_size
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.items = 0
+        self.queue_seconds = 0
+        self.max_queue_seconds = 0
+        self.encode_seconds = 0
+
+    def add(self, items: int, waits: list[float], encode: float) -> None:
+        with self.lock:
+            self.batches += 1
+            self.requests += len(waits)
+            self.items += items
+            self.queue_seconds += sum(waits)
+            self.max_queue_seconds = max(self.max_queue_seconds, *waits)
+            self.encode_seconds += encode
+
+    def stats(self) -> dict:
+        with self.lock:
+            batches = max(self.batches, 1)
+            return {
+                'batches': self.batches,
+                'requests': self.requests,
+                'items': self.items,
+                'mean_batch_size': self.items / batches,
+                # share of the maximum batch size actually used
+                'batch_fill_rate': self.items
+                                   / (batches * self.max_batch_size),
+                'mean_queue_ms': self.queue_seconds
+                                 / max(self.requests, 1) * 1000,
+                'max_queue_ms': self.max_queue_seconds * 1000,
+                'mean_encode_ms': self.encode_seconds / batches * 1000,
+            }
+
+class InferenceProcess:
+    # client side, used from any number of threads
+
+    def __init__(self, model_name: str, max_batch_size: int, max_wait: float):
+        # spawned rather than forked, the API process has threads running
+        context = mp.get_context('spawn')
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(
+            target=serve, name='inference', daemon=True,
+            args=(model_name, self.requests, self.results, max_batch_size,
+                  max_wait))
+        self.process.start()
+
+        self.metrics = InferenceMetrics(max_batch_size)
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.pending: dict[int, Future] = {}
+
+        message = self._receive()
+        if message is None or message[0] != 'ready':
+            self.process.join()
+            error = 'process exited' if message is None else message[1]
+            raise RuntimeError(f'Failed to start inference worker: {error}')
+
+        self.reader = threading.Thread(target=self._read,
+                                       name='inference-results', daemon=True)
+        self.reader.start()
+
+    def _receive(self) -> tuple | None:
+        # None once the worker is gone
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except Empty:
+                if not self.process.is_alive():
+                    return None
+
+    def _read(self) -> None:
+        while True:
+            message = self._receive()
+            if message is None or message[0] == 'closed':
+                break
+
+            if message[0] == 'batch':
+                self.metrics.add(*message[1:])
+                continue
+
+            with self.lock:
+                future = self.pending.pop(message[1])
+            if message[0] == 'result':
+                future.set_result(message[2])
+            else:
+                future.set_exception(RuntimeError(message[2]))
+
+        # whatever is still waiting will never get an answer
+        with self.lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for future in pending:
+            future.set_exception(RuntimeError('Inference worker stopped.'))
+
+    def encode(self, kind: str, inputs: list) -> np.ndarray:
+        future = Future()
+        with self.lock:
+            if not self.reader.is_alive():
+                raise RuntimeError('Inference worker stopped.')
+            id = next(self.ids)
+            self.pending[id] = future
+        self.requests.put((id, kind, inputs, time.time()))
+        return future.result()
+
+    def close(self) -> None:
+        self.requests.put(None)
+        self.reader.join()
+        self.process.join()
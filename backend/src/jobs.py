@@ -0,0 +1,144 @@
+import json
+import time
+import threading
+from sys import stderr
+from typing import Any, Callable
+from fastapi import HTTPException
+
+from .sql_wrapper import DataBase
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    # handle given to the function running a job, to report its progress
+
+    def __init__(self, queue: 'JobQueue', row: dict):
+        self.queue = queue
+        self.id = row['id']
+        self.kind = row['kind']
+        self.params = json.loads(row['params'])
+        self.checkpoint = None
+        if row['checkpoint'] is not None:
+            self.checkpoint = json.loads(row['checkpoint'])
+
+    def update(self, done: int, total: int, checkpoint: Any = None) -> None:
+        # called between chunks of work, which must be safe to run twice: a
+        # resumed job starts over from the last checkpoint saved. Stops the
+        # job there if it was cancelled or the server is stopping.
+        if checkpoint is not None:
+            self.checkpoint = checkpoint
+        self.queue.db._update_job(self.id, done=done, total=total,
+                                  checkpoint=json.dumps(self.checkpoint))
+
+        if self.queue.stopping.is_set() \
+                or self.queue.db._is_job_cancelled(self.id):
+            raise JobCancelled()
+
+class JobQueue:
+    # Runs long operations one at a time in a background thread, from the
+    # jobs table. Jobs still running when the server stopped are queued again
+    # on start, and resume from their last checkpoint.
+
+    def __init__(self, db: DataBase):
+        self.db = db
+        # kind -> function(job, **params) returning the JSON result
+        self.handlers: dict[str, Callable] = {}
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def register(self, kind: str, handler: Callable) -> None:
+        self.handlers[kind] = handler
+
+    def start(self) -> None:
+        resumed = self.db._requeue_jobs()
+        if resumed:
+            self.db._log(f'Resuming {resumed} interrupted job(s).')
+
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._work, name='jobs',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        # the running job is interrupted at its next checkpoint
+        self.stopping.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, kind: str, params: dict | None = None) -> int:
+        id = self.db._add_job(kind, json.dumps(params or {}, sort_keys=True))
+        self.wake.set()
+        return id
+
+    def find(self, kinds: list[str]) -> int | None:
+        # the oldest job of these kinds that is queued or running
+        return self.db._find_job(kinds)
+
+    def cancel(self, id: int) -> bool:
+        return self.db._cancel_job(id)
+
+    def status(self, id: int) -> dict | None:
+        row = self.db._get_job(id)
+        return None if row is None else self._describe(row)
+
+    def list(self, limit: int) -> list[dict]:
+        return [self._describe(row) for row in self.db._get_jobs(limit)]
+
+    def _describe(self, row: dict) -> dict:
+        job = {key: row[key] for key in ['id', 'kind', 'status', 'done',
+                                         'total', 'error', 'created',
+                                         'started', 'finished']}
+        job['params'] = json.loads(row['params'])
+        job['result'] = None
+        if row['result'] is not None:
+            job['result'] = json.loads(row['result'])
+
+        # the eta assumes the rest goes as fast as what was done this run
+        job['elapsed'] = job['eta'] = None
+        if row['started'] is not None:
+            end = row['finished'] if row['finished'] is not None \
+                else time.time()
+            job['elapsed'] = end - row['started']
+            if row['status'] == 'running' and row['done']:
+                job['eta'] = job['elapsed'] \
+                    * (row['total'] - row['done']) / row['done']
+
+        return job
+
+    def _work(self) -> None:
+        while not self.stopping.is_set():
+            # cleared first, so that a job submitted meanwhile is not missed
+            self.wake.clear()
+            row = self.db._next_job()
+            if row is None:
+                self.wake.wait()
+                continue
+
+            self._run(Job(self, row), row['cancelled'])
+
+    def _run(self, job: Job, cancelled: bool) -> None:
+        finish = self.db._finish_job
+        if cancelled:
+            finish(job.id, 'cancelled')
+            return
+
+        self.db._log(f'Running job {job.id} ({job.kind}).')
+        try:
+            result = self.handlers[job.kind](job, **job.params)
+        except JobCancelled:
+            if self.db._is_job_cancelled(job.id):
+                finish(job.id, 'cancelled')
+            else:
+                self.db._update_job(job.id, status='queued')
+        except HTTPException as e:
+            finish(job.id, 'failed', error=e.detail)
+        except Exception as e:
+            print(f'Error: job {job.id} ({job.kind}) failed: {e}',
+                  file=stderr)
+            finish(job.id, 'failed', error=str(e))
+        else:
+            finish(job.id, 'done', result=json.dumps(result))
@@ -0,0 +1,120 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Timings and counters of the hot paths, rendered in the Prometheus text
+# exposition format. Each metric has a fixed set of label names, and one
+# series per combination of label values.
+
+descriptions = {
+    'mediadb_http_request_seconds':
+        ('histogram', 'Latency of the HTTP requests, by route.'),
+    'mediadb_http_requests_total':
+        ('counter', 'HTTP requests, by route and status code.'),
+    'mediadb_sql_seconds':
+        ('histogram', 'Time spent on SQL statements up to their last row, '
+                      'by the database method running them.'),
+    'mediadb_slow_queries_total':
+        ('counter', 'SQL statements slower than the slow query threshold.'),
+    'mediadb_embedding_seconds':
+        ('histogram', 'Time spent embedding a batch of texts or images.'),
+    'mediadb_embedded_total':
+        ('counter', 'Texts and images embedded.'),
+    'mediadb_text_cache_total':
+        ('counter', 'Text embedding lookups, by the cache that answered.'),
+    'mediadb_file_seconds':
+        ('histogram', 'Time spent on file operations.'),
+    'mediadb_search_seconds':
+        ('histogram', 'Time spent on the stages of prompt searches.'),
+}
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+def _labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"'
+                          for name, value in labels) + '}'
+
+class Histogram:
+    # upper bounds in seconds, the last bucket is +Inf
+    buckets = [.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1,
+               2.5, 5, 10]
+
+    def __init__(self):
+        self.counts = [0] * (len(Histogram.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(Histogram.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: tuple) -> list[str]:
+        lines = []
+        total = 0
+        for bound, count in zip(Histogram.buckets + ['+Inf'], self.counts):
+            total += count
+            lines.append(f'{name}_bucket'
+                         f'{_labels(labels + (("le", bound),))} {total}')
+        lines.append(f'{name}_sum{_labels(labels)} {self.sum}')
+        lines.append(f'{name}_count{_labels(labels)} {self.count}')
+        return lines
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> labels -> histogram or counter value
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+        self.counters: dict[str, dict[tuple, float]] = {}
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = tuple(labels.items())
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(labels.items())
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self, gauges: dict[str, float] | None = None) -> str:
+        # gauges are extra values known by the caller, without labels
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.histograms.items()):
+                lines += self._header(name, 'histogram')
+                for labels, histogram in series.items():
+                    lines += histogram.render(name, labels)
+
+            for name, series in sorted(self.counters.items()):
+                lines += self._header(name, 'counter')
+                for labels, value in series.items():
+                    lines.append(f'{name}{_labels(labels)} {value}')
+
+        for name, value in sorted((gauges or {}).items()):
+            lines += self._header(name, 'gauge')
+            lines.append(f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, name: str, type: str) -> list[str]:
+        type, description = descriptions.get(name, (type, ''))
+        return [f'# HELP {name} {description}', f'# TYPE {name} {type}']
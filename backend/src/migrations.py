@@ -0,0 +1,162 @@
+import sqlite3
+
+# Schema migrations, applied in order. The number of migrations applied to a
+# database is stored in its user_version pragma, so only the missing ones run
+# when an existing database is opened. Never edit a released migration, add a
+# new one instead.
+
+def _create_tables(cur: sqlite3.Cursor) -> None:
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS images (
+        id INTEGER PRIMARY KEY,
+        path TEXT,
+        timestamp REAL,
+        embedding BLOB
+    )""")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tags (
+        id INTEGER PRIMARY KEY,
+        is_dirname INTEGER,
+        name TEXT,
+        embedding BLOB
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tags_join (
+        id INTEGER PRIMARY KEY,
+        image_id INTEGER,
+        tag_id INTEGER,
+        FOREIGN KEY(image_id) REFERENCES images(id),
+        FOREIGN KEY(tag_id) REFERENCES tags(id)
+    )
+    """)
+
+def _add_file_stats(cur: sqlite3.Cursor) -> None:
+    # databases created before files were tracked by stat and hash. Some of
+    # them already got the columns before migrations were versioned.
+    cur.execute('PRAGMA table_info(images)')
+    columns = [column[1] for column in cur.fetchall()]
+    for column, type in [('size', 'INTEGER'), ('mtime', 'REAL'),
+                         ('hash', 'TEXT')]:
+        if column not in columns:
+            cur.execute(f'ALTER TABLE images ADD COLUMN {column} {type}')
+
+def _add_indexes(cur: sqlite3.Cursor) -> None:
+    # older versions could assign the same tag twice to an image
+    cur.execute("""
+    DELETE FROM tags_join
+    WHERE tags_join.id NOT IN (
+        SELECT MIN(tags_join.id)
+        FROM tags_join
+        GROUP BY tags_join.image_id, tags_join.tag_id
+    )
+    """)
+
+    cur.execute('CREATE INDEX IF NOT EXISTS images_path ON images(path)')
+    cur.execute('CREATE INDEX IF NOT EXISTS images_timestamp '
+                'ON images(timestamp)')
+    cur.execute('CREATE INDEX IF NOT EXISTS tags_name ON tags(name)')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS tags_join_image_tag '
+                'ON tags_join(image_id, tag_id)')
+    # the unique index covers lookups by image, this one lookups by tag
+    cur.execute('CREATE INDEX IF NOT EXISTS tags_join_tag '
+                'ON tags_join(tag_id)')
+
+def _add_duplicates(cur: sqlite3.Cursor) -> None:
+    # perceptual hash of the image, filled in when it is next embedded
+    cur.execute('ALTER TABLE images ADD COLUMN phash INTEGER')
+    # groups of near-duplicates, images without duplicates have no row
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS duplicates (
+        image_id INTEGER PRIMARY KEY,
+        representative_id INTEGER,
+        FOREIGN KEY(image_id) REFERENCES images(id),
+        FOREIGN KEY(representative_id) REFERENCES images(id)
+    )
+    """)
+    cur.execute('CREATE INDEX IF NOT EXISTS duplicates_representative '
+                'ON duplicates(representative_id)')
+
+def _add_jobs(cur: sqlite3.Cursor) -> None:
+    # background jobs, kept across restarts. The parameters, checkpoint and
+    # result are JSON, the checkpoint being whatever the job needs to resume.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY,
+        kind TEXT,
+        params TEXT,
+        status TEXT,
+        done INTEGER DEFAULT 0,
+        total INTEGER DEFAULT 0,
+        checkpoint TEXT,
+        result TEXT,
+        error TEXT,
+        cancelled INTEGER DEFAULT 0,
+        created REAL,
+        started REAL,
+        finished REAL
+    )
+    """)
+    cur.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status)')
+
+def _unique_image_paths(cur: sqlite3.Cursor) -> None:
+    # uploads were only kept from adding a file along with a sync by a lock
+    # held for the whole sync, the oldest row of each path is kept
+    cur.execute("""
+    CREATE TEMP TABLE duplicate_paths AS
+    SELECT images.id
+    FROM images
+    WHERE images.id NOT IN (
+        SELECT MIN(images.id)
+        FROM images
+        GROUP BY images.path
+    )
+    """)
+    for table, column in [('tags_join', 'image_id'),
+                          ('duplicates', 'image_id'),
+                          ('duplicates', 'representative_id'),
+                          ('images', 'id')]:
+        cur.execute(f"""
+        DELETE FROM {table}
+        WHERE {table}.{column} IN (SELECT id FROM duplicate_paths)
+        """)
+    cur.execute('DROP TABLE duplicate_paths')
+
+    cur.execute('DROP INDEX IF EXISTS images_path')
+    cur.execute('CREATE UNIQUE INDEX images_path ON images(path)')
+
+migrations = [
+    _create_tables,
+    _add_file_stats,
+    _add_indexes,
+    _add_duplicates,
+    _add_jobs,
+    _unique_image_paths,
+]
+
+def schema_version(con: sqlite3.Connection) -> int:
+    return con.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(con: sqlite3.Connection) -> list[str]:
+    # returns the names of the migrations that were applied
+    version = schema_version(con)
+    if version > len(migrations):
+        raise RuntimeError(f'Database schema version {version} is newer than '
+                           f'the latest known version {len(migrations)}.')
+
+    applied = []
+    for version, migration in enumerate(migrations[version:], version + 1):
+        # each migration is applied along with its version bump, or not at all
+        cur = con.cursor()
+        try:
+            cur.execute('BEGIN')
+            migration(cur)
+            cur.execute(f'PRAGMA user_version = {version}')
+            cur.execute('COMMIT')
+        except BaseException:
+            cur.execute('ROLLBACK')
+            raise
+
+        applied.append(migration.__name__.lstrip('_'))
+
+    return applied
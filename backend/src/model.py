@@ -1,20 +1,206 @@
+import time
+import sqlite3
+import threading
+from typing import IO
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import numpy as np
-import torch
-from sentence_transformers import SentenceTransformer, util
+
+from .cache import LRUCache
+from .metrics import Metrics
+from .inference import InferenceProcess, load_model
 
 class Model:
     model_name = 'clip-ViT-B-32'
+    # CLIP crops images to this size, no need to decode them any bigger
+    image_size = 224
+
+    # text embeddings of prompts and tag names are cached in memory, and in an
+    # SQLite file when one is given, trimmed to the most recently used ones
+    text_cache_entries = 4096
+    text_cache_bytes = 16 << 20
+    text_cache_file_entries = 100000
+    text_cache_trim_interval = 1000
+
+    # with an inference process, the texts and images requested within
+    # batch_wait seconds of each other are encoded together, up to
+    # batch_max_size of them
+    batch_max_size = 64
+    batch_wait = .005
+
+    def __init__(self, workers: int = 1, text_cache_file: str | None = None,
+                 inference_process: bool = False):
+        # loaded on first use, serving the library does not need it
+        self.model = None
+        self.worker = None
+        self.inference_process = inference_process
+        # shared with the database, see DataBase.metrics
+        self.metrics = Metrics()
+        self.load_lock = threading.Lock()
+        # bounds concurrent inference, whatever the number of calling threads
+        self.executor = ThreadPoolExecutor(workers,
+                                           thread_name_prefix='inference')
+
+        self.text_cache = LRUCache(Model.text_cache_entries,
+                                   Model.text_cache_bytes)
+        self.cache_con = None
+        if text_cache_file is not None:
+            self._open_text_cache(text_cache_file)
+
+    @property
+    def loaded(self) -> bool:
+        return self.model is not None or self.worker is not None
+
+    def load(self) -> None:
+        with self.load_lock:
+            if self.loaded:
+                return
+
+            if self.inference_process:
+                self.worker = InferenceProcess(Model.model_name,
+                                               Model.batch_max_size,
+                                               Model.batch_wait)
+            else:
+                self.model = load_model(Model.model_name)
+
+    def inference_metrics(self) -> dict | None:
+        if self.worker is None:
+            return None
+        return self.worker.metrics.stats()
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        with self.load_lock:
+            if self.worker is not None:
+                self.worker.close()
+                self.worker = None
+        if self.cache_con is not None:
+            with self.cache_lock:
+                self.cache_con.close()
+                self.cache_con = None
+
+    def _open_text_cache(self, path: str) -> None:
+        self.cache_lock = threading.Lock()
+        self.cache_stores = 0
+        # shared by all threads, only used under cache_lock
+        self.cache_con = sqlite3.connect(path, timeout=30,
+                                         check_same_thread=False)
+        self.cache_con.execute('PRAGMA journal_mode = wal')
+        self.cache_con.execute('PRAGMA synchronous = normal')
+        # the model name is part of the key, another model never reads
+        # embeddings it did not compute
+        self.cache_con.execute("""
+        CREATE TABLE IF NOT EXISTS text_embeddings (
+            model TEXT,
+            text TEXT,
+            embedding BLOB,
+            used REAL,
+            PRIMARY KEY (model, text)
+        )""")
+        self.cache_con.execute("""
+        CREATE INDEX IF NOT EXISTS text_embeddings_used
+        ON text_embeddings(used)""")
+        self.cache_con.commit()
+
+    def _load_text(self, text: str) -> np.ndarray | None:
+        if self.cache_con is None:
+            return None
 
-    def __init__(self):
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model = SentenceTransformer(Model.model_name, device=device)
+        with self.cache_lock:
+            row = self.cache_con.execute("""
+            SELECT text_embeddings.embedding
+            FROM text_embeddings
+            WHERE text_embeddings.model = ?
+            AND text_embeddings.text = ?
+            """, [Model.model_name, text]).fetchone()
+            if row is None:
+                return None
+
+            self.cache_con.execute("""
+            UPDATE text_embeddings
+            SET used = ?
+            WHERE text_embeddings.model = ?
+            AND text_embeddings.text = ?
+            """, [time.time(), Model.model_name, text])
+            self.cache_con.commit()
+
+        return np.frombuffer(row[0], dtype=np.float32).copy()
+
+    def _store_text(self, text: str, embedding: np.ndarray) -> None:
+        if self.cache_con is None:
+            return
+
+        with self.cache_lock:
+            self.cache_con.execute("""
+            INSERT OR REPLACE
+            INTO text_embeddings (model, text, embedding, used)
+            VALUES (?, ?, ?, ?)
+            """, [Model.model_name, text, embedding.tobytes(), time.time()])
+
+            self.cache_stores += 1
+            if self.cache_stores % Model.text_cache_trim_interval == 0:
+                self.cache_con.execute("""
+                DELETE FROM text_embeddings
+                WHERE rowid NOT IN (
+                    SELECT rowid
+                    FROM text_embeddings
+                    ORDER BY used DESC
+                    LIMIT ?
+                )""", [Model.text_cache_file_entries])
+            self.cache_con.commit()
+
+    def _encode(self, kind: str, inputs: list) -> np.ndarray:
+        self.load()
+        self.metrics.increment('mediadb_embedded_total', len(inputs),
+                               kind=kind)
+        with self.metrics.span('mediadb_embedding_seconds', kind=kind):
+            if self.worker is not None:
+                return self.worker.encode(kind, inputs)
+
+            return self.executor.submit(self.model.encode, inputs,
+                                        batch_size=len(inputs)).result()
 
     def embed_text(self, text: str) -> np.ndarray:
-        return self.model.encode(text)
+        embedding = self.text_cache.get(text)
+        if embedding is not None:
+            self.metrics.increment('mediadb_text_cache_total', cache='memory')
+            return embedding
+
+        embedding = self._load_text(text)
+        if embedding is not None:
+            self.metrics.increment('mediadb_text_cache_total', cache='file')
+        else:
+            self.metrics.increment('mediadb_text_cache_total', cache='none')
+            embedding = np.asarray(self._encode('text', [text])[0],
+                                   dtype=np.float32)
+            self._store_text(text, embedding)
+
+        # shared by all the callers from now on
+        embedding.setflags(write=False)
+        self.text_cache.put(text, embedding, embedding.nbytes + len(text))
+        return embedding
+
+    def _shrink(self, image: Image.Image, size: int) -> Image.Image:
+        # shortest side down to size
+        scale = size / min(image.size)
+        if scale < 1:
+            width, height = image.size
+            image = image.resize((round(width * scale), round(height * scale)),
+                                 Image.Resampling.BICUBIC)
+
+        return image
+
+    def load_image(self, fp: str | IO[bytes],
+                   size: int | None = None) -> Image.Image:
+        # decoded bigger when given a size, like the thumbnails written during
+        # sync, and shrunk to image_size when embedded
+        size = max(size or 0, Model.image_size)
+        with Image.open(fp) as image:
+            image.draft('RGB', (size, size)) # cheap downscaling for JPEG files
+            image = image.convert('RGB')
 
-    def embed_image(self, path: str) -> np.ndarray:
-        return self.model.encode(Image.open(path))
+        return self._shrink(image, size)
 
-    def sim_score(self, t1: np.ndarray, t2: np.ndarray) -> np.ndarray:
-        return util.cos_sim(t1, t2)[0]
+    def embed_images(self, images: list[Image.Image]) -> np.ndarray:
+        return self._encode('image', [self._shrink(image, Model.image_size)
+                                      for image in images])
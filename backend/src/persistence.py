@@ -1,17 +1,32 @@
+import io
 import os
 import re
-import time
 import shutil
-import numpy as np
+import tarfile
+import zipfile
+import zlib
+import threading
 from sys import stderr
 from datetime import datetime
+from typing import IO, Callable
+from concurrent.futures import Executor, ThreadPoolExecutor
+import numpy as np
+from PIL import Image
 from fastapi import UploadFile, HTTPException
 
 from .sql_wrapper import DataBase
-from .files import FilePath, list_files
+from .files import FilePath, list_files, content_hash, hash_file
 from .model import Model
+from .thumbnails import ThumbnailCache
+from .cache import LRUCache
+from .embeddings import normalize
+from .duplicates import DuplicateFinder, perceptual_hash
+from .jobs import Job, JobQueue
+from .timeline import units as timeline_units
 
 extensions = ['jpg', 'jpeg', 'jfif', 'png', 'bmp', 'gif']
+# uploads expanded into the images they contain
+archive_extensions = ['zip', 'tar', 'tar.gz', 'tgz', 'tar.bz2', 'tar.xz']
 
 def is_image(path: str) -> bool:
     ext = os.path.splitext(path)[-1].lower().strip()
@@ -20,87 +35,384 @@ def is_image(path: str) -> bool:
 
     return len(ext) > 0 and ext in extensions
 
-def start_progress():
-    global start
-    start = time.time()
-
-def progress_bar(i: int, n: int, verbose: bool):
-    spent = time.time() - start
-    eta = spent * (n / (i + 1) - 1)
-    hr_s, s = divmod(round(spent), 3600)
-    min_s, sec_s = divmod(s, 60)
-    hr_e, e = divmod(round(eta), 3600)
-    min_e, sec_e = divmod(e, 60)
-    end = '\n' if verbose else '\r'
-
-    size = 50
-    if n == 0:
-        min_e = sec_e = 0
-        prop = 1
-    else:
-        prop = i / n
-    count = round(prop * size)
-    print(f'Progress: [{'=' * count}{' ' * (size - count)}] ' \
-            f'{round(prop * 100):>3}%, spent: {hr_s}:{min_s:02}:{sec_s:02}, ' \
-            f'eta: {hr_e}:{min_e:02}:{sec_e:02}', end=end)
+def safe_name(name: str) -> str:
+    return re.sub('[^\\w\\s\\-+=_!,;.\'"]+', '_', name)
+
+def tag_name(name: str) -> str:
+    return safe_name(name).strip()
+
+def is_archive(path: str) -> bool:
+    path = path.lower()
+    return any(path.endswith('.' + ext) for ext in archive_extensions)
+
+def archive_entries(upload: UploadFile):
+    # (name, timestamp, file object) of the files in a tar or zip archive,
+    # read one after the other. Tar archives are read as a stream.
+    if upload.filename.lower().endswith('.zip'):
+        with zipfile.ZipFile(upload.file) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with archive.open(info) as f:
+                    yield (info.filename,
+                           datetime(*info.date_time).timestamp(), f)
+        return
+
+    with tarfile.open(fileobj=upload.file, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            yield member.name, float(member.mtime), \
+                archive.extractfile(member)
 
 class Persistence(DataBase):
+    # thumbnail size generated during sync, as shown in the frontend grid
+    thumbnail_size = 256
+    thumbnail_cache_bytes = 1 << 30
+    # prompt results kept until the images or their embeddings change
+    prompt_cache_entries = 256
+    # hybrid searches score the filtered images directly when the filter
+    # keeps at most this share of the library, else they filter index results
+    filter_first_ratio = .1
+    # extra index results fetched for vector-first searches, to make up for
+    # the estimated share of the library matching the filter being an
+    # upper bound
+    vector_first_oversample = 2
+    # images scored per checkpoint when a new tag is matched against the
+    # library in a job
+    tag_job_chunk_size = 16384
+    # jobs returned by the job list
+    jobs_list_limit = 50
+
     def __init__(self, db_file: str, images_dir: str, model: Model,
-                 verbose: bool = False):
-        super().__init__(db_file, model, verbose)
+                 verbose: bool = False, sync_batch_size: int = 32,
+                 sync_workers: int | None = None,
+                 slow_query_seconds: float | None = None):
+        super().__init__(db_file, model, verbose, slow_query_seconds)
         self.images_dir = images_dir
+        self.sync_batch_size = sync_batch_size
+        self.sync_workers = sync_workers or os.cpu_count() or 1
+        # a single sync or reset at a time, they would add the same files
+        self.sync_lock = threading.Lock()
+
+        thumbnails_dir = os.path.splitext(db_file)[0] + '_thumbs'
+        self.thumbnails = ThumbnailCache(thumbnails_dir,
+                                         Persistence.thumbnail_cache_bytes)
+
+        self.prompt_cache = LRUCache(Persistence.prompt_cache_entries)
+        self.prompt_cache_version = None
+        # a single duplicate detection at a time
+        self.duplicates_lock = threading.Lock()
+
+        # started and stopped along with the server
+        self.jobs = JobQueue(self)
+        self.jobs.register('sync', self.sync_job)
+        self.jobs.register('reset', self.reset_job)
+        self.jobs.register('tag', self.tag_job)
 
     def _error(self, error_code: int, msg: str):
         print(f'Error: {msg}', file=stderr)
         raise HTTPException(error_code, msg)
 
-    def sync(self):
-        self._log('Syncing images.')
+    def reset_db(self) -> None:
+        with self.sync_lock:
+            super().reset_db()
+            self.thumbnails.clear()
+
+    def sync(self, progress: Callable | None = None):
+        with self.sync_lock:
+            self._log('Syncing images.')
+
+            with self.metrics.span('mediadb_file_seconds',
+                                   operation='list_files'):
+                present = list_files(self.images_dir)
+            return self._sync(present, self._get_image_stats(), progress)
+
+    def sync_paths(self, paths: list[str]):
+        # sync only the given files or directory trees, used by the watcher
+        with self.sync_lock:
+            self._log(f'Syncing {len(paths)} changed path(s).')
 
+            present = []
+            for path in paths:
+                if os.path.isdir(path):
+                    present += list_files(path)
+                elif os.path.isfile(path):
+                    file = FilePath(path)
+                    try:
+                        file.update_stat()
+                    except OSError:
+                        continue
+                    present.append(file)
+
+            return self._sync(present, self._get_image_stats(paths))
+
+    def _sync(self, present: list[FilePath], known: dict[str, dict],
+              progress: Callable | None = None):
+        # progress(done, total, counts) is called after each batch
         added = 0
+        updated = 0
+        moved = 0
         deleted = 0
         failed = 0
 
-        present = list_files(self.images_dir)
         total = len(present)
-        start_progress()
-        progress_bar(0, total, self.verbose)
 
-        for i, file in enumerate(present):
+        # whatever is left in known after the scan is gone from its path
+        new_files = []
+        changed = {} # path -> image id
+        unstated = []
+        for file in present:
             if not is_image(file.path):
                 self._log(f'Skipping \'{file.name}\'')
                 continue
 
-            if self._get_image_from_path(file.path) is None:
-                try:
-                    self._new_image(file, None)
-                except HTTPException:
-                    print(f'Skipping \'{file.name}\' due to errors.')
-                    failed += 1
-                    continue
-                added += 1
+            image = known.pop(file.path, None)
+            if image is None:
+                new_files.append(file)
+            elif image['size'] is None:
+                # added before stats were stored, trust the current embedding
+                unstated.append((image['id'], file))
+            elif image['size'] != file.size or image['mtime'] != file.mtime:
+                changed[file.path] = image['id']
 
-            progress_bar(i + 1, total, self.verbose)
+        if unstated:
+            self._update_image_stats(*zip(*unstated))
 
-        progress_bar(total, total, self.verbose)
-        if not self.verbose:
-            print()
+        new_files, moves = self._find_moves(new_files, known)
+        if moves:
+            self._log(f'Detected {len(moves)} moved image(s).')
+            self._move_images_everywhere(moves)
+            for image, _ in moves:
+                del known[image['path']]
+            moved = len(moves)
 
-        present_paths = [file.path for file in present]
-        for file in self._all_images():
-            path = file['path']
-            if path not in present_paths:
-                self._delete_image(path)
+        to_embed = new_files + [file for file in present
+                                if file.path in changed]
+        done = 0
+        with ThreadPoolExecutor(self.sync_workers) as executor:
+            for batch in self._load_batches(to_embed, executor):
+                files = []
+                images = []
+                for file, image in batch:
+                    if image is None:
+                        print(f'Skipping \'{file.name}\' due to errors.')
+                        failed += 1
+                        continue
+
+                    files.append(file)
+                    images.append(image)
+
+                new = [i for i, file in enumerate(files)
+                       if file.path not in changed]
+                if new:
+                    self._new_images([files[i] for i in new],
+                                     [images[i] for i in new],
+                                     [files[i].mtime for i in new])
+                    added += len(new)
+
+                old = [i for i, file in enumerate(files)
+                       if file.path in changed]
+                if old:
+                    self._reembed_images([changed[files[i].path] for i in old],
+                                         [files[i] for i in old],
+                                         [images[i] for i in old])
+                    updated += len(old)
+
+                done += len(batch)
+                self._log(f'Processed {done}/{len(to_embed)} image(s).')
+                if progress is not None:
+                    progress(done, len(to_embed),
+                             {'added': added, 'updated': updated,
+                              'moved': moved, 'deleted': deleted,
+                              'failed': failed})
+
+        # files written since the listing, like uploads, are not gone
+        gone = [image for image in known.values()
+                if not os.path.exists(image['path'])]
+        with self.transaction():
+            for image in gone:
+                self._delete_image(image['id'])
                 deleted += 1
+        for image in gone:
+            self.thumbnails.remove(image['id'])
+
+        self._update_index()
 
         self._log(f'Sync summary: {total} total, {added} additions, '
-                  f'{deleted} deletions.')
+                  f'{updated} updates, {moved} moves, {deleted} deletions.')
+
+        return {'total': total, 'added': added, 'updated': updated,
+                'moved': moved, 'deleted': deleted, 'failed': failed}
+
+    def sync_job(self, job: Job) -> dict[str, int]:
+        # the counts of a resumed sync add up with those of its previous runs,
+        # the files they handled are already up to date
+        state = job.checkpoint or {}
+        previous = state.get('counts', {})
+
+        def progress(done: int, total: int, counts: dict[str, int]) -> None:
+            counts = {key: previous.get(key, 0) + value
+                      for key, value in counts.items()}
+            job.update(done, total, {**state, 'counts': counts})
+
+        result = self.sync(progress)
+        for key, value in previous.items():
+            result[key] += value
+        return result
+
+    def reset_job(self, job: Job) -> dict[str, int]:
+        # once the database is reset, a resumed job only carries on syncing
+        if not (job.checkpoint or {}).get('reset'):
+            self.reset_db()
+            job.update(0, 0, {'reset': True})
+        return self.sync_job(job)
+
+    def tag_job(self, job: Job, tag_id: int) -> dict[str, int]:
+        # match a new tag against the library a chunk of images at a time,
+        # in id order so that a resumed job skips the images already scored
+        if self._get_tag_from_id(tag_id) is None:
+            self._error(404, 'Tag not present.')
+
+        state = job.checkpoint or {'after': -1, 'done': 0, 'assigned': 0}
+        while True:
+            step = self._try_assign_tag(tag_id, state['after'],
+                                        Persistence.tag_job_chunk_size)
+            if step is None:
+                break
+
+            last, scored, assigned = step
+            state = {'after': last, 'done': state['done'] + scored,
+                     'assigned': state['assigned'] + assigned}
+            job.update(state['done'], state['done'] + self._count_after(last),
+                       state)
+
+        return {'tag_id': tag_id, 'assigned': state['assigned']}
+
+    def _count_after(self, id: int) -> int:
+        with self.lock:
+            return int((self.embeddings.ids > id).sum())
+
+    def job_status(self, id: int) -> dict:
+        job = self.jobs.status(id)
+        if job is None:
+            self._error(404, 'Job not found.')
 
-        return {'total': total, 'added': added, 'deleted': deleted,
-                'failed': failed}
+        return job
+
+    def list_jobs(self) -> list[dict]:
+        return self.jobs.list(Persistence.jobs_list_limit)
+
+    def cancel_job(self, id: int) -> dict:
+        if self.jobs.status(id) is None:
+            self._error(404, 'Job not found.')
+        if not self.jobs.cancel(id):
+            self._error(409, 'Job already finished.')
+
+        return self.jobs.status(id)
+
+    def _find_moves(self, new_files: list[FilePath], missing: dict[str, dict]
+                    ) -> tuple[list[FilePath], list[tuple[dict, FilePath]]]:
+        # only hash the new files that have the size of a missing image
+        by_size = {}
+        for image in missing.values():
+            if image['hash'] is not None:
+                by_size.setdefault(image['size'], []).append(image)
+
+        remaining = []
+        moves = []
+        for file in new_files:
+            candidates = by_size.get(file.size)
+            if candidates:
+                try:
+                    file.hash = hash_file(file.path)
+                except OSError:
+                    candidates = []
+
+                match = [image for image in candidates
+                         if image['hash'] == file.hash]
+                if match:
+                    candidates.remove(match[0])
+                    moves.append((match[0], file))
+                    continue
+
+            remaining.append(file)
+
+        return remaining, moves
+
+    def _read_image(self, file: FilePath) -> Image.Image:
+        # read the file once for both the content hash and the decoding
+        with self.metrics.span('mediadb_file_seconds', operation='read'):
+            with open(file.path, 'rb') as f:
+                data = f.read()
+
+        file.hash = content_hash(data)
+        with self.metrics.span('mediadb_file_seconds', operation='decode'):
+            image = self.model.load_image(io.BytesIO(data),
+                                          Persistence.thumbnail_size)
+        file.phash = perceptual_hash(image)
+        return image
+
+    def _load_file(self, file: FilePath) -> Image.Image | None:
+        try:
+            if file.size is None or file.mtime is None:
+                file.update_stat()
+            return self._read_image(file)
+        except (OSError, Image.DecompressionBombError):
+            return None
+
+    def _load_batches(self, files: list[FilePath], executor: Executor):
+        # decode the next batch in the pool while the current one is embedded
+        size = self.sync_batch_size
+        batches = [files[i:i + size] for i in range(0, len(files), size)]
+
+        def submit(batch: list[FilePath]) -> list:
+            return [executor.submit(self._load_file, file) for file in batch]
+
+        futures = submit(batches[0]) if batches else []
+        for i, batch in enumerate(batches):
+            current = futures
+            if i + 1 < len(batches):
+                futures = submit(batches[i + 1])
+
+            yield list(zip(batch, [future.result() for future in current]))
 
     def all_image_ids(self) -> list[int]:
-        return [image['id'] for image in self._all_images()]
+        return [image['id'] for image in self.filter_all_images([])]
+
+    def filter_images_page(self, tag_ids: list[int], limit: int | None = None,
+                           cursor: str | None = None
+                           ) -> tuple[list[dict], str | None]:
+        # keyset pagination: the cursor is the (timestamp, id) of the last
+        # image returned, so pages stay cheap and stable under insertions
+        after = None
+        if cursor is not None:
+            try:
+                timestamp, id = cursor.rsplit('_', 1)
+                after = (float(timestamp), int(id))
+            except ValueError:
+                self._error(400, 'Invalid cursor.')
+
+        images = self.filter_all_images(tag_ids, limit, after)
+        if limit is None or len(images) < limit:
+            return images, None
+
+        last = images[-1]
+        return images, f'{last["timestamp"]!r}_{last["id"]}'
+
+    def tags_page(self, limit: int | None = None, cursor: str | None = None
+                  ) -> tuple[list[dict], str | None]:
+        after = None
+        if cursor is not None:
+            if not cursor.isdigit():
+                self._error(400, 'Invalid cursor.')
+            after = int(cursor)
+
+        tags = self.all_tags(limit, after)
+        if limit is None or len(tags) < limit:
+            return tags, None
+
+        return tags, str(tags[-1]['id'])
 
     def safe_image(self, image: dict) -> dict:
         return {'id': image['id'], 'path': image['path'],
@@ -124,9 +436,7 @@ class Persistence(DataBase):
         if not is_image(upload_file.filename):
             self._error(400, 'File type is not supported.')
 
-        # sanitize filename
-        name = re.sub('[^\\w\\s\\-+=_!,;.\'"]+', '_', name)
-        path = os.path.join(self.images_dir, name)
+        path = os.path.join(self.images_dir, safe_name(name))
 
         # add to disk
         with open(path, 'wb') as f:
@@ -134,64 +444,300 @@ class Persistence(DataBase):
         # alter metadata
         os.utime(path, (timestamp, timestamp))
 
-        # add to database
+        # add to database. A sync listing the file being written may add it
+        # first, or fail to read it and leave it to the next sync. Paths are
+        # unique, only one of them adds the image.
         file = FilePath(path)
         return self._new_image(file, timestamp)
 
+    def add_images_everywhere(self, uploads: list[UploadFile],
+                              timestamps: list[str]) -> list[dict]:
+        # image files, and tar or zip archives of images, written to the
+        # images directory then embedded in batches and added in a single
+        # transaction. timestamps are those of the files, in order, archives
+        # keep the ones of their entries. Returns the status of each image.
+        if timestamps and len(timestamps) != len(uploads):
+            self._error(400, 'Expected one timestamp per file.')
+        try:
+            timestamps = [float(timestamp) for timestamp in timestamps]
+        except ValueError:
+            self._error(400, 'Invalid timestamp.')
+
+        # like single uploads, files added by a sync at the same time are
+        # only added once
+        results = []
+        written = {} # path -> result
+        for i, upload in enumerate(uploads):
+            name = upload.filename or ''
+            if is_archive(name):
+                entries = archive_entries(upload)
+            else:
+                timestamp = timestamps[i] if timestamps else None
+                entries = [(name, timestamp, upload.file)]
+
+            try:
+                for name, timestamp, f in entries:
+                    result = {'name': name}
+                    path = self._write_upload(result, name, timestamp, f)
+                    results.append(result)
+                    if path is not None:
+                        written[path] = result
+            except (OSError, EOFError, zlib.error, tarfile.TarError,
+                    zipfile.BadZipFile) as e:
+                results.append({'name': upload.filename,
+                                'status': 'failed',
+                                'error': f'Invalid archive: {e}'})
+
+        self._ingest(written)
+
+        counts = {}
+        for result in results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        self._log(f'Batch upload: {counts}.')
+        return results
+
+    def _write_upload(self, result: dict, name: str, timestamp: float | None,
+                      f: IO[bytes]) -> str | None:
+        # the path written to, None when the file is left out. Archive
+        # entries are flattened into the images directory.
+        if not is_image(name):
+            result['status'] = 'unsupported'
+            return None
+
+        path = os.path.join(self.images_dir,
+                            safe_name(os.path.basename(name)))
+        try:
+            out = open(path, 'xb')
+        except FileExistsError:
+            result['status'] = 'exists'
+            image = self._get_image_from_path(path)
+            if image is not None:
+                result['image_id'] = image['id']
+            return None
+        except OSError as e:
+            result['status'] = 'failed'
+            result['error'] = str(e)
+            return None
+
+        try:
+            with out, self.metrics.span('mediadb_file_seconds',
+                                        operation='write'):
+                shutil.copyfileobj(f, out)
+        except BaseException as e:
+            # no partial files, archives may be cut short
+            os.remove(path)
+            if not isinstance(e, OSError):
+                raise
+            result['status'] = 'failed'
+            result['error'] = str(e)
+            return None
+
+        if timestamp is not None:
+            os.utime(path, (timestamp, timestamp))
+        return path
+
+    def _ingest(self, written: dict[str, dict]) -> None:
+        # embeds the written files batch by batch, only keeping the
+        # embeddings, then adds them all at once. Thumbnails are made when
+        # first requested. Files left behind by an error are added by the
+        # next sync.
+        files = []
+        embeddings = []
+        with ThreadPoolExecutor(self.sync_workers) as executor:
+            for batch in self._load_batches(
+                    [FilePath(path) for path in written], executor):
+                images = []
+                for file, image in batch:
+                    if image is None:
+                        # the next syncs would skip it over and over
+                        os.remove(file.path)
+                        written[file.path]['status'] = 'failed'
+                        written[file.path]['error'] = 'Failed to read image.'
+                        continue
+                    files.append(file)
+                    images.append(image)
+
+                if images:
+                    self._log(f'Embedding {len(images)} uploaded image(s).')
+                    embeddings.append(self.model.embed_images(images))
+
+        if not files:
+            return
+
+        image_ids = self._insert_new_images(files,
+                                            [file.mtime for file in files],
+                                            np.concatenate(embeddings))
+        for file, image_id in zip(files, image_ids):
+            written[file.path]['status'] = 'added'
+            written[file.path]['image_id'] = image_id
+        self._update_index()
+
     def _new_image(self, file: FilePath, timestamp: float | None) -> int:
         self._log(f'-> Adding new image \'{file.path}\'.')
+        try:
+            file.update_stat()
+        except OSError:
+            self._error(600, 'Failed to get file timestamp.')
         if timestamp is None:
-            try:
-                timestamp = os.path.getmtime(file.path)
-            except:
-                self._error(600, 'Failed to get file timestamp.')
+            timestamp = file.mtime
 
         try:
-            image_id = self._add_image(file.path, timestamp)
-        except OSError:
+            image = self._read_image(file)
+        except (OSError, Image.DecompressionBombError):
             self._error(500, 'Failed to embed image.')
+
+        image_id = self._new_images([file], [image], [timestamp])[0]
         if image_id is None:
             self._error(500, 'Failed to add image.')
 
-        self._log('Generating tags for new image.')
-        self._try_assign_tags(image_id)
+        return image_id
+
+    def _new_images(self, files: list[FilePath], images: list[Image.Image],
+                    timestamps: list[float]) -> list[int]:
+        self._log(f'Embedding {len(images)} image(s).')
+        embeddings = self.model.embed_images(images)
+        image_ids = self._insert_new_images(files, timestamps, embeddings)
+        self._cache_thumbnails(image_ids, files, images)
+        return image_ids
+
+    def _insert_new_images(self, files: list[FilePath],
+                           timestamps: list[float],
+                           embeddings: np.ndarray) -> list[int]:
+        # the tags made from the paths and dates are embedded before taking
+        # the write lock, the model may still have to load
+        names = [self._path_tags(file, timestamp)
+                 for file, timestamp in zip(files, timestamps)]
+        tag_embeddings = self._embed_new_tags(
+            {name for image_names in names for name in image_names})
+
+        # one transaction for the images and all their tags
+        new_tags = []
+        with self.transaction():
+            image_ids = self._add_images(files, timestamps, embeddings)
+            added = [i for i, id in enumerate(image_ids) if id is not None]
+
+            self._log('Generating tags for new images.')
+            self._try_assign_tags([image_ids[i] for i in added])
+
+            for i in added:
+                new_tags += self._tag_new_image(image_ids[i], names[i],
+                                                tag_embeddings)
 
+        self._match_new_tags(new_tags)
+
+        # the ids of the images added by someone else in the meantime
+        for i, file in enumerate(files):
+            if image_ids[i] is None:
+                image = self._get_image_from_path(file.path)
+                image_ids[i] = None if image is None else image['id']
+
+        return image_ids
+
+    def _move_images_everywhere(self, moves: list[tuple[dict, FilePath]]
+                                ) -> None:
+        # the tags of the directories left are replaced by those of the new
+        # ones, the other tags stay
+        ids = [image['id'] for image, _ in moves]
+        files = [file for _, file in moves]
+        old_names = [set(self._dir_tags(FilePath(image['path'])))
+                     for image, _ in moves]
+        names = [self._dir_tags(file) for file in files]
+        tag_embeddings = self._embed_new_tags(
+            {name for file_names in names for name in file_names})
+
+        new_tags = []
+        with self.transaction():
+            self._move_images(ids, files)
+            for id, old, new in zip(ids, old_names, names):
+                for name in old.difference(new):
+                    tag = self._get_tag_from_name(name)
+                    if tag is not None:
+                        self._unassign_tag(id, tag['id'])
+                new_tags += self._tag_new_image(id, new, tag_embeddings)
+
+        self._match_new_tags(new_tags)
+
+    def _match_new_tags(self, tag_ids: list[int]) -> None:
+        # the library is matched against the tags by jobs, outside of the
+        # transaction that created them
+        for tag_id in tag_ids:
+            self.jobs.submit('tag', {'tag_id': tag_id})
+
+    def _reembed_images(self, ids: list[int], files: list[FilePath],
+                        images: list[Image.Image]) -> None:
+        # keep the tags of modified files, only add the newly matching ones
+        self._log(f'Embedding {len(images)} modified image(s).')
+        embeddings = self.model.embed_images(images)
+        with self.transaction():
+            self._update_images(ids, files, embeddings)
+            self._try_assign_tags(ids)
+        self._cache_thumbnails(ids, files, images)
+
+    def _cache_thumbnails(self, ids: list[int], files: list[FilePath],
+                          images: list[Image.Image]) -> None:
+        # the images are already decoded for embedding, reuse them
+        for id, file, image in zip(ids, files, images):
+            try:
+                with self.metrics.span('mediadb_file_seconds',
+                                       operation='thumbnail_put'):
+                    self.thumbnails.put(id, Persistence.thumbnail_size,
+                                        file.path, file.mtime, image)
+            except OSError:
+                self._log(f'Failed to cache thumbnail for \'{file.name}\'.')
+
+    def _dir_tags(self, file: FilePath) -> list[str]:
+        names = [tag_name(dir) for dir in file.dirs]
+        return [name for name in names if name]
+
+    def _path_tags(self, file: FilePath, timestamp: float) -> list[str]:
+        # names of the tags of a new image, its directories and date
         dt = datetime.fromtimestamp(timestamp)
-        year = str(dt.year)
-        month = dt.strftime("%B")
+        return self._dir_tags(file) + [str(dt.year), dt.strftime("%B")]
+
+    def _embed_new_tags(self, names: set[str]) -> dict[str, np.ndarray]:
+        return {name: self.model.embed_text(name) for name in sorted(names)
+                if self._get_tag_from_name(name) is None}
+
+    def _tag_new_image(self, image_id: int, names: list[str],
+                       tag_embeddings: dict[str, np.ndarray]) -> list[int]:
+        # returns the ids of the tags created
         self._log('Generating new tags from file path and date and assigning.')
-        for dirname in file.dirs + [year, month]:
-            tag_id = self._get_tag_from_name(dirname)
-            if tag_id is None:
-                tag_id = self.new_tag(dirname, False, True)
+        new_tags = []
+        for name in names:
+            tag = self._get_tag_from_name(name)
+            if tag is not None:
+                tag_id = tag['id']
             else:
-                tag_id = tag_id['id']
+                self._log(f'-> Adding new tag \'{name}\'')
+                embedding = tag_embeddings.get(name)
+                if embedding is None:
+                    # deleted since it was looked up
+                    embedding = self.model.embed_text(name)
+                tag_id = self._add_tag(name, False, embedding)
+                if tag_id is None:
+                    self._error(500, 'Failed to create tag.')
+                new_tags.append(tag_id)
             self._assign_tag(image_id, tag_id)
 
         self._log()
-        return image_id
+        return new_tags
 
-    def new_tag(self, name: str, is_dirname: bool, silent: bool = False) -> int:
-        # sanitize tag name
-        name = re.sub('[^\\w\\s\\-+=_!,;.\'"]+', '_', name)
-        name = name.strip()
+    def new_tag(self, name: str, is_dirname: bool) -> int:
+        # the images are matched against the tag by a tag job
+        name = tag_name(name)
         if not name:
             self._error(400, "Invalid tag name.");
 
         if self._get_tag_from_name(name) is not None:
-            if silent:
-                return -1
             self._error(409, 'Tag already present.')
 
         self._log(f'-> Adding new tag \'{name}\'')
-        id = self._add_tag(name, is_dirname)
-        if id is None:
-            self._error(500, 'Failed to create tag.')
-
-        if not is_dirname:
-            self._log('Updating tags for all images.')
-            for image in self._all_images():
-                self._try_assign_tags(image['id'])
+        # embedded before taking the write lock, the model may have to load
+        embedding = self.model.embed_text(name)
+        with self.transaction():
+            id = self._add_tag(name, is_dirname, embedding)
+            if id is None:
+                self._error(500, 'Failed to create tag.')
 
         return id
 
@@ -203,10 +749,11 @@ class Persistence(DataBase):
         path = image['path']
         self._log(f'Removing image {path}')
 
-        # remove from database
-        self._delete_image(image['id'])
-        # remove from disk
-        os.remove(path)
+        # remove from database and disk, the row is kept if the file can't be
+        with self.transaction():
+            self._delete_image(image['id'])
+            os.remove(path)
+        self.thumbnails.remove(image['id'])
 
     def delete_tag_everywhere(self, id: int) -> None:
         tag = self._get_tag_from_id(id)
@@ -240,31 +787,263 @@ class Persistence(DataBase):
 
         self._unassign_tag(image_id, tag_id)
 
-    def get_image_path_for_data(self, image_id: int) -> str:
+    def get_image_file(self, image_id: int) -> tuple[str, os.stat_result]:
+        # a cached path is only trusted while the file is still there, the
+        # image may have moved or been deleted meanwhile
+        path = self.path_cache.get(image_id)
+        if path is not None:
+            try:
+                return path, os.stat(path)
+            except OSError:
+                self.path_cache.remove(image_id)
+
         image = self._get_image_from_id(image_id)
         if image is None:
             self._error(404, 'Image not present.')
+        try:
+            stat = os.stat(image['path'])
+        except OSError:
+            self._error(404, 'Image file not found.')
+
+        self.path_cache.put(image_id, image['path'])
+        return image['path'], stat
+
+    def get_image_thumb(self, image_id: int, size: int) -> tuple[str, str]:
+        image = self._get_image_from_id(image_id)
+        if image is None:
+            self._error(404, 'Image not present.')
+
+        path = image['path']
+        try:
+            with self.metrics.span('mediadb_file_seconds',
+                                   operation='thumbnail_get'):
+                mtime = os.path.getmtime(path)
+                thumb = self.thumbnails.get(image_id, size, path, mtime)
+        except (OSError, Image.DecompressionBombError):
+            self._error(500, 'Failed to generate thumbnail.')
+
+        size = ThumbnailCache.bucket(size)
+        return thumb, ThumbnailCache.etag(image_id, size, mtime)
+
+    def prompt_n_best(self, prompt: str, n: int, distinct: bool = False
+                      ) -> list[tuple[float, dict]]:
+        # only the scores and ids are cached, the paths may still change.
+        # Prompts are far from every image, their best matches spread over
+        # too many lists of the index: they always scan the whole library.
+        with self.lock:
+            version = (self.embeddings.version, self.duplicates_version)
+            if version != self.prompt_cache_version:
+                self.prompt_cache.clear()
+                self.prompt_cache_version = version
+
+        results = self.prompt_cache.get((version, prompt, n, distinct))
+        if results is None:
+            prompt_embedding = self.model.embed_text(prompt)
+            wanted = self._candidates(n)
+            k = wanted
+            while True:
+                with self.lock:
+                    # the images may have changed while embedding the prompt
+                    version = (self.embeddings.version,
+                               self.duplicates_version)
+                    with self.metrics.span('mediadb_search_seconds',
+                                           stage='exact'):
+                        scores, ids = self.embeddings.search(prompt_embedding,
+                                                             k)
+                    # distinct results leave out the duplicates of others
+                    hidden = self.duplicate_of if distinct else {}
+                    keep = np.array([id not in hidden for id in ids.tolist()],
+                                    dtype=bool)
+                    total = len(self.embeddings)
+                if keep.sum() >= wanted or k >= total:
+                    break
+                k *= 4
+
+            with self.metrics.span('mediadb_search_seconds', stage='rerank'):
+                scores, ids = self._rerank(prompt_embedding,
+                                           scores[keep][:wanted],
+                                           ids[keep][:wanted], n)
+            results = (scores.tolist(), ids.tolist())
+            self.prompt_cache.put((version, prompt, n, distinct), results)
+
+        scores, ids = results
+        images = self._get_images_from_ids(ids)
+        return [(float(score), images[id])
+                for score, id in zip(scores, ids) if id in images]
+
+    def detect_duplicates(self) -> dict[str, int]:
+        # regroups the whole library, from the stored embeddings and hashes
+        with self.duplicates_lock:
+            with self.lock:
+                ids = self.embeddings.ids.copy()
+                vectors = normalize(self.embeddings.matrix)
+
+            self.cur.execute("""
+            SELECT images.id, images.timestamp, images.phash, images.size
+            FROM images
+            """)
+            details = {row['id']: row for row in self.cur.fetchall()}
+            known = [i for i, id in enumerate(ids.tolist()) if id in details]
+            ids = ids[known]
+            vectors = vectors[known]
+            rows = [details[id] for id in ids.tolist()]
+
+            self._log(f'Looking for duplicates among {len(ids)} image(s).')
+            finder = DuplicateFinder(
+                vectors, np.array([row['timestamp'] for row in rows]),
+                [row['phash'] for row in rows])
+
+            # the largest file of a group is likely the best copy
+            groups = {}
+            for group in finder.groups():
+                members = sorted(ids[group].tolist())
+                representative = max(
+                    members, key=lambda id: (details[id]['size'] or 0, -id))
+                groups[representative] = members
+            self._set_duplicates(groups)
 
-        return image['path']
+        duplicates = sum(len(members) - 1 for members in groups.values())
+        self._log(f'Found {len(groups)} group(s) of duplicates, '
+                  f'{duplicates} duplicate(s).')
+        return {'groups': len(groups), 'duplicates': duplicates}
 
-    def prompt_n_best(self, prompt: str, n: int) -> list[tuple[float, dict]]:
-        l = []
+    def duplicate_groups(self) -> list[dict]:
+        groups = self._get_duplicate_groups()
+        images = self._get_images_from_ids(
+            [id for members in groups.values() for id in members])
+        return [{'representative': representative,
+                 'images': [self.safe_image(images[id])
+                            for id in members if id in images]}
+                for representative, members in groups.items()]
+
+    def _search_embedding(self, embedding: np.ndarray, n: int,
+                          nprobe: int | None = None,
+                          exclude: int | None = None
+                          ) -> list[tuple[float, dict]]:
+        extra = 0 if exclude is None else 1
+        with self.lock, self.metrics.span('mediadb_search_seconds',
+                                          stage='index'):
+            scores, ids = self.index.search(embedding,
+                                            self._candidates(n + extra), nprobe)
+        with self.metrics.span('mediadb_search_seconds', stage='rerank'):
+            scores, ids = self._rerank(embedding, scores, ids, n + extra)
+
+        keep = ids != exclude
+        scores, ids = scores[keep][:n].tolist(), ids[keep][:n].tolist()
+        images = self._get_images_from_ids(ids)
+        return [(score, images[id])
+                for score, id in zip(scores, ids) if id in images]
+
+    def similar_images(self, image_id: int, n: int,
+                       nprobe: int | None = None) -> list[tuple[float, dict]]:
+        # the stored embedding is used as is, nothing is run through the model
+        self.cur.execute("""
+        SELECT images.embedding
+        FROM images
+        WHERE images.id = ?
+        """, [image_id])
+        row = self.cur.fetchone()
+        if row is None:
+            self._error(404, 'Image not present.')
+
+        code = np.frombuffer(row['embedding'], dtype=np.uint8)[None]
+        embedding = self.storage_codec.decode(code)[0]
+        return self._search_embedding(embedding, n, nprobe, image_id)
+
+    def search_by_image(self, upload_file: UploadFile, n: int,
+                        nprobe: int | None = None) -> list[tuple[float, dict]]:
+        try:
+            image = self.model.load_image(io.BytesIO(upload_file.file.read()))
+        except (OSError, Image.DecompressionBombError):
+            self._error(400, 'Failed to read image.')
+
+        embedding = self.model.embed_images([image])[0]
+        return self._search_embedding(embedding, n, nprobe)
+
+    def search_images(self, prompt: str, n: int, tag_ids: list[int],
+                      start: float | None = None, end: float | None = None
+                      ) -> tuple[list[tuple[float, dict]], str]:
+        # prompt ranking restricted to images with all the tags and within the
+        # time range, returns the results and the plan that was used
+        tag_ids = sorted(set(tag_ids))
+        if not tag_ids and start is None and end is None:
+            return self.prompt_n_best(prompt, n), 'vector'
+
+        with self.lock:
+            total = len(self.embeddings)
+        candidates = self._count_candidates(tag_ids, start, end)
         prompt_embedding = self.model.embed_text(prompt)
 
-        for image in self._all_images():
-            img_embedding = np.frombuffer(image['embedding'], dtype=np.float32)
-            score = self.model.sim_score(img_embedding, prompt_embedding)[0]
-            l.append((float(score), image))
+        wanted = self._candidates(n)
+        if candidates <= total * Persistence.filter_first_ratio:
+            # selective filter: exact scores of the few matching images
+            plan = 'filter-first'
+            with self.metrics.span('mediadb_search_seconds', stage='filter'):
+                ids = self._filter_image_ids(tag_ids, start, end)
+            with self.lock, self.metrics.span('mediadb_search_seconds',
+                                              stage='exact'):
+                scores, ids = self.embeddings.search_among(prompt_embedding,
+                                                           ids, wanted)
+        else:
+            # broad filter: walk down the prompt results until enough match
+            plan = 'vector-first'
+            k = wanted * total // max(candidates, 1) \
+                * Persistence.vector_first_oversample
+            k = max(k, wanted)
+            while True:
+                with self.lock, self.metrics.span('mediadb_search_seconds',
+                                                  stage='exact'):
+                    scores, ids = self.embeddings.search(prompt_embedding, k)
+                keep = self._filter_image_ids(tag_ids, start, end,
+                                              ids.tolist())
+                matches = np.isin(ids, keep)
+                if matches.sum() >= wanted or k >= total:
+                    break
+                k *= 4
+            scores, ids = scores[matches][:wanted], ids[matches][:wanted]
 
-        return sorted(l, key=lambda t: -t[0])[:n]
+        with self.metrics.span('mediadb_search_seconds', stage='rerank'):
+            scores, ids = self._rerank(prompt_embedding, scores, ids, n)
+        results = list(zip(scores.tolist(), ids.tolist()))
 
-    def filter_around(self, image_id: int, tag_ids: list[int],
-                      n: int) -> list[dict]:
-        image = self._get_image_from_id(image_id)
+        self._log(f'Hybrid search over {candidates} candidate(s) out of '
+                  f'{total}, {plan}.')
+        images = self._get_images_from_ids([id for _, id in results])
+        return [(score, images[id])
+                for score, id in results if id in images], plan
+
+    def closest_to_date(self, timestamp: float,
+                        tag_ids: list[int] | None = None) -> dict:
+        # the library may still be empty while the first sync runs
+        image = super().closest_to_date(timestamp, tag_ids)
         if image is None:
-            self._error(404, 'Image not present.')
+            self._error(404, 'No image present.')
+
+        return image
+
+    def filter_around(self, image_id: int | None, tag_ids: list[int],
+                      n: int, timestamp: float | None = None) -> list[dict]:
+        # around an image, or around a date when no image is given
+        if n < 1:
+            self._error(400, 'n must be at least 1.')
+
+        id = None
+        if image_id is not None:
+            image = self._get_image_from_id(image_id)
+            if image is None:
+                self._error(404, 'Image not present.')
+            id, timestamp = image['id'], image['timestamp']
+        elif timestamp is None:
+            self._error(400, 'Either an image or a timestamp is needed.')
+
+        return self._images_around(timestamp, id, tag_ids, n)
 
-        before = self._filter_around(image['timestamp'], tag_ids, n, False)
-        after = self._filter_around(image['timestamp'], tag_ids, n, True)
+    def date_histogram(self, unit: str, tag_ids: list[int],
+                       start: float | None = None,
+                       end: float | None = None) -> list[dict]:
+        if unit not in timeline_units:
+            self._error(400, 'Unit must be one of '
+                             f'{", ".join(timeline_units)}.')
 
-        return before + after[1:]
+        return [{'start': period, 'count': count} for period, count
+                in self._date_histogram(unit, tag_ids, start, end)]
@@ -0,0 +1,166 @@
+import numpy as np
+
+# Embedding codecs. Each one turns a matrix of normalized float32 vectors into
+# a matrix of fixed size byte codes, one row per vector, and back. The codes
+# of the float32, float16 and int8 codecs are also the blobs stored in the
+# database, told apart by their length.
+
+class Float32Codec:
+    name = 'float32'
+    lossy = False
+    # vectors needed by train() before the codec can encode anything
+    min_train_size = 0
+    train_sample_size = 65536
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.code_size = 4 * dim
+
+    def train(self, vectors: np.ndarray) -> None:
+        pass
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        return vectors.view(np.uint8).reshape(len(vectors), self.code_size)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return np.ascontiguousarray(codes).view(np.float32)
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        return self.decode(codes) @ query
+
+class Float16Codec(Float32Codec):
+    name = 'float16'
+    lossy = True
+
+    def __init__(self, dim: int):
+        super().__init__(dim)
+        self.code_size = 2 * dim
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.ascontiguousarray(vectors, dtype=np.float16)
+        return vectors.view(np.uint8).reshape(len(vectors), self.code_size)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        codes = np.ascontiguousarray(codes)
+        return codes.view(np.float16).astype(np.float32)
+
+class Int8Codec(Float32Codec):
+    # symmetric scalar quantization, each code is the float32 scale of the
+    # vector followed by its int8 components
+    name = 'int8'
+    lossy = True
+
+    def __init__(self, dim: int):
+        super().__init__(dim)
+        self.code_size = 4 + dim
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        scales = np.abs(vectors).max(axis=1, keepdims=True) / 127
+        scales[scales == 0] = 1
+
+        codes = np.empty((len(vectors), self.code_size), dtype=np.uint8)
+        codes[:, :4] = scales.view(np.uint8)
+        codes[:, 4:] = np.rint(vectors / scales).astype(np.int8).view(np.uint8)
+        return codes
+
+    def _split(self, codes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        scales = np.ascontiguousarray(codes[:, :4]).view(np.float32)
+        return codes[:, 4:].view(np.int8), scales[:, 0]
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        values, scales = self._split(codes)
+        return values.astype(np.float32) * scales[:, None]
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        values, scales = self._split(codes)
+        return (values.astype(np.float32) @ query) * scales
+
+class PQCodec(Float32Codec):
+    # product quantization: the vector is split in `subspaces` chunks, each
+    # replaced by the index of its closest centroid among 256 learned for
+    # that chunk. Only used in memory, since the database keeps a format that
+    # can be decoded without the learned centroids.
+    name = 'pq'
+    lossy = True
+
+    subspaces = 64
+    centroids = 256
+    # fewer vectors than this are not enough to learn the centroids from
+    min_train_size = 10000
+    kmeans_iterations = 10
+
+    def __init__(self, dim: int):
+        super().__init__(dim)
+        self.code_size = PQCodec.subspaces
+        self.sub_dim = dim // PQCodec.subspaces
+        self.codebooks = None # (subspaces, centroids, sub_dim)
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        # (n, dim) -> (subspaces, n, sub_dim)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors.reshape(len(vectors), PQCodec.subspaces,
+                               self.sub_dim).transpose(1, 0, 2)
+
+    def _nearest(self, codebook: np.ndarray, data: np.ndarray) -> np.ndarray:
+        # squared distance up to the norm of the data, which is constant
+        distances = (codebook ** 2).sum(axis=1) - 2 * data @ codebook.T
+        return np.argmin(distances, axis=1)
+
+    def train(self, vectors: np.ndarray) -> None:
+        rng = np.random.default_rng(0)
+        if len(vectors) > PQCodec.train_sample_size:
+            rows = rng.choice(len(vectors), PQCodec.train_sample_size,
+                              replace=False)
+            vectors = vectors[rows]
+
+        k = PQCodec.centroids
+        codebooks = []
+        for data in self._split(vectors):
+            codebook = data[rng.choice(len(data), k,
+                                       replace=len(data) < k)]
+            for _ in range(PQCodec.kmeans_iterations):
+                labels = self._nearest(codebook, data)
+                counts = np.bincount(labels, minlength=k)[:, None]
+                sums = np.stack([np.bincount(labels, data[:, d], k)
+                                 for d in range(self.sub_dim)], axis=1)
+                # empty clusters keep their previous centroid
+                codebook = np.where(counts > 0, sums / np.maximum(counts, 1),
+                                    codebook).astype(np.float32)
+            codebooks.append(codebook)
+
+        self.codebooks = np.stack(codebooks)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(vectors), PQCodec.subspaces), dtype=np.uint8)
+        for j, data in enumerate(self._split(vectors)):
+            codes[:, j] = self._nearest(self.codebooks[j], data)
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        subspaces = np.arange(PQCodec.subspaces)
+        return self.codebooks[subspaces, codes].reshape(len(codes), self.dim)
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # asymmetric distance: the query stays exact, the score of a code is
+        # the sum of the precomputed scores of its centroids
+        query = np.asarray(query, dtype=np.float32)
+        tables = np.einsum('jkd,jd->jk', self.codebooks,
+                           query.reshape(PQCodec.subspaces, self.sub_dim))
+        subspaces = np.arange(PQCodec.subspaces)
+        return tables[subspaces, codes].sum(axis=1)
+
+codecs = {codec.name: codec
+          for codec in [Float32Codec, Float16Codec, Int8Codec, PQCodec]}
+# formats that can be stored in the database
+storage_codecs = ['float32', 'float16', 'int8']
+
+def codec_for_size(code_size: int, dim: int) -> Float32Codec | None:
+    # the storage codec whose codes are that long
+    for name in storage_codecs:
+        codec = codecs[name](dim)
+        if codec.code_size == code_size:
+            return codec
+
+    return None
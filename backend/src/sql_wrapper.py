@@ -1,7 +1,71 @@
+import os
+import sys
+import time
 import sqlite3
+import threading
+from contextlib import contextmanager
 import numpy as np
 
 from .model import Model
+from .files import FilePath
+from .embeddings import EmbeddingStore, normalize, top_n
+from .quantization import codecs, codec_for_size
+from .ann import indexes
+from .tag_index import TagIndex
+from .cache import LRUCache
+from .migrations import migrate
+
+class TimedCursor(sqlite3.Cursor):
+    # Times each statement up to the last row read, as SQLite only computes
+    # the rows of a query when they are fetched. Statements are named after
+    # the DataBase method running them.
+
+    def __init__(self, con: sqlite3.Connection, db: 'DataBase'):
+        super().__init__(con)
+        self.db = db
+        self.pending = None
+
+    # DataBase methods running queries on behalf of their caller
+    helpers = {'_select_in_chunks'}
+
+    def _start(self, sql: str, params) -> None:
+        self._finish()
+        frame = sys._getframe(2)
+        while frame.f_code.co_name in TimedCursor.helpers:
+            frame = frame.f_back
+        name = frame.f_code.co_name
+        self.pending = (name, sql, params, time.perf_counter())
+
+    def _finish(self) -> None:
+        if self.pending is not None:
+            name, sql, params, start = self.pending
+            self.pending = None
+            self.db._record_query(name, sql, params,
+                                  time.perf_counter() - start)
+
+    def execute(self, sql: str, params=()) -> 'TimedCursor':
+        self._start(sql, params)
+        super().execute(sql, params)
+        if self.description is None:
+            # no rows to read
+            self._finish()
+        return self
+
+    def executemany(self, sql: str, params) -> 'TimedCursor':
+        self._start(sql, None)
+        super().executemany(sql, params)
+        self._finish()
+        return self
+
+    def fetchone(self):
+        row = super().fetchone()
+        self._finish()
+        return row
+
+    def fetchall(self) -> list:
+        rows = super().fetchall()
+        self._finish()
+        return rows
 
 class DataBase:
     basic_tags = [
@@ -12,19 +76,74 @@ class DataBase:
     # minimum sim score (0 to 1) to automatically assign a tag to an image
     min_sim_score = .25
 
-    def __init__(self, db_file: str, model: Model, verbose: bool = False):
+    # nearest neighbour index used for searches by image, see ann.indexes.
+    # Prompts always scan the whole library.
+    index_type = 'ivf'
+
+    # columns returned for images and tags, the embeddings are only read
+    # into the in-memory stores
+    image_columns = 'images.id, images.path, images.timestamp'
+    tag_columns = 'tags.id, tags.is_dirname, tags.name'
+
+    # connection pragmas. WAL lets readers go on while a sync is writing, and
+    # only needs a full fsync on checkpoints with synchronous = normal.
+    journal_mode = 'wal'
+    synchronous = 'normal'
+    cache_size = -65536 # in KiB when negative
+    mmap_size = 256 << 20
+
+    # format of the image embeddings in the database, one of
+    # quantization.storage_codecs. Rows in another format are converted when
+    # the database is opened.
+    embedding_format = 'float32'
+    # format of the in-memory copy used for prompts and tag matching, the
+    # database format when None. When it is less precise, prompt results are
+    # re-ranked with the database rows among rerank_factor times more
+    # candidates.
+    memory_format = None
+    rerank_factor = 4
+
+    # image id -> path, saves a query per request for the original files
+    path_cache_entries = 65536
+
+    # parameters of a slow query longer than this are cut in the log
+    slow_query_param_length = 200
+    # values bound by each IN (...) query, well below SQLite's limit on the
+    # number of query parameters
+    in_query_size = 500
+
+    def __init__(self, db_file: str, model: Model, verbose: bool = False,
+                 slow_query_seconds: float | None = None):
         self.db_file = db_file
         self.model = model
         self.verbose = verbose
+        # statements taking longer are logged with their parameters
+        self.slow_query_seconds = slow_query_seconds
+        # shared with the model, a single registry for the whole server
+        self.metrics = model.metrics
 
-        self._log('Connecting to database.')
+        # each thread gets its own connection, see con and cur
+        self._local = threading.local()
+        self._connections = []
+        # guards the in-memory embedding stores and index
+        self.lock = threading.RLock()
 
-        self.con = sqlite3.connect(db_file)
-        self.con.row_factory = sqlite3.Row
-        self.cur = self.con.cursor()
+        self.embeddings = EmbeddingStore()
+        self.storage_codec = codecs[DataBase.embedding_format](
+            self.embeddings.dim)
+        self.tag_embeddings = EmbeddingStore()
+        self.index = indexes[DataBase.index_type](self.embeddings)
+        self.index_file = os.path.splitext(db_file)[0] + '.index.npz'
+        # image id -> representative, for the duplicates of another image
+        self.duplicate_of: dict[int, int] = {}
+        self.duplicates_version = 0
+        self.tag_index = TagIndex()
+        # only ever emptied by the writers, readers check the files exist
+        self.path_cache = LRUCache(DataBase.path_cache_entries)
 
         #self.reset_db()
         self._init_db()
+        self._load_embeddings()
 
         self._log()
 
@@ -32,9 +151,95 @@ class DataBase:
         if self.verbose:
             print(*args, **kwargs)
 
+    @property
+    def con(self) -> sqlite3.Connection:
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            self._log('Connecting to database.')
+            # closed from the thread calling close(), never used concurrently
+            con = sqlite3.connect(self.db_file, timeout=30,
+                                  check_same_thread=False)
+            con.row_factory = sqlite3.Row
+            for pragma in ['journal_mode', 'synchronous', 'cache_size',
+                           'mmap_size']:
+                con.execute(f'PRAGMA {pragma} = '
+                            f'{getattr(DataBase, pragma)}')
+            self._local.con = con
+            self._local.cur = con.cursor(lambda con: TimedCursor(con, self))
+            self._local.depth = 0
+            with self.lock:
+                self._connections.append(con)
+
+        return con
+
+    @property
+    def cur(self) -> sqlite3.Cursor:
+        self.con
+        return self._local.cur
+
+    @contextmanager
+    def transaction(self):
+        # groups the writes made in this thread into a single commit, can be
+        # nested. The write lock is taken up front so that concurrent writers
+        # wait on each other instead of failing to upgrade a read lock.
+        con = self.con
+        if self._local.depth == 0 and not con.in_transaction:
+            con.execute('BEGIN IMMEDIATE')
+        changes = con.total_changes
+
+        self._local.depth += 1
+        try:
+            yield
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                con.rollback()
+                if con.total_changes != changes:
+                    # the in-memory stores were updated along with the rows
+                    self._load_embeddings()
+            raise
+
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            con.commit()
+
+    def _record_query(self, name: str, sql: str, params,
+                      seconds: float) -> None:
+        self.metrics.observe('mediadb_sql_seconds', seconds, query=name)
+        if self.slow_query_seconds is None \
+                or seconds < self.slow_query_seconds:
+            return
+
+        self.metrics.increment('mediadb_slow_queries_total', query=name)
+        if params is None:
+            params = '(many)'
+        else:
+            params = [f'<{len(param)} bytes>'
+                      if isinstance(param, bytes) else param
+                      for param in params]
+            params = str(params)
+            if len(params) > DataBase.slow_query_param_length:
+                params = params[:DataBase.slow_query_param_length] + '...'
+        print(f'Slow query in {name} ({seconds * 1000:.1f} ms): '
+              f'{" ".join(sql.split())} {params}', file=sys.stderr)
+
+    def _commit(self) -> None:
+        # deferred to the end of the enclosing transaction, if any
+        con = self.con
+        if self._local.depth == 0:
+            con.commit()
+
     def close(self) -> None:
-        self._log('Closing database connection.')
-        self.con.close()
+        self._log('Saving embedding index.')
+        with self.lock:
+            self.index.save(self.index_file)
+
+        self._log('Closing database connections.')
+        with self.lock:
+            for con in self._connections:
+                con.close()
+            self._connections = []
+        self._local = threading.local()
 
     def _init_db(self) -> None:
         self.cur.execute("""
@@ -44,67 +249,218 @@ class DataBase:
         AND name='images'""")
         exists = self.cur.fetchone()
 
-        self.cur.execute("""
-        CREATE TABLE IF NOT EXISTS images (
-            id INTEGER PRIMARY KEY,
-            path TEXT,
-            timestamp REAL,
-            embedding BLOB
-        )""")
-        self.cur.execute("""
-        CREATE TABLE IF NOT EXISTS tags (
-            id INTEGER PRIMARY KEY,
-            is_dirname INTEGER,
-            name TEXT,
-            embedding BLOB
-        )
-        """)
-        self.cur.execute("""
-        CREATE TABLE IF NOT EXISTS tags_join (
-            id INTEGER PRIMARY KEY,
-            image_id INTEGER,
-            tag_id INTEGER,
-            FOREIGN KEY(image_id) REFERENCES images(id),
-            FOREIGN KEY(tag_id) REFERENCES tags(id)
-        )
-        """)
-
-        self.con.commit()
+        for name in migrate(self.con):
+            self._log(f'Applied database migration {name}.')
+        self._convert_embeddings()
 
         if not exists:
             self._log('Adding basic tags because there are none.')
 
             for tag in DataBase.basic_tags:
-                self._add_tag(tag, False)
+                self._add_tag(tag, False, self.model.embed_text(tag))
 
     def reset_db(self) -> None:
         self._log('Resetting database.')
         self.cur.execute('DROP TABLE IF EXISTS images')
         self.cur.execute('DROP TABLE IF EXISTS tags')
         self.cur.execute('DROP TABLE IF EXISTS tags_join')
-        self.con.commit()
+        self.cur.execute('DROP TABLE IF EXISTS duplicates')
+        self.cur.execute('PRAGMA user_version = 0')
+        self._commit()
+
+        with self.lock:
+            self.index.clear()
+            self.index.save(self.index_file)
 
         self._init_db()
+        self._load_embeddings()
 
-    def _get_image_from_id(self, id: int) -> dict | None:
+    def _convert_embeddings(self) -> None:
+        # rewrite the rows stored in another format than the configured one,
+        # a batch per transaction so that an interrupted conversion resumes
+        codec = self.storage_codec
+        self.cur.execute("""
+        SELECT COUNT(*)
+        FROM images
+        WHERE length(images.embedding) != ?
+        """, [codec.code_size])
+        count = self.cur.fetchone()[0]
+        if count == 0:
+            return
+
+        self._log(f'Converting {count} image embedding(s) to {codec.name}.')
+        last_id = -1
+        while True:
+            self.cur.execute("""
+            SELECT images.id, images.embedding
+            FROM images
+            WHERE length(images.embedding) != ?
+            AND images.id > ?
+            ORDER BY images.id
+            LIMIT 1000
+            """, [codec.code_size, last_id])
+            rows = self.cur.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+
+            vectors = []
+            for row in rows:
+                blob = row['embedding']
+                old = codec_for_size(len(blob), self.embeddings.dim)
+                if old is None:
+                    raise ValueError(f'Image {row["id"]} has an embedding of '
+                                     f'unknown format.')
+                vectors.append(old.decode(np.frombuffer(blob, np.uint8)[None]))
+
+            codes = codec.encode(normalize(np.concatenate(vectors)))
+            with self.transaction():
+                self.cur.executemany("""
+                UPDATE images
+                SET embedding = ?
+                WHERE images.id = ?
+                """, [(code.tobytes(), row['id'])
+                      for code, row in zip(codes, rows)])
+
+    def _memory_codec(self, codes: np.ndarray):
+        name = DataBase.memory_format or DataBase.embedding_format
+        if name == self.storage_codec.name:
+            return self.storage_codec
+
+        codec = codecs[name](self.embeddings.dim)
+        if len(codes) < codec.min_train_size:
+            self._log(f'Not enough images for {name} embeddings, keeping '
+                      f'{self.storage_codec.name} in memory.')
+            return self.storage_codec
+
+        sample = codes
+        if len(codes) > codec.train_sample_size:
+            rng = np.random.default_rng(0)
+            sample = codes[np.sort(rng.choice(len(codes),
+                                              codec.train_sample_size,
+                                              replace=False))]
+        codec.train(normalize(self.storage_codec.decode(sample)))
+        return codec
+
+    def _load_embeddings(self) -> None:
+        self._log('Loading image and tag embeddings.')
+        ids, codes = self._read_image_codes()
+        tags = self._read_embeddings('tags')
+        tag_index = self._read_tag_index()
+
+        codec = self._memory_codec(codes)
+        with self.lock:
+            self.embeddings.set_codec(codec)
+            if codec is self.storage_codec:
+                self.embeddings.add_codes(ids, codes)
+            else:
+                # decode in chunks, the whole library may not fit as float32
+                chunk_size = 65536
+                for i in range(0, len(ids), chunk_size):
+                    self.embeddings.add_many(
+                        ids[i:i + chunk_size],
+                        self.storage_codec.decode(codes[i:i + chunk_size]))
+            self.tag_embeddings.load(*tags)
+            self.tag_index.load(*tag_index)
+            self.path_cache.clear()
+            self.duplicate_of = self._read_duplicates()
+            self.duplicates_version += 1
+
+            self._log('Loading embedding index.')
+            self.index.load(self.index_file)
+            self._update_index()
+
+    def _read_embeddings(self, table: str) -> tuple[list[int], np.ndarray]:
+        self.cur.execute(f"""
+        SELECT {table}.id, {table}.embedding
+        FROM {table}
+        """)
+        rows = self.cur.fetchall()
+
+        ids = [row['id'] for row in rows]
+        blob = b''.join(row['embedding'] for row in rows)
+        return ids, np.frombuffer(blob, dtype=np.float32)
+
+    def _read_tag_index(self) -> tuple[list[int], list[float],
+                                       list[tuple[int, int]]]:
+        self.cur.execute("""
+        SELECT images.id, images.timestamp
+        FROM images
+        """)
+        images = self.cur.fetchall()
         self.cur.execute("""
-        SELECT images.*
+        SELECT tags_join.image_id, tags_join.tag_id
+        FROM tags_join
+        """)
+        pairs = [tuple(row) for row in self.cur.fetchall()]
+
+        return ([row['id'] for row in images],
+                [row['timestamp'] for row in images], pairs)
+
+    def _read_image_codes(self) -> tuple[list[int], np.ndarray]:
+        self.cur.execute("""
+        SELECT images.id, images.embedding
+        FROM images
+        """)
+        rows = self.cur.fetchall()
+
+        ids = [row['id'] for row in rows]
+        blob = b''.join(row['embedding'] for row in rows)
+        codes = np.frombuffer(blob, dtype=np.uint8)
+        return ids, codes.reshape(-1, self.storage_codec.code_size)
+
+    def _rerank(self, query: np.ndarray, scores: np.ndarray, ids: np.ndarray,
+                n: int) -> tuple[np.ndarray, np.ndarray]:
+        # candidates of an in-memory search are rescored with the stored
+        # embeddings when the in-memory ones are less precise
+        if self.embeddings.codec is self.storage_codec:
+            return scores[:n], ids[:n]
+
+        rows = self._select_in_chunks("""
+        SELECT images.id, images.embedding
+        FROM images
+        WHERE images.id IN ({})
+        """, ids.tolist())
+        blobs = {row['id']: row['embedding'] for row in rows}
+
+        ids = np.fromiter(blobs.keys(), dtype=np.int64, count=len(blobs))
+        codes = np.frombuffer(b''.join(blobs.values()), dtype=np.uint8)
+        codes = codes.reshape(-1, self.storage_codec.code_size)
+        scores = normalize(self.storage_codec.decode(codes)) @ normalize(query)
+        best = top_n(scores, n)
+        return scores[best], ids[best]
+
+    def _candidates(self, n: int) -> int:
+        # number of in-memory results to fetch for n re-ranked ones
+        if self.embeddings.codec is self.storage_codec:
+            return n
+        return n * DataBase.rerank_factor
+
+    def _update_index(self) -> None:
+        with self.lock:
+            if self.index.maybe_train():
+                self._log('Trained embedding index.')
+                self.index.save(self.index_file)
+
+    def _get_image_from_id(self, id: int) -> dict | None:
+        self.cur.execute(f"""
+        SELECT {DataBase.image_columns}
         FROM images
         WHERE images.id = ?
         """, [id])
         return self.cur.fetchone()
 
     def _get_image_from_path(self, path: str) -> dict:
-        self.cur.execute("""
-        SELECT images.*
+        self.cur.execute(f"""
+        SELECT {DataBase.image_columns}
         FROM images
         WHERE images.path = ?
         """, [path])
         return self.cur.fetchone()
 
     def _get_tag_from_id(self, id: int) -> dict | None:
-        self.cur.execute("""
-        SELECT tags.*
+        self.cur.execute(f"""
+        SELECT {DataBase.tag_columns}
         FROM tags
         WHERE tags.id = ?
         """, [id])
@@ -118,36 +474,139 @@ class DataBase:
         """, [name])
         return self.cur.fetchone()
 
-    def _add_image(self, path: str, timestamp: float) -> int | None:
-        embedding = self.model.embed_image(path)
-        embedding_blob = embedding.tobytes()
+    def _add_images(self, files: list[FilePath], timestamps: list[float],
+                    embeddings: np.ndarray) -> list[int | None]:
+        # None for the paths already added, by a sync and an upload at the
+        # same time
+        embeddings = normalize(embeddings)
+        codes = self.storage_codec.encode(embeddings)
 
-        self.cur.execute("""
-        INSERT INTO images (path, timestamp, embedding)
-        VALUES (?, ?, ?)""", [path, timestamp, embedding_blob])
-        self.con.commit()
+        ids = []
+        for file, timestamp, code in zip(files, timestamps, codes):
+            self.cur.execute("""
+            INSERT OR IGNORE INTO images
+                (path, timestamp, embedding, size, mtime, hash, phash)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            [file.path, timestamp, code.tobytes(), file.size, file.mtime,
+             file.hash, file.phash])
+            ids.append(self.cur.lastrowid if self.cur.rowcount else None)
+        self._commit()
+
+        added = [i for i, id in enumerate(ids) if id is not None]
+        with self.lock:
+            self.embeddings.add_many([ids[i] for i in added],
+                                     embeddings[added])
+            self.index.add([ids[i] for i in added])
+            self.tag_index.set_timestamps([ids[i] for i in added],
+                                          [timestamps[i] for i in added])
+
+        return ids
+
+    def _update_images(self, ids: list[int], files: list[FilePath],
+                       embeddings: np.ndarray) -> None:
+        embeddings = normalize(embeddings)
+        codes = self.storage_codec.encode(embeddings)
+
+        self.cur.executemany("""
+        UPDATE images
+        SET embedding = ?, size = ?, mtime = ?, hash = ?, phash = ?
+        WHERE images.id = ?
+        """, [(code.tobytes(), file.size, file.mtime, file.hash, file.phash,
+               id) for id, file, code in zip(ids, files, codes)])
+        self._commit()
+
+        with self.lock:
+            self.embeddings.add_many(ids, embeddings)
+            self.index.add(ids)
+
+    def _update_image_stats(self, ids: list[int],
+                            files: list[FilePath]) -> None:
+        self.cur.executemany("""
+        UPDATE images
+        SET size = ?, mtime = ?
+        WHERE images.id = ?
+        """, [(file.size, file.mtime, id) for id, file in zip(ids, files)])
+        self._commit()
+
+    def _move_images(self, ids: list[int], files: list[FilePath]) -> None:
+        self.cur.executemany("""
+        UPDATE images
+        SET path = ?, size = ?, mtime = ?
+        WHERE images.id = ?
+        """, [(file.path, file.size, file.mtime, id)
+              for id, file in zip(ids, files)])
+        self._commit()
+
+        for id in ids:
+            self.path_cache.remove(id)
+
+    def _get_image_stats(self,
+                         paths: list[str] | None = None) -> dict[str, dict]:
+        # stats of all the images, or of the given files and directory trees
+        if paths is None:
+            self.cur.execute("""
+            SELECT images.id, images.path, images.size, images.mtime,
+                images.hash
+            FROM images
+            """)
+            return {image['path']: image for image in self.cur.fetchall()}
 
-        return self.cur.lastrowid
+        # the files in one go, then each directory tree as a range of the
+        # path index. Paths of deleted files may be either.
+        rows = self._select_in_chunks("""
+        SELECT images.id, images.path, images.size, images.mtime,
+            images.hash
+        FROM images
+        WHERE images.path IN ({})
+        """, paths)
+        stats = {image['path']: image for image in rows}
+
+        for path in paths:
+            prefix = path.rstrip(os.sep) + os.sep
+            # the first path after the whole tree, os.sep being ASCII
+            end = prefix[:-1] + chr(ord(os.sep) + 1)
+            self.cur.execute("""
+            SELECT images.id, images.path, images.size, images.mtime,
+                images.hash
+            FROM images
+            WHERE images.path >= ?
+            AND images.path < ?
+            """, [prefix, end])
+            stats.update((image['path'], image)
+                         for image in self.cur.fetchall())
 
-    def _add_tag(self, name: str, is_dirname: bool) -> int | None:
-        embedding = self.model.embed_text(name)
+        return stats
+
+    def _add_tag(self, name: str, is_dirname: bool,
+                 embedding: np.ndarray) -> int | None:
+        # embedding of the name, computed by the caller outside of any
+        # transaction
         embedding_blob = embedding.tobytes()
 
         self.cur.execute("""
         INSERT INTO tags (name, is_dirname, embedding)
         VALUES (?, ?, ?)""", [name, is_dirname, embedding_blob])
-        self.con.commit()
+        self._commit()
+
+        tag_id = self.cur.lastrowid
+        if tag_id is not None:
+            with self.lock:
+                self.tag_embeddings.add(tag_id, embedding)
 
-        return self.cur.lastrowid
+        return tag_id
 
     def _assign_tag(self, image_id: int, tag_id: int) -> int | None:
         self.cur.execute("""
-        INSERT INTO tags_join (image_id, tag_id)
+        INSERT OR IGNORE INTO tags_join (image_id, tag_id)
         VALUES (?, ?)
         """, [image_id, tag_id])
-        self.con.commit()
+        self._commit()
+        join_id = self.cur.lastrowid
+
+        with self.lock:
+            self.tag_index.add([(image_id, tag_id)])
 
-        return self.cur.lastrowid
+        return join_id
 
     def _unassign_tag(self, image_id: int, tag_id: int) -> None:
         self.cur.execute("""
@@ -155,7 +614,10 @@ class DataBase:
         WHERE tags_join.image_id = ?
         AND tags_join.tag_id = ?
         """, [image_id, tag_id])
-        self.con.commit()
+        self._commit()
+
+        with self.lock:
+            self.tag_index.remove(image_id, tag_id)
 
     def _get_join_from_ids(self, image_id: int, tag_id: int) -> dict:
         self.cur.execute("""
@@ -166,44 +628,87 @@ class DataBase:
         """, [image_id, tag_id])
         return self.cur.fetchone()
 
-    def _try_assign_tags(self, img_id: int):
-        self.cur.execute("""
-        SELECT images.*
-        FROM images
-        WHERE images.id = ?
-        """, [img_id])
+    def _assign_tags(self, pairs: list[tuple[int, int]]) -> None:
+        self.cur.executemany("""
+        INSERT OR IGNORE INTO tags_join (image_id, tag_id)
+        VALUES (?, ?)
+        """, pairs)
+        self._commit()
 
-        img = self.cur.fetchone()
+        with self.lock:
+            self.tag_index.add(pairs)
 
-        self.cur.execute("""
-        SELECT DISTINCT tags.*
-        FROM tags
-        JOIN tags_join
-        WHERE tags_join.image_id = ?
-        """, [img_id])
-        assigned_tags = self.cur.fetchall()
-        assigned_tag_ids = [tag['id']
-                            for tag in assigned_tags
-                            if not tag['is_dirname']]
+    def _try_assign_tags(self, image_ids: list[int]) -> None:
+        # score the images against every tag at once
+        with self.lock:
+            tag_ids = self.tag_embeddings.ids.copy()
+            if not image_ids or len(tag_ids) == 0:
+                return
 
-        for tag in self.all_tags():
-            tag_id = tag['id']
-            if tag_id in assigned_tag_ids:
-                continue
+            rows = self.embeddings.rows_of(image_ids)
+            scores = self.embeddings.vectors(rows) \
+                @ self.tag_embeddings.matrix.T
+        image_idx, tag_idx = np.nonzero(scores > DataBase.min_sim_score)
 
-            img_embedding = np.frombuffer(img['embedding'], dtype=np.float32)
-            tag_embedding = np.frombuffer(tag['embedding'], dtype=np.float32)
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+        pairs = set(zip(image_ids[image_idx].tolist(),
+                        tag_ids[tag_idx].tolist()))
+        pairs -= self._get_joins_from_image_ids(image_ids.tolist())
 
-            score = self.model.sim_score(img_embedding, tag_embedding)[0]
+        self._log(f'- Adding {len(pairs)} tag(s).')
+        self._assign_tags(sorted(pairs))
 
-            if score > DataBase.min_sim_score:
-                self._log(f'- Adding tag {tag['name']} ({int(score * 100)}%).')
-                self._assign_tag(img_id, tag_id)
+    def _try_assign_tag(self, tag_id: int, after: int = -1,
+                        limit: int | None = None
+                        ) -> tuple[int, int, int] | None:
+        # score the images with an id above after against a single tag, at
+        # most limit of them in id order. Returns the last id scored, the
+        # number of images scored and the number of tags added, or None when
+        # no image is left.
+        with self.lock:
+            tag_embedding = self.tag_embeddings.get(tag_id)
+            if tag_embedding is None:
+                return None
+
+            ids = self.embeddings.ids
+            rows = np.nonzero(ids > after)[0]
+            if len(rows) == 0:
+                return None
+            if limit is not None and len(rows) > limit:
+                rows = rows[np.argpartition(ids[rows], limit - 1)[:limit]]
+
+            scores = self.embeddings.scores(tag_embedding, rows)
+            image_ids = ids[rows][scores > DataBase.min_sim_score]
+            last = int(ids[rows].max())
 
-    def get_image_tags(self, image_id: int) -> list[dict]:
         self.cur.execute("""
+        SELECT tags_join.image_id
+        FROM tags_join
+        WHERE tags_join.tag_id = ?
+        AND tags_join.image_id > ?
+        AND tags_join.image_id <= ?
+        """, [tag_id, after, last])
+        assigned = {row['image_id'] for row in self.cur.fetchall()}
+
+        pairs = [(image_id, tag_id) for image_id in image_ids.tolist()
+                 if image_id not in assigned]
+        self._log(f'- Adding tag to {len(pairs)} image(s).')
+        self._assign_tags(pairs)
+        return last, len(rows), len(pairs)
+
+    def _get_joins_from_image_ids(self,
+                                  image_ids: list[int]) -> set[tuple[int, int]]:
+        rows = self._select_in_chunks("""
+        SELECT tags_join.image_id, tags_join.tag_id
+        FROM tags_join
+        WHERE tags_join.image_id IN ({})
+        """, image_ids)
+        return {(row['image_id'], row['tag_id']) for row in rows}
+
+    def get_image_tags(self, image_id: int) -> list[dict]:
+        self.cur.execute(f"""
         SELECT DISTINCT
-            tags.*
+            {DataBase.tag_columns}
         FROM tags
         JOIN tags_join
         ON tags.id = tags_join.tag_id
@@ -211,19 +716,35 @@ class DataBase:
         """, [image_id])
         return self.cur.fetchall()
 
-    def _all_images(self) -> list[dict]:
-        self.cur.execute("""
-        SELECT images.*
+    def _get_images_from_ids(self, ids: list[int]) -> dict[int, dict]:
+        rows = self._select_in_chunks(f"""
+        SELECT {DataBase.image_columns}
         FROM images
-        ORDER BY images.timestamp DESC
-        """)
-        return self.cur.fetchall()
+        WHERE images.id IN ({{}})
+        """, ids)
+        return {image['id']: image for image in rows}
 
-    def all_tags(self) -> list[dict]:
-        self.cur.execute("""
-        SELECT tags.*
+    def _select_in_chunks(self, query: str, values: list) -> list[dict]:
+        # rows of a query with a single IN ({}), run on in_query_size values
+        # at a time
+        rows = []
+        for i in range(0, len(values), DataBase.in_query_size):
+            chunk = values[i:i + DataBase.in_query_size]
+            self.cur.execute(query.format(', '.join(['?'] * len(chunk))),
+                             chunk)
+            rows += self.cur.fetchall()
+        return rows
+
+    def all_tags(self, limit: int | None = None,
+                 after: int | None = None) -> list[dict]:
+        # ordered by id, `after` is the id of the last tag of the previous page
+        self.cur.execute(f"""
+        SELECT {DataBase.tag_columns}
         FROM tags
-        """)
+        WHERE tags.id > ?
+        ORDER BY tags.id
+        LIMIT ?
+        """, [-1 if after is None else after, -1 if limit is None else limit])
         return self.cur.fetchall()
 
     def _delete_image(self, id: int) -> None:
@@ -231,11 +752,199 @@ class DataBase:
         DELETE FROM images
         WHERE images.id = ?
         """, [id])
+        # only the lists of these tags change in the tag index
+        self.cur.execute("""
+        SELECT tags_join.tag_id
+        FROM tags_join
+        WHERE tags_join.image_id = ?
+        """, [id])
+        tag_ids = [row['tag_id'] for row in self.cur.fetchall()]
         self.cur.execute("""
         DELETE FROM tags_join
         WHERE tags_join.image_id = ?
         """, [id])
-        self.con.commit()
+
+        # a group loses its representative: its duplicates are shown again
+        self.cur.execute("""
+        SELECT duplicates.image_id
+        FROM duplicates
+        WHERE duplicates.representative_id = ?
+        OR duplicates.image_id = ?
+        """, [id, id])
+        members = [row['image_id'] for row in self.cur.fetchall()]
+        self.cur.execute("""
+        DELETE FROM duplicates
+        WHERE duplicates.representative_id = ?
+        OR duplicates.image_id = ?
+        """, [id, id])
+        self._commit()
+
+        with self.lock:
+            self.index.remove(id)
+            self.embeddings.remove(id)
+            self.tag_index.remove_image(id, tag_ids)
+            for member in members:
+                self.duplicate_of.pop(member, None)
+        self.path_cache.remove(id)
+
+    def _read_duplicates(self) -> dict[int, int]:
+        self.cur.execute("""
+        SELECT duplicates.image_id, duplicates.representative_id
+        FROM duplicates
+        WHERE duplicates.image_id != duplicates.representative_id
+        """)
+        return {row[0]: row[1] for row in self.cur.fetchall()}
+
+    def _set_duplicates(self, groups: dict[int, list[int]]) -> None:
+        # representative id -> ids of the group, itself included. Images
+        # deleted since the groups were computed are left out.
+        with self.transaction():
+            self.cur.execute('DELETE FROM duplicates')
+            self.cur.executemany("""
+            INSERT INTO duplicates (image_id, representative_id)
+            SELECT images.id, ?
+            FROM images
+            WHERE images.id = ?
+            """, [(representative, id)
+                  for representative, ids in groups.items() for id in ids])
+            duplicate_of = self._read_duplicates()
+
+        with self.lock:
+            self.duplicate_of = duplicate_of
+            self.duplicates_version += 1
+
+    def _get_duplicate_groups(self) -> dict[int, list[int]]:
+        self.cur.execute("""
+        SELECT duplicates.image_id, duplicates.representative_id
+        FROM duplicates
+        ORDER BY duplicates.representative_id, duplicates.image_id
+        """)
+        groups = {}
+        for image_id, representative in self.cur.fetchall():
+            groups.setdefault(representative, []).append(image_id)
+        return groups
+
+    def _add_job(self, kind: str, params: str) -> int:
+        # a job still waiting with the same parameters would do the same work
+        with self.transaction():
+            self.cur.execute("""
+            SELECT jobs.id
+            FROM jobs
+            WHERE jobs.status = 'queued'
+            AND jobs.kind = ?
+            AND jobs.params = ?
+            AND NOT jobs.cancelled
+            """, [kind, params])
+            job = self.cur.fetchone()
+            if job is not None:
+                return job['id']
+
+            self.cur.execute("""
+            INSERT INTO jobs (kind, params, status, created)
+            VALUES (?, ?, 'queued', ?)""", [kind, params, time.time()])
+            return self.cur.lastrowid
+
+    def _get_job(self, id: int) -> dict | None:
+        self.cur.execute("""
+        SELECT *
+        FROM jobs
+        WHERE jobs.id = ?
+        """, [id])
+        return self.cur.fetchone()
+
+    def _get_jobs(self, limit: int) -> list[dict]:
+        self.cur.execute("""
+        SELECT *
+        FROM jobs
+        ORDER BY jobs.id DESC
+        LIMIT ?
+        """, [limit])
+        return self.cur.fetchall()
+
+    def _find_job(self, kinds: list[str]) -> int | None:
+        self.cur.execute(f"""
+        SELECT jobs.id
+        FROM jobs
+        WHERE jobs.status IN ('queued', 'running')
+        AND jobs.kind IN ({', '.join(['?'] * len(kinds))})
+        AND NOT jobs.cancelled
+        ORDER BY jobs.id
+        LIMIT 1
+        """, kinds)
+        job = self.cur.fetchone()
+        return None if job is None else job['id']
+
+    def _next_job(self) -> dict | None:
+        # the oldest queued job, marked as running
+        with self.transaction():
+            self.cur.execute("""
+            SELECT jobs.id
+            FROM jobs
+            WHERE jobs.status = 'queued'
+            ORDER BY jobs.id
+            LIMIT 1
+            """)
+            job = self.cur.fetchone()
+            if job is None:
+                return None
+
+            self._update_job(job['id'], status='running', started=time.time())
+        return self._get_job(job['id'])
+
+    def _update_job(self, id: int, **values) -> None:
+        columns = ', '.join(f'{column} = ?' for column in values)
+        self.cur.execute(f"""
+        UPDATE jobs
+        SET {columns}
+        WHERE jobs.id = ?
+        """, [*values.values(), id])
+        self._commit()
+
+    def _finish_job(self, id: int, status: str, result: str | None = None,
+                    error: str | None = None) -> None:
+        self._update_job(id, status=status, result=result, error=error,
+                         finished=time.time())
+
+    def _is_job_cancelled(self, id: int) -> bool:
+        self.cur.execute("""
+        SELECT jobs.cancelled
+        FROM jobs
+        WHERE jobs.id = ?
+        """, [id])
+        job = self.cur.fetchone()
+        return job is None or bool(job['cancelled'])
+
+    def _cancel_job(self, id: int) -> bool:
+        # queued jobs are cancelled right away, running ones at their next
+        # checkpoint. Returns whether the job was still queued or running.
+        with self.transaction():
+            self.cur.execute("""
+            UPDATE jobs
+            SET cancelled = 1
+            WHERE jobs.id = ?
+            AND jobs.status IN ('queued', 'running')
+            """, [id])
+            if self.cur.rowcount == 0:
+                return False
+
+            self.cur.execute("""
+            UPDATE jobs
+            SET status = 'cancelled', finished = ?
+            WHERE jobs.id = ?
+            AND jobs.status = 'queued'
+            """, [time.time(), id])
+        return True
+
+    def _requeue_jobs(self) -> int:
+        # jobs left running by a previous process
+        self.cur.execute("""
+        UPDATE jobs
+        SET status = 'queued'
+        WHERE jobs.status = 'running'
+        """)
+        resumed = self.cur.rowcount
+        self._commit()
+        return resumed
 
     def _delete_tag(self, id: int) -> None:
         self.cur.execute("""
@@ -246,69 +955,89 @@ class DataBase:
         DELETE FROM tags_join
         WHERE tags_join.tag_id = ?
         """, [id])
-        self.con.commit()
+        self._commit()
 
-    def filter_all_images(self, tag_ids: list[int]) -> list[dict]:
-        if not tag_ids:
-            return self._all_images()
+        with self.lock:
+            self.tag_embeddings.remove(id)
+            self.tag_index.remove_tag(id)
 
-        num_tags = len(tag_ids)
-        placeholders = ', '.join(['?'] * num_tags)
-
-        self.cur.execute(f"""
-        SELECT images.*
-        FROM images
-        JOIN tags_join
-        ON images.id = tags_join.image_id
-        WHERE tags_join.tag_id in ({placeholders})
-        GROUP BY images.id
-        HAVING COUNT(DISTINCT tags_join.tag_id) = ?
-        """, tag_ids + [num_tags])
-        return self.cur.fetchall()
-
-    def _filter_around(self, timestamp: float, tag_ids: list[int],
-                       n: int, search_after: bool) -> list[dict]:
-        if search_after:
-            comp = '>='
-            order = 'ASC'
-        else:
-            comp = '<='
-            order = 'DESC'
+    def filter_all_images(self, tag_ids: list[int], limit: int | None = None,
+                          after: tuple[float, int] | None = None) -> list[dict]:
+        # newest first, `after` is the (timestamp, id) of the last image of
+        # the previous page
+        keyset = ''
+        keyset_params = []
+        if after is not None:
+            keyset = """AND (images.timestamp < ?
+            OR (images.timestamp = ? AND images.id < ?))"""
+            keyset_params = [after[0], after[0], after[1]]
+        limit = -1 if limit is None else limit
 
         if not tag_ids:
             self.cur.execute(f"""
-            SELECT images.*
+            SELECT {DataBase.image_columns}
             FROM images
-            WHERE images.timestamp {comp} ?
-            ORDER BY images.timestamp {order}
+            WHERE 1 {keyset}
+            ORDER BY images.timestamp DESC, images.id DESC
             LIMIT ?
-            """, [timestamp, n])
+            """, keyset_params + [limit])
             return self.cur.fetchall()
 
-        num_tags = len(tag_ids)
-        placeholders = ', '.join(['?'] * num_tags)
+        # the tags are intersected in memory, only the page is read
+        with self.lock:
+            ids = self.tag_index.filter(tag_ids)
+            ids = self.tag_index.ordered(ids, True,
+                                         None if limit < 0 else limit, after)
+        return self._ordered_images(ids)
 
-        self.cur.execute(f"""
-        SELECT images.*
-        FROM images
-        JOIN tags_join
-        ON images.id = tags_join.image_id
-        WHERE tags_join.tag_id IN ({placeholders})
-        AND images.timestamp {comp} ?
-        GROUP BY images.id
-        HAVING COUNT(DISTINCT tags_join.tag_id) = ?
-        ORDER BY images.timestamp {order}
-        LIMIT ?
-        """, tag_ids + [timestamp, num_tags, n])
-        return self.cur.fetchall()
+    def _ordered_images(self, ids: np.ndarray) -> list[dict]:
+        images = self._get_images_from_ids(ids.tolist())
+        return [images[id] for id in ids.tolist() if id in images]
 
-    def closest_to_date(self, timestamp: float) -> dict:
-        self.cur.execute("""
-        SELECT
-            images.*,
-            ABS(images.timestamp - ?) AS distance
-        FROM images
-        ORDER BY distance ASC
-        LIMIT 1
-        """, [timestamp])
-        return self.cur.fetchone()
+    def _images_around(self, timestamp: float, id: int | None,
+                       tag_ids: list[int], n: int) -> list[dict]:
+        # n images up to (timestamp, id), latest first, then the n - 1 next
+        # ones in chronological order
+        with self.lock:
+            timeline = self.tag_index.timeline(tag_ids)
+            ids = np.concatenate([timeline.before(timestamp, id, n),
+                                  timeline.after(timestamp, id, n - 1)])
+        return self._ordered_images(ids)
+
+    def closest_to_date(self, timestamp: float,
+                        tag_ids: list[int] | None = None) -> dict | None:
+        with self.lock:
+            id = self.tag_index.timeline(tag_ids or []).closest(timestamp)
+        return None if id is None else self._get_image_from_id(id)
+
+    def _date_histogram(self, unit: str, tag_ids: list[int],
+                        start: float | None,
+                        end: float | None) -> list[tuple[float, int]]:
+        with self.lock:
+            return self.tag_index.timeline(tag_ids).histogram(unit, start,
+                                                              end)
+
+    def _count_candidates(self, tag_ids: list[int], start: float | None,
+                          end: float | None) -> int:
+        # upper bound of the number of images matching a filter, from the
+        # rarest tag and the time range, both counted on indexes
+        with self.lock:
+            counts = [len(self.embeddings)]
+            counts += [self.tag_index.count(tag_id) for tag_id in tag_ids]
+
+            if start is not None or end is not None:
+                counts.append(self.tag_index.all.count(start, end))
+
+        return min(counts)
+
+    def _filter_image_ids(self, tag_ids: list[int], start: float | None,
+                          end: float | None,
+                          among: list[int] | None = None) -> list[int]:
+        # ids of the images with all the tags and in the time range, among
+        # the given ones if any
+        with self.lock:
+            ids = self.tag_index.filter(tag_ids, start, end)
+        if among is not None:
+            ids = np.intersect1d(ids, np.asarray(among, dtype=np.int64))
+
+        return ids.tolist()
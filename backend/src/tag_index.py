@@ -0,0 +1,188 @@
+import numpy as np
+
+from .timeline import Timeline
+
+class TagIndex:
+    # Inverted index of the tag assignments: tag id -> sorted ids of the
+    # images with that tag, along with the timestamp of every image, indexed
+    # by image id. Filters intersect the lists of their tags from the rarest
+    # one, then order the few remaining images by timestamp.
+    #
+    # Assignments are buffered per tag and merged into its list when it is
+    # read, or once the buffer grows past a share of the list, so that
+    # tagging a batch of new images does not copy every list.
+    #
+    # Chronological queries go through a timeline of all the images, kept up
+    # to date, and timelines of single tags, built when first needed and
+    # dropped when the tag changes.
+
+    # pending assignments of a tag, relative to its list, before a merge
+    merge_ratio = .125
+    min_pending = 1024
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.postings: dict[int, np.ndarray] = {}
+        self.pending: dict[int, list[int]] = {}
+        # NaN for the ids of missing images
+        self.timestamps = np.full(0, np.nan)
+        self.all = Timeline()
+        self.tag_timelines: dict[int, Timeline] = {}
+
+    def load(self, image_ids: list[int], timestamps: list[float],
+             pairs: list[tuple[int, int]]) -> None:
+        # pairs are (image id, tag id)
+        self.clear()
+        self.set_timestamps(image_ids, timestamps)
+
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        pairs = pairs[np.lexsort((pairs[:, 0], pairs[:, 1]))]
+        tags, starts = np.unique(pairs[:, 1], return_index=True)
+        for tag_id, image_ids in zip(tags.tolist(),
+                                     np.split(pairs[:, 0], starts[1:])):
+            self.postings[tag_id] = np.unique(image_ids)
+
+    def set_timestamps(self, image_ids: list[int],
+                       timestamps: list[float]) -> None:
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+        if len(image_ids) == 0:
+            return
+
+        size = int(image_ids.max()) + 1
+        if size > len(self.timestamps):
+            grown = np.full(max(size, 2 * len(self.timestamps)), np.nan)
+            grown[:len(self.timestamps)] = self.timestamps
+            self.timestamps = grown
+
+        known = image_ids[~np.isnan(self.timestamps[image_ids])]
+        if len(known):
+            # moved in time, the order of their tags changes
+            self.all.remove(known.tolist())
+            self.tag_timelines.clear()
+        self.timestamps[image_ids] = timestamps
+        self.all.add(image_ids, self.timestamps[image_ids])
+
+    def add(self, pairs: list[tuple[int, int]]) -> None:
+        for image_id, tag_id in pairs:
+            self.tag_timelines.pop(tag_id, None)
+            pending = self.pending.setdefault(tag_id, [])
+            pending.append(image_id)
+
+            size = len(self.postings.get(tag_id, ()))
+            if len(pending) >= max(TagIndex.min_pending,
+                                   size * TagIndex.merge_ratio):
+                self._merge(tag_id)
+
+    def _merge(self, tag_id: int) -> np.ndarray:
+        image_ids = self.postings.get(tag_id, np.empty(0, dtype=np.int64))
+        pending = self.pending.pop(tag_id, None)
+        if pending:
+            pending = np.unique(np.asarray(pending, dtype=np.int64))
+            if len(image_ids) == 0 or pending[0] > image_ids[-1]:
+                # new images have the highest ids
+                image_ids = np.concatenate([image_ids, pending])
+            else:
+                image_ids = np.union1d(image_ids, pending)
+            self.postings[tag_id] = image_ids
+
+        return image_ids
+
+    def remove(self, image_id: int, tag_id: int) -> None:
+        image_ids = self._merge(tag_id)
+        i = np.searchsorted(image_ids, image_id)
+        if i < len(image_ids) and image_ids[i] == image_id:
+            self.postings[tag_id] = np.delete(image_ids, i)
+            self.tag_timelines.pop(tag_id, None)
+
+    def remove_image(self, image_id: int, tag_ids: list[int]) -> None:
+        # ids can be reused by SQLite, forget every tag of the image
+        if image_id < len(self.timestamps) \
+                and not np.isnan(self.timestamps[image_id]):
+            self.timestamps[image_id] = np.nan
+            self.all.remove([image_id])
+        for tag_id in tag_ids:
+            self.remove(image_id, tag_id)
+
+    def remove_tag(self, tag_id: int) -> None:
+        self.postings.pop(tag_id, None)
+        self.pending.pop(tag_id, None)
+        self.tag_timelines.pop(tag_id, None)
+
+    def count(self, tag_id: int) -> int:
+        return len(self._merge(tag_id))
+
+    def filter(self, tag_ids: list[int], start: float | None = None,
+               end: float | None = None) -> np.ndarray:
+        # ids of the images with all the tags, taken between start and end
+        lists = sorted((self._merge(tag_id) for tag_id in set(tag_ids)),
+                       key=len)
+        if not lists:
+            return np.sort(self.all.between(start, end))
+
+        image_ids = lists[0]
+        for other in lists[1:]:
+            if len(image_ids) == 0:
+                break
+            # look the remaining ids up in the longer list
+            i = np.searchsorted(other, image_ids)
+            found = i < len(other)
+            found[found] = other[i[found]] == image_ids[found]
+            image_ids = image_ids[found]
+
+        image_ids = image_ids[image_ids < len(self.timestamps)]
+        timestamps = self.timestamps[image_ids]
+        keep = ~np.isnan(timestamps)
+        if start is not None:
+            keep &= timestamps >= start
+        if end is not None:
+            keep &= timestamps <= end
+        return image_ids[keep]
+
+    def timeline(self, tag_ids: list[int]) -> Timeline:
+        # images with all the tags
+        tag_ids = set(tag_ids)
+        if not tag_ids:
+            return self.all
+
+        if len(tag_ids) > 1:
+            timeline = Timeline()
+            image_ids = self.filter(tag_ids)
+            timeline.load(image_ids, self.timestamps[image_ids])
+            return timeline
+
+        tag_id, = tag_ids
+        timeline = self.tag_timelines.get(tag_id)
+        if timeline is None:
+            timeline = self.tag_timelines[tag_id] = Timeline()
+            image_ids = self.filter([tag_id])
+            timeline.load(image_ids, self.timestamps[image_ids])
+        return timeline
+
+    def ordered(self, image_ids: np.ndarray, descending: bool,
+                limit: int | None = None,
+                after: tuple[float, int] | None = None) -> np.ndarray:
+        # the first ids in (timestamp, id) order, after the given key if any
+        timestamps = self.timestamps[image_ids]
+        if after is not None:
+            timestamp, id = after
+            if descending:
+                keep = (timestamps < timestamp) \
+                    | ((timestamps == timestamp) & (image_ids < id))
+            else:
+                keep = (timestamps > timestamp) \
+                    | ((timestamps == timestamp) & (image_ids > id))
+            image_ids = image_ids[keep]
+            timestamps = timestamps[keep]
+
+        keys = -timestamps if descending else timestamps
+        if limit is not None and len(image_ids) > limit:
+            # only sort the images that can make it to the first ones
+            last = np.partition(keys, limit - 1)[limit - 1]
+            keep = keys <= last
+            image_ids = image_ids[keep]
+            keys = keys[keep]
+
+        order = np.lexsort((-image_ids if descending else image_ids, keys))
+        return image_ids[order[:limit]]
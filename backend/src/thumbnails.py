@@ -0,0 +1,136 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageOps
+
+class ThumbnailCache:
+    # requested sizes are rounded up to one of these to bound the variants
+    sizes = [64, 128, 256, 512, 1024]
+    quality = 85
+
+    def __init__(self, cache_dir: str, max_bytes: int = 1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        # least recently used first, file name -> size in bytes
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.by_image: dict[int, set[str]] = {}
+        self.total_bytes = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        files = []
+        with os.scandir(cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.tmp'):
+                    os.remove(entry.path)
+                    continue
+                if not entry.name.split('_', 1)[0].isdigit():
+                    continue
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self._add(name, size)
+
+    @staticmethod
+    def bucket(size: int) -> int:
+        for bucket in ThumbnailCache.sizes:
+            if size <= bucket:
+                return bucket
+
+        return ThumbnailCache.sizes[-1]
+
+    @staticmethod
+    def etag(image_id: int, size: int, mtime: float) -> str:
+        return f'"{image_id}-{size}-{int(mtime * 1e6)}"'
+
+    def _name(self, image_id: int, size: int, path: str, mtime: float) -> str:
+        # the source path and mtime are part of the name so that modified
+        # files and reused ids never hit a stale thumbnail
+        key = f'{path}\0{mtime}'.encode()
+        digest = hashlib.blake2b(key, digest_size=8).hexdigest()
+        return f'{image_id}_{size}_{digest}.jpg'
+
+    def get(self, image_id: int, size: int, path: str, mtime: float) -> str:
+        size = ThumbnailCache.bucket(size)
+        name = self._name(image_id, size, path, mtime)
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                return os.path.join(self.cache_dir, name)
+
+        with Image.open(path) as image:
+            image.draft('RGB', (size, size))
+            return self._store(image_id, size, name, image)
+
+    def put(self, image_id: int, size: int, path: str, mtime: float,
+            image: Image.Image) -> None:
+        # store a thumbnail from an already decoded image
+        size = ThumbnailCache.bucket(size)
+        name = self._name(image_id, size, path, mtime)
+        with self.lock:
+            if name in self.entries:
+                return
+
+        self._store(image_id, size, name, image)
+
+    def _store(self, image_id: int, size: int, name: str,
+               image: Image.Image) -> str:
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        image.thumbnail((size, size))
+
+        path = os.path.join(self.cache_dir, name)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        image.save(tmp_path, 'JPEG', quality=ThumbnailCache.quality)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            # drop the thumbnails of older versions of the file
+            prefix = f'{image_id}_{size}_'
+            for old in list(self.by_image.get(image_id, ())):
+                if old.startswith(prefix) and old != name:
+                    self._remove(old)
+
+            self._add(name, os.path.getsize(path))
+            self._evict()
+
+        return path
+
+    def _add(self, name: str, size: int) -> None:
+        if name in self.entries:
+            self._remove(name, False)
+
+        self.entries[name] = size
+        self.total_bytes += size
+        image_id = int(name.split('_', 1)[0])
+        self.by_image.setdefault(image_id, set()).add(name)
+
+    def _remove(self, name: str, delete_file: bool = True) -> None:
+        self.total_bytes -= self.entries.pop(name)
+        image_id = int(name.split('_', 1)[0])
+        names = self.by_image[image_id]
+        names.discard(name)
+        if not names:
+            del self.by_image[image_id]
+
+        if delete_file:
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            self._remove(next(iter(self.entries)))
+
+    def remove(self, image_id: int) -> None:
+        with self.lock:
+            for name in list(self.by_image.get(image_id, ())):
+                self._remove(name)
+
+    def clear(self) -> None:
+        with self.lock:
+            for name in list(self.entries):
+                self._remove(name)
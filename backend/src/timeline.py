@@ -0,0 +1,156 @@
+from datetime import datetime
+import numpy as np
+
+# calendar periods of the histograms, in local time like the year and month
+# tags
+units = ['day', 'month', 'year']
+
+def _period_start(date: datetime, unit: str) -> datetime:
+    if unit == 'year':
+        return datetime(date.year, 1, 1)
+    if unit == 'month':
+        return datetime(date.year, date.month, 1)
+    return datetime(date.year, date.month, date.day)
+
+def _next_period(date: datetime, unit: str) -> datetime:
+    if unit == 'year':
+        return datetime(date.year + 1, 1, 1)
+    if unit == 'month':
+        return datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+    # not a fixed 86400 seconds, days can be shorter or longer with DST
+    return datetime.fromordinal(date.toordinal() + 1)
+
+class Timeline:
+    # Image ids sorted by (timestamp, id), answering chronological queries
+    # with binary searches. Changes are buffered and merged on the next read,
+    # so that a sync adding batches of images does not copy the arrays for
+    # each of them.
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.times = np.empty(0)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.added: list[tuple[np.ndarray, np.ndarray]] = []
+        self.removed: set[int] = set()
+
+    def load(self, image_ids: np.ndarray, timestamps: np.ndarray) -> None:
+        self.clear()
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        order = np.lexsort((image_ids, timestamps))
+        self.times = timestamps[order]
+        self.ids = image_ids[order]
+
+    def add(self, image_ids: np.ndarray, timestamps: np.ndarray) -> None:
+        # removals are applied first, an id can be removed and added back
+        if self.removed:
+            self._merge()
+        self.added.append((np.asarray(image_ids, dtype=np.int64),
+                           np.asarray(timestamps, dtype=np.float64)))
+
+    def remove(self, image_ids: list[int]) -> None:
+        if self.added:
+            self._merge()
+        self.removed.update(image_ids)
+
+    def _merge(self) -> None:
+        if self.removed:
+            keep = ~np.isin(self.ids, np.fromiter(self.removed, np.int64))
+            self.times = self.times[keep]
+            self.ids = self.ids[keep]
+            self.removed.clear()
+
+        if self.added:
+            image_ids = np.concatenate([ids for ids, _ in self.added])
+            timestamps = np.concatenate([times for _, times in self.added])
+            self.added.clear()
+            order = np.lexsort((image_ids, timestamps))
+            image_ids = image_ids[order]
+            timestamps = timestamps[order]
+
+            # insertion points, only equal timestamps need the ids compared
+            positions = np.searchsorted(self.times, timestamps, 'left')
+            ends = np.searchsorted(self.times, timestamps, 'right')
+            for i in np.nonzero(positions < ends)[0].tolist():
+                positions[i] = self._end(timestamps[i], image_ids[i])
+            self.times = np.insert(self.times, positions, timestamps)
+            self.ids = np.insert(self.ids, positions, image_ids)
+
+    def __len__(self) -> int:
+        self._merge()
+        return len(self.ids)
+
+    def _end(self, timestamp: float, id: int | None = None) -> int:
+        # number of images up to (timestamp, id), all the images taken at
+        # timestamp when id is None
+        end = int(np.searchsorted(self.times, timestamp, 'right'))
+        if id is None:
+            return end
+        start = int(np.searchsorted(self.times, timestamp, 'left'))
+        return start + int(np.searchsorted(self.ids[start:end], id, 'right'))
+
+    def closest(self, timestamp: float) -> int | None:
+        # the earlier one when two images are as close
+        self._merge()
+        i = int(np.searchsorted(self.times, timestamp))
+        if i == len(self.times) or (i > 0 and timestamp - self.times[i - 1]
+                                    <= self.times[i] - timestamp):
+            i -= 1
+        return None if i < 0 else int(self.ids[i])
+
+    def before(self, timestamp: float, id: int | None,
+               n: int) -> np.ndarray:
+        # the n last images up to (timestamp, id) included, latest first
+        self._merge()
+        end = self._end(timestamp, id)
+        return self.ids[max(end - n, 0):end][::-1]
+
+    def after(self, timestamp: float, id: int | None,
+              n: int) -> np.ndarray:
+        # the n first images after (timestamp, id)
+        self._merge()
+        start = self._end(timestamp, id)
+        return self.ids[start:start + n]
+
+    def _range(self, start: float | None, end: float | None
+               ) -> tuple[int, int]:
+        # bounds included
+        first = 0 if start is None else \
+            int(np.searchsorted(self.times, start, 'left'))
+        last = len(self.times) if end is None else self._end(end)
+        return first, max(first, last)
+
+    def between(self, start: float | None, end: float | None) -> np.ndarray:
+        # in chronological order
+        self._merge()
+        first, last = self._range(start, end)
+        return self.ids[first:last]
+
+    def count(self, start: float | None, end: float | None) -> int:
+        self._merge()
+        first, last = self._range(start, end)
+        return last - first
+
+    def histogram(self, unit: str, start: float | None = None,
+                  end: float | None = None) -> list[tuple[float, int]]:
+        # (start of the period, images) for each day, month or year with
+        # images, between start and end
+        self._merge()
+        first, last = self._range(start, end)
+        times = self.times[first:last]
+        if len(times) == 0:
+            return []
+
+        edges = []
+        date = _period_start(datetime.fromtimestamp(times[0]), unit)
+        while True:
+            edges.append(date.timestamp())
+            if edges[-1] > times[-1]:
+                break
+            date = _next_period(date, unit)
+
+        counts = np.diff(np.searchsorted(times, edges, 'left'))
+        return [(edges[i], int(counts[i]))
+                for i in np.nonzero(counts)[0].tolist()]
@@ -0,0 +1,263 @@
+import os
+import sys
+import time
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+from typing import Callable
+
+class Watcher:
+    # watches a directory tree in a background thread and reports the paths
+    # that changed, batched once no new event arrived for `debounce` seconds
+
+    # flush anyway when events keep coming for that long
+    max_delay = 10
+
+    def __init__(self, root: str, callback: Callable[[list[str]], None],
+                 debounce: float = 1):
+        self.root = root
+        self.callback = callback
+        self.debounce = debounce
+
+        self.pending: set[str] = set()
+        self.first_event = 0
+        self.last_event = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _changed(self, path: str) -> None:
+        now = time.monotonic()
+        if not self.pending:
+            self.first_event = now
+        self.last_event = now
+        self.pending.add(path)
+
+    def _flush(self) -> None:
+        if not self.pending:
+            return
+
+        now = time.monotonic()
+        if now - self.last_event < self.debounce \
+                and now - self.first_event < Watcher.max_delay:
+            return
+
+        paths = sorted(self.pending)
+        self.pending = set()
+        self.callback(paths)
+
+    def _run(self) -> None:
+        self._setup()
+        try:
+            while not self.stopped.is_set():
+                self._poll(min(self.debounce, 1))
+                self._flush()
+        finally:
+            self._teardown()
+
+    def _setup(self) -> None:
+        pass
+
+    def _teardown(self) -> None:
+        pass
+
+    def _poll(self, timeout: float) -> None:
+        raise NotImplementedError
+
+class InotifyWatcher(Watcher):
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE \
+        | IN_DELETE | IN_DELETE_SELF
+    event_header = struct.Struct('iIII')
+
+    @staticmethod
+    def available() -> bool:
+        if not sys.platform.startswith('linux'):
+            return False
+
+        libc = ctypes.util.find_library('c')
+        return libc is not None \
+            and hasattr(ctypes.CDLL(libc), 'inotify_init1')
+
+    def _setup(self) -> None:
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.dirs: dict[int, str] = {} # watch descriptor -> directory
+        self._watch_tree(self.root)
+
+    def _teardown(self) -> None:
+        os.close(self.fd)
+
+    def _watch_tree(self, path: str) -> None:
+        # only directories are visited, files are reported by their events
+        for dir, _, _ in os.walk(path):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir),
+                                             InotifyWatcher.mask)
+            if wd >= 0:
+                self.dirs[wd] = dir
+
+    def _unwatch_tree(self, path: str) -> None:
+        prefix = path + os.sep
+        for wd, dir in list(self.dirs.items()):
+            if dir == path or dir.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.dirs[wd]
+
+    def _poll(self, timeout: float) -> None:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return
+
+        header = InotifyWatcher.event_header
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = header.unpack_from(data, offset)
+            offset += header.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            self._event(wd, mask, os.fsdecode(name))
+
+    def _event(self, wd: int, mask: int, name: str) -> None:
+        if mask & InotifyWatcher.IN_Q_OVERFLOW:
+            # events were lost, let the consumer rescan everything
+            self._changed(self.root)
+            return
+
+        if mask & InotifyWatcher.IN_IGNORED:
+            self.dirs.pop(wd, None)
+            return
+
+        dir = self.dirs.get(wd)
+        if dir is None or mask & InotifyWatcher.IN_DELETE_SELF:
+            return
+
+        path = os.path.join(dir, name)
+        if mask & InotifyWatcher.IN_ISDIR:
+            if mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO):
+                self._watch_tree(path)
+            elif mask & InotifyWatcher.IN_MOVED_FROM:
+                self._unwatch_tree(path)
+        elif mask & InotifyWatcher.IN_CREATE:
+            # wait for IN_CLOSE_WRITE, the file may still be written to
+            return
+
+        self._changed(path)
+
+class PollingWatcher(Watcher):
+    # fallback for platforms without inotify: only the directories are
+    # stat'ed on every poll, and a directory is listed again only when its
+    # mtime changed, which happens when an entry is added, removed or renamed
+    # in it. Files modified in place are picked up by the next full sync.
+
+    interval = 2
+
+    def _setup(self) -> None:
+        self.dirs: dict[str, float] = {} # directory -> mtime
+        self.entries: dict[str, dict[str, tuple]] = {} # directory -> listing
+        self._scan_tree(self.root)
+        self.next_poll = time.monotonic() + PollingWatcher.interval
+
+    def _list(self, dir: str) -> dict[str, tuple]:
+        # the stats of subdirectories are left out: their mtime changes with
+        # their entries, which their own poll reports
+        entries = {}
+        with os.scandir(dir) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        entries[entry.name] = (True, None, None)
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries[entry.name] = (False, stat.st_size, stat.st_mtime)
+
+        return entries
+
+    def _scan_tree(self, path: str) -> None:
+        for dir, _, _ in os.walk(path):
+            try:
+                self.dirs[dir] = os.stat(dir).st_mtime
+                self.entries[dir] = self._list(dir)
+            except OSError:
+                continue
+
+    def _forget_tree(self, path: str) -> None:
+        prefix = path + os.sep
+        for dir in list(self.dirs):
+            if dir == path or dir.startswith(prefix):
+                del self.dirs[dir]
+                del self.entries[dir]
+
+    def _poll(self, timeout: float) -> None:
+        wait = self.next_poll - time.monotonic()
+        if wait > 0:
+            self.stopped.wait(min(wait, timeout))
+            return
+        self.next_poll = time.monotonic() + PollingWatcher.interval
+
+        for dir, mtime in list(self.dirs.items()):
+            if dir not in self.dirs:
+                continue # forgotten along with a parent directory
+
+            try:
+                current = os.stat(dir).st_mtime
+                if current == mtime:
+                    continue
+                entries = self._list(dir)
+            except OSError:
+                self._forget_tree(dir)
+                self._changed(dir)
+                continue
+
+            old_entries = self.entries[dir]
+            self.dirs[dir] = current
+            self.entries[dir] = entries
+
+            for name in old_entries.keys() | entries.keys():
+                old = old_entries.get(name)
+                new = entries.get(name)
+                if old == new:
+                    continue
+
+                path = os.path.join(dir, name)
+                if old is not None and old[0]:
+                    self._forget_tree(path)
+                if new is not None and new[0]:
+                    self._scan_tree(path)
+                self._changed(path)
+
+def create_watcher(root: str, callback: Callable[[list[str]], None],
+                   debounce: float = 1) -> Watcher:
+    if InotifyWatcher.available():
+        return InotifyWatcher(root, callback, debounce)
+
+    return PollingWatcher(root, callback, debounce)
@@ -15,13 +15,16 @@ let tagElts = []; // {tag id: {global element, current element}, ...}
 const MAX_IMAGE_LENGTH = 30;
 const PROMPT_N_RESULTS = 50;
 const TAG_SEARCH_RADIUS = 10;
+const THUMBNAIL_SIZE = 256;
+const JOB_POLL_DELAY = 1000;
 const LEFT = 0, RIGHT = 1;
-const TAG_SEARCH = 0, PROMPT = 1;
+const TAG_SEARCH = 0, PROMPT = 1, SIMILAR = 2;
 
 let currentImage = null;
 let lastMove = RIGHT;
 let searchMethod = TAG_SEARCH;
 let prompt = "";
+let similarTo = null; // image id
 let imageList = [];
 let lastScroll;
 
@@ -202,7 +205,7 @@ function updateImageList(list) {
 
         const div = document.createElement("DIV");
         div.innerHTML = '<img src="' + backendUrl + "/image/" + image.id +
-            '/data" image-id="' + image.id + '">';
+            '/thumb?size=' + THUMBNAIL_SIZE + '" image-id="' + image.id + '">';
         elts.right.appendChild(div);
     });
 }
@@ -281,6 +284,13 @@ function applySearch() {
                 transitionCurrent();
             });
     }
+    else if (searchMethod == SIMILAR) {
+        httpGet("/image/" + similarTo + "/similar?n=" + PROMPT_N_RESULTS,
+            [], list => {
+                updateImageList(list);
+                transitionCurrent();
+            });
+    }
 }
 
 function applyTagFilters() {
@@ -366,25 +376,24 @@ function uploadMedia() {
     document.body.appendChild(input);
     input.click();
     input.addEventListener("change", () => {
-        let count = 0;
-        const targetCount = input.files.length;
-
+        // all the files in a single request
+        const formData = new FormData();
         Array.from(input.files).forEach(file => {
             const timestamp = new Date(file.lastModified).getTime() / 1000;
-
-            const formData = new FormData();
-            formData.append("name", file.name);
-            formData.append("timestamp", timestamp);
-            formData.append("file", file);
-            httpPost("/images/new", [], formData, () => {
-                if (++count < targetCount)
-                    return;
-
-                // all files have been uploaded
-                refreshAll();
-            }, true);
+            formData.append("files", file);
+            formData.append("timestamps", timestamp);
         });
 
+        httpPost("/images/batch", [], formData, results => {
+            const failed = results.filter(result =>
+                result.status !== "added" && result.status !== "exists");
+            if (failed.length > 0)
+                alert("Failed to upload " + failed.map(result =>
+                    result.name).join(", "));
+
+            refreshAll();
+        }, true);
+
         input.remove();
     });
 }
@@ -403,6 +412,18 @@ function searchWithPrompt() {
     applySearch();
 }
 
+function searchSimilar() {
+    if (currentImage == null) {
+        alert("Please select media first.");
+        return;
+    }
+
+    similarTo = currentImage.id;
+    currentImage = null; // force select the best match in upcoming transition
+    searchMethod = SIMILAR;
+    applySearch();
+}
+
 function trashCurrent() {
     const ok = confirm("Really delete this image?");
     if (!ok)
@@ -426,8 +447,20 @@ function syncDatabase() {
     if (!ok)
         return;
 
-    httpGet("/sync", [], () => {
-        updateGlobalTags();
+    httpGet("/sync", [], job => {
+        waitForJob(job.job_id, updateGlobalTags);
+    });
+}
+
+function waitForJob(id, callback) {
+    httpGet("/jobs/" + id, [], job => {
+        if (job.status == "queued" || job.status == "running")
+            setTimeout(() => waitForJob(id, callback), JOB_POLL_DELAY);
+        else if (job.status == "done")
+            callback(job.result);
+        else
+            alert("Job " + job.kind + " " + job.status +
+                (job.error == null ? "" : ": " + job.error));
     });
 }
 